@@ -22,8 +22,9 @@ from .views import Api_LoginView
 from .views import ApiDevPanel_ResourceJSON, ApiDevPanel_ResourceRaw, ApiDevPanel_ResourceHistory
 from .views import ApiDevPanel_ClassidViewDetails, ApiDevPanel_ClassidViewList
 from .views import ApiDevPanel_Config, ApiDevPanel_Log
-from .views import ApiDevPanel_CatalogReindex
+from .views import ApiDevPanel_CatalogCheck, ApiDevPanel_CatalogReindex
 from .views import ApiDevPanel_ServerView, ApiDevPanel_ServerStop
+from .views import ApiDevPanel_Metrics
 
 
 urlpatterns = [
@@ -44,7 +45,9 @@ urlpatterns = [
     urlpattern('/devpanel/log/update', ApiDevPanel_Log(source_name='update')),
     # Catalog
     urlpattern('/devpanel/catalog/reindex', ApiDevPanel_CatalogReindex),
+    urlpattern('/devpanel/catalog/check', ApiDevPanel_CatalogCheck),
     # Server
     urlpattern('/devpanel/server', ApiDevPanel_ServerView),
     urlpattern('/devpanel/server/stop', ApiDevPanel_ServerStop),
+    urlpattern('/devpanel/metrics', ApiDevPanel_Metrics),
 ]
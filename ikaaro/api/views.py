@@ -291,16 +291,50 @@ class ApiDevPanel_Log(Api_View):
 
 
 class ApiDevPanel_CatalogReindex(Api_View):
-    """ Reindex the catalog
+    """ Reindex the catalog, in the background (POST), and report the
+    progress (GET)
     """
 
     access = 'is_admin'
-    known_methods = ['POST']
+    known_methods = ['GET', 'POST']
+
+    def GET(self, root, context):
+        reindex = context.server.catalog_reindex
+        if reindex is None:
+            return self.return_json({'state': None}, context)
+        return self.return_json(reindex.get_status(), context)
+
+
+    def POST(self, root, context):
+        try:
+            reindex = context.server.start_catalog_reindex()
+        except ValueError as error:
+            return context.return_json({'error': str(error)}, status=409)
+        return self.return_json(reindex.get_status(), context)
+
+
+
+class ApiDevPanel_CatalogCheck(Api_View):
+    """ Check and repair the catalog, in the background (POST), and report
+    the progress (GET)
+    """
+
+    access = 'is_admin'
+    known_methods = ['GET', 'POST']
+
+    def GET(self, root, context):
+        check = context.server.catalog_check
+        if check is None:
+            return self.return_json({'state': None}, context)
+        return self.return_json(check.get_status(), context)
 
-    async def POST(self, root, context):
-        n = await context.database.reindex_catalog(base_abspath='/')
-        kw = {'n': n}
-        return self.return_json(kw, context)
+
+    def POST(self, root, context):
+        try:
+            check = context.server.start_catalog_check()
+        except ValueError as error:
+            return context.return_json({'error': str(error)}, status=409)
+        return self.return_json(check.get_status(), context)
 
 
 
@@ -325,6 +359,108 @@ class ApiDevPanel_ServerView(Api_View):
 
 
 
+class ApiDevPanel_Metrics(Api_View):
+    """ Return the runtime metrics, in the Prometheus text format
+    """
+
+    access = 'is_admin'
+    known_methods = ['GET']
+
+    def get_values(self, server, database):
+        """Return the gauges and counters, the histograms are kept by
+        server.metrics
+        """
+        values = []
+        # Lock
+        lock_stats = database.lock.get_stats()
+        values.append((
+            'ikaaro_lock_acquired_total', 'counter',
+            'Number of times the database lock was acquired',
+            [ ({'mode': mode}, lock_stats[mode]['acquired'])
+              for mode in ('read', 'write') ]))
+        values.append((
+            'ikaaro_lock_waiting', 'gauge',
+            'Number of tasks waiting for the database lock',
+            [ ({'mode': mode}, lock_stats[mode]['waiting'])
+              for mode in ('read', 'write') ]))
+        # Catalog
+        values.append((
+            'ikaaro_catalog_searches_total', 'counter',
+            'Number of catalog searches', [({}, database.search_count)]))
+        # Handlers cache
+        size_min, size_max = server.database_size
+        values.append((
+            'ikaaro_handler_cache_size', 'gauge',
+            'Number of handlers in the database cache',
+            [({}, len(database.cache))]))
+        values.append((
+            'ikaaro_handler_cache_max', 'gauge',
+            'Maximum number of handlers in the database cache (database-size)',
+            [({}, size_max)]))
+        # Page cache
+        if server.page_cache:
+            stats = server.page_cache.get_stats()
+            values.append((
+                'ikaaro_page_cache_size', 'gauge',
+                'Number of pages in the cache', [({}, stats['size'])]))
+            values.append((
+                'ikaaro_page_cache_requests_total', 'counter',
+                'Number of lookups in the page cache',
+                [({'result': 'hit'}, stats['hits']),
+                 ({'result': 'miss'}, stats['misses'])]))
+        # Commit phases (see Database._before_commit)
+        commit_stats = getattr(database, 'commit_stats', None)
+        if commit_stats:
+            totals = commit_stats.totals
+            values.append((
+                'ikaaro_commit_phase_seconds_total', 'counter',
+                'Time spent in every phase of the commits',
+                [ ({'phase': x}, y[0]) for x, y in totals.items() ]))
+            values.append((
+                'ikaaro_commit_phase_resources_total', 'counter',
+                'Number of resources processed by every phase of the commits',
+                [ ({'phase': x}, y[1]) for x, y in totals.items() ]))
+        # Group commit
+        group_commit = getattr(database, 'group_commit', None)
+        if group_commit:
+            values.append((
+                'ikaaro_group_commits_total', 'counter',
+                'Number of commits saving a batch of transactions',
+                [({}, group_commit.commits)]))
+            values.append((
+                'ikaaro_group_commit_deferred_total', 'counter',
+                'Number of transactions deferred to a group commit',
+                [({}, group_commit.transactions)]))
+        # Spool
+        values.append((
+            'ikaaro_spool_size', 'gauge',
+            'Number of emails waiting in the spool',
+            [({}, server.get_spool_size())]))
+        # Cron
+        cron = server.cron_statistics
+        samples = [({}, bool(cron.get('started')))]
+        values.append((
+            'ikaaro_cron_started', 'gauge',
+            'Whether the cron is running', samples))
+        for name in ('last_start', 'last_end', 'next_start'):
+            value = cron.get(name)
+            value = value.timestamp() if value else None
+            values.append((
+                f'ikaaro_cron_{name}_timestamp_seconds', 'gauge',
+                f'Cron {name.replace("_", " ")} (Unix time)',
+                [({}, value)]))
+
+        return values
+
+
+    def GET(self, root, context):
+        server = context.server
+        values = self.get_values(server, context.database)
+        context.set_content_type('text/plain', version='0.0.4')
+        return server.metrics.to_str(values)
+
+
+
 class ApiDevPanel_ServerStop(Api_View):
     """ Stop the web server
     """
@@ -1,4 +1,6 @@
+import asyncio
 import contextlib
+import contextvars
 import logging
 import os
 import time
@@ -6,10 +8,10 @@ import traceback
 
 # Starlette
 from starlette.middleware import Middleware
-from starlette.middleware.sessions import SessionMiddleware
 from starlette.middleware.trustedhost import TrustedHostMiddleware
 from starlette.applications import Starlette
-from starlette.responses import Response, JSONResponse
+from starlette.formparsers import MultiPartException
+from starlette.responses import HTMLResponse, Response, JSONResponse
 from starlette.routing import Route
 
 # itools/ikaaro
@@ -18,7 +20,14 @@ from itools.uri import Reference
 from itools.web.exceptions import HTTPError
 from itools.web.router import RequestMethod
 from ikaaro import constants
+from ikaaro.context import CMSContext, UploadTooLarge, is_multipart
+from ikaaro.context import iter_upload, receive_multipart
+from ikaaro.group_commit import BatchAborted
+from ikaaro.page_cache import CachedPage
+from ikaaro.profiler import RequestProfiler, get_profile_mode
+from ikaaro.responses import FileBody
 from ikaaro.server import get_server
+from ikaaro.workers import SessionMiddleware, forward_request
 
 
 #
@@ -26,6 +35,7 @@ from ikaaro.server import get_server
 #
 
 log = logging.getLogger("ikaaro.web")
+log_access = logging.getLogger("ikaaro.access")
 
 async def prepare_response(context) -> Response:
     """Convert context to ASGI response"""
@@ -40,6 +50,10 @@ async def prepare_response(context) -> Response:
         # Handle redirects or file references
         return Response(status_code=status_code, headers=headers)
 
+    if isinstance(data, FileBody):
+        # Stream files from disk
+        return data.get_response(context.request, status_code, headers)
+
     if isinstance(data, str):
         data = data.encode("utf-8")
 
@@ -48,6 +62,113 @@ async def prepare_response(context) -> Response:
 
     return Response(content=data, status_code=status_code, headers=headers)
 
+def log_request(context, response, total):
+    """Write the access log line: Common Log Format, plus the time spent in
+    every phase of the request (the handler time excludes the rendering of
+    the skin and the commit).
+    """
+    request = context.request
+    timings = context.timings
+    render = timings.get('render', 0)
+    commit = timings.get('commit', 0)
+    handler = max(timings.get('handler', 0) - render - commit, 0)
+
+    address = request.headers.get('x-forwarded-for')
+    if address:
+        address = address.split(',', 1)[0].strip()
+    elif request.client:
+        address = request.client.host
+    user = context.user.name if context.user else '-'
+    now = time.strftime('%d/%b/%Y:%H:%M:%S %z')
+    path = request.url.path
+    if request.url.query:
+        path = f'{path}?{request.url.query}'
+    size = response.headers.get('content-length', '-')
+    log_access.info(
+        f'{address or "-"} - {user} [{now}] "{request.method} {path} HTTP/1.1"'
+        f' {response.status_code} {size} {total:.6f}'
+        f' lock={timings.get("lock", 0):.6f} handler={handler:.6f}'
+        f' render={render:.6f} commit={commit:.6f}')
+
+
+def log_slow_request(context, response, total):
+    """Log the requests slower than the 'slow-request-time' threshold, with
+    the database operations they did (see CMSContext.count).
+    """
+    request = context.request
+    user = context.user.name if context.user else '-'
+    lines = [f'Slow request ({total:.3f}s): {request.method} {request.url}'
+             f' status={response.status_code} user={user}']
+    timings = context.timings
+    lines.append('  ' + ', '.join(
+        f'{name} {timings.get(name, 0):.3f}s'
+        for name in ('lock', 'handler', 'render', 'commit')))
+    for name, (count, seconds) in sorted(context.counters.items()):
+        lines.append(f'  {name}: {count} ({seconds:.3f}s)')
+    searches = sorted(context.slow_searches, reverse=True)
+    if searches:
+        lines.append('  slowest searches:')
+        for seconds, n, query in searches:
+            lines.append(f'    {seconds:.3f}s {query}')
+    log.warning('\n'.join(lines))
+
+
+def get_cached_response(page):
+    return Response(content=page.content, status_code=page.status,
+                    headers=page.headers)
+
+
+async def handle_request(context, read_only):
+    """Run the request handler, in the server's executor for read-only
+    requests (if configured), on the event loop otherwise.  In the executor
+    the request holds the database lock alone (see catch_all), so the
+    handlers run one at a time, but the event loop keeps serving meanwhile.
+    """
+    executor = context.server.request_executor
+    if not read_only or executor is None:
+        RequestMethod.handle_request(context)
+        return
+
+    # Propagate the CMS context (and other context variables) to the thread
+    loop = asyncio.get_running_loop()
+    run = contextvars.copy_context().run
+    await loop.run_in_executor(executor, run, RequestMethod.handle_request, context)
+
+
+def get_upload_error(status):
+    message = {401: '401 Unauthorized', 403: '403 Forbidden',
+               404: '404 Not Found', 413: '413 Payload Too Large'}[status]
+    return Response(message, status_code=status, media_type='text/plain')
+
+
+async def check_upload(request, server):
+    """Refuse an upload before receiving it: if it is larger than the
+    "max-upload-size" variable, or if the user is not allowed to use the
+    view.  Return the error response, or None.
+    """
+    max_size = server.max_upload_size
+    size = request.headers.get('content-length', '')
+    if max_size and size.isdigit() and int(size) > max_size:
+        return get_upload_error(413)
+
+    # The access is checked only if the resource and the view are found,
+    # otherwise it is left to the handler (e.g. the API routes)
+    context_manager = server.database.init_context(commit_at_exit=False,
+                                                   read_only=True)
+    async with context_manager as context:
+        await context.init_from_request(request, read_body=False)
+        resource = context.root.get_resource(context.path, soft=True)
+        if resource is None:
+            return None
+        view = resource.get_view(context.view_name, context.query)
+        if view is None:
+            # Not found, or not allowed (see Folder.get_view)
+            return get_upload_error(404 if context.user else 401)
+        if context.is_access_allowed(resource, view):
+            return None
+        return get_upload_error(403 if context.user else 401)
+
+
 async def catch_all(request):
     t0 = time.time()
     server = get_server()
@@ -60,13 +181,87 @@ async def catch_all(request):
     rw_path = any(s in path for s in GET_writable_paths)
     read_only = read_only_method and not rw_path
 
-    async with server.database.init_context(commit_at_exit=False, read_only=read_only) as context:
+    # Read-only worker: the writer process handles the writes, and follows
+    # the uploads it receives (see UploadStatsView)
+    upload_stats_view = path.endswith('/;upload_stats')
+    if server.writer_address and (not read_only or upload_stats_view):
+        max_size = 0
+        try:
+            if is_multipart(request):
+                response = await check_upload(request, server)
+                if response is not None:
+                    return response
+                max_size = server.max_upload_size
+            body = iter_upload(request, {}, max_size)
+            return await forward_request(request, server.writer_address, body)
+        except UploadTooLarge:
+            return get_upload_error(413)
+
+    # Receive the uploads before taking the lock (see UploadStatsView)
+    try:
+        if is_multipart(request):
+            response = await check_upload(request, server)
+            if response is not None:
+                return response
+        await receive_multipart(request, server.upload_stats,
+                                server.max_upload_size)
+    except UploadTooLarge:
+        return get_upload_error(413)
+    except MultiPartException as error:
+        log.warning(f"Malformed multipart body: {error}")
+        return Response('400 Bad Request', status_code=400,
+                        media_type='text/plain')
+
+    # Anonymous pages cache, before the lock: the cached pages are not held
+    # back by the requests running
+    page_cache = server.page_cache
+    page_key = None
+    if page_cache and read_only:
+        page_key = page_cache.get_key(request)
+        if page_key is not None:
+            page = page_cache.get(page_key)
+            if page is not None:
+                response = get_cached_response(page)
+                context = CMSContext()
+                context.request = request
+                context.server = server
+                end_request(context, response, t0)
+                return response
+            version = page_cache.version
+
+    # The database is not thread-safe: a request handled in the executor
+    # holds the lock alone (as a reader)
+    exclusive = read_only and server.request_executor is not None
+    context_manager = server.database.init_context(commit_at_exit=False,
+                                                   read_only=read_only,
+                                                   exclusive=exclusive)
+    async with context_manager as context:
+        context.add_timing('lock', context_manager.lock_wait)
+        context.count_operations = bool(server.slow_request_time)
+        context.group_commit = not read_only
         try:
             # Init context from Starlette's request
             await context.init_from_request(request)
 
+            # Profile the request (admins only)
+            profile = get_profile_mode(context)
+
+            # The languages of the site, for the keys of the pages cache
+            if page_cache and read_only and not profile:
+                languages = context.root.get_value('website_languages')
+                page_cache.languages = languages
+                if page_key is None:
+                    page_key = page_cache.get_key(request)
+                    version = page_cache.version
+
             # Handle the request
-            RequestMethod.handle_request(context)
+            t1 = time.time()
+            if profile:
+                profiler = RequestProfiler(context)
+                profiler.run(RequestMethod.handle_request, context)
+            else:
+                await handle_request(context, read_only)
+            context.add_timing('handler', time.time() - t1)
 
             # Compute request time
             context.request_time = time.time() - t0
@@ -75,22 +270,80 @@ async def catch_all(request):
             context.on_request_end()
 
             # Prepare response
-            return await prepare_response(context)
+            response = await prepare_response(context)
+            if page_key is not None and not profile:
+                headers = dict(response.headers)
+                if page_cache.is_cacheable(context, headers):
+                    path = str(context.resource.abspath)
+                    page = CachedPage(path, response.status_code, headers,
+                                      response.body)
+                    page_cache.put(page_key, page, version)
+
+            # The profile, as a report or in a file
+            if profile == 'html':
+                response = HTMLResponse(profiler.get_report())
+            elif profile:
+                name = profiler.save(server.target)
+                response.headers['x-ikaaro-profile'] = name
 
         except HTTPError as e:
             RequestMethod.handle_client_error(e, context)
-            return await prepare_response(context)
+            response = await prepare_response(context)
         except Exception:
             tb = traceback.format_exc()
             log.error(f"Internal error: {tb}", exc_info=True)
             context.set_default_response(500)
-            return await prepare_response(context)
+            response = await prepare_response(context)
+
+    # Group commit: the response is sent once the changes are saved
+    if context.commit_future is not None:
+        t1 = time.time()
+        try:
+            await context.commit_future
+        except BatchAborted:
+            # Not saved, because of another request
+            log.warning(f"Commit aborted: {method} {path}")
+            response = Response('503 Service Unavailable', status_code=503,
+                                headers={'Retry-After': '1'},
+                                media_type='text/plain')
+        except Exception:
+            log.error(f"Commit failed: {method} {path}", exc_info=True)
+            response = Response('500 Internal Server Error', status_code=500,
+                                media_type='text/plain')
+        # Counted in the handler time, as the commit usually is
+        wait = time.time() - t1
+        context.add_timing('handler', wait)
+        context.add_timing('commit', wait)
+
+    end_request(context, response, t0)
+    return response
+
+
+def end_request(context, response, t0):
+    """Log the request, and record it in the metrics.
+    """
+    server = context.server
+    total = time.time() - t0
+    log_request(context, response, total)
+    if server.slow_request_time and total * 1000 >= server.slow_request_time:
+        log_slow_request(context, response, total)
+    server.metrics.observe_request(context, response.status_code, total)
 
 
 #
 # Starlette routes
 #
 
+async def static(request):
+    """Serve the skins files, without database context (see ikaaro.static).
+    """
+    server = get_server()
+    response = server.static_files.get_response(request)
+    if response is None:
+        return await catch_all(request)
+    return response
+
+
 async def ctrl(request):
     server = get_server()
     async with server.database.init_context() as context:
@@ -130,6 +383,7 @@ middleware = [
 
 routes = [
     Route('/;_ctrl', ctrl),
+    Route('/ui/{path:path}', static, methods=['GET']),
     Route("/{path:path}", catch_all, methods=['GET', 'POST']),  # XXX PUT, PATCH?
 ]
 
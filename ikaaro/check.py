@@ -0,0 +1,269 @@
+"""Check the catalog against the database (see the script icms-check.py and
+the view ApiDevPanel_CatalogCheck).
+
+The metadata files are read from the filesystem (only their header, see
+ikaaro.walk) and compared with the documents of the catalog, looked up by
+batches:
+
+- missing: the resource has no document in the catalog;
+- stale: the format or the class version of the document is not the one
+  of the metadata;
+- orphan: the document has no resource.
+
+The problems are reported as (abspath, detail), detail is None but for the
+stale documents.
+
+With 'repair' the missing and stale resources are reindexed, and the orphan
+documents removed, by a commit of the database.
+
+While the server runs, OnlineCheck checks and repairs the catalog in the
+background.
+"""
+
+from logging import getLogger
+from os.path import isfile
+from time import time
+import asyncio
+import contextvars
+
+# Import from itools
+from itools.database import AllQuery, OrQuery, PhraseQuery
+from itools.web import get_context
+
+# Import from ikaaro
+from .update import class_version_to_date
+from .walk import walk_metadata
+
+
+log = getLogger("ikaaro")
+
+
+class CatalogCheck:
+
+    # Number of documents per catalog lookup
+    batch_size = 1000
+    # Number of problems reported, by kind
+    limit = 1000
+
+    def __init__(self, database):
+        self.database = database
+        self.database_path = f'{database.path}/database'
+        self.resources = 0
+        self.documents = 0
+        self.problems = {'missing': [], 'stale': [], 'orphan': []}
+        self.counts = {'missing': 0, 'stale': 0, 'orphan': 0}
+
+
+    def add(self, kind, abspath, detail=None):
+        self.counts[kind] += 1
+        problems = self.problems[kind]
+        if len(problems) < self.limit:
+            problems.append((abspath, detail))
+
+
+    def check_batch(self, batch):
+        """Compare a batch of resources, [(abspath, class_id, version)], with
+        their documents.
+        """
+        query = OrQuery(*[ PhraseQuery('abspath', x[0]) for x in batch ])
+        documents = {
+            x.abspath: x
+            for x in self.database.search(query).get_documents() }
+
+        for abspath, class_id, version in batch:
+            document = documents.get(abspath)
+            if document is None:
+                self.add('missing', abspath)
+            elif document.format != class_id:
+                self.add('stale', abspath, f'format {document.format} != {class_id}')
+            elif version and document.class_version != class_version_to_date(version):
+                self.add('stale', abspath,
+                         f'class_version {document.class_version} != {version}')
+
+
+    def get_metadata_path(self, abspath):
+        if abspath == '/':
+            return f'{self.database_path}/.metadata'
+        return f'{self.database_path}{abspath}.metadata'
+
+
+    def iter_check(self):
+        """Check the resources, then the documents, by batches: yield after
+        every batch (see OnlineCheck).
+        """
+        batch = []
+        for abspath, path, class_id, version in walk_metadata(self.database_path):
+            self.resources += 1
+            batch.append((abspath, class_id, version))
+            if len(batch) == self.batch_size:
+                self.check_batch(batch)
+                batch = []
+                yield
+        if batch:
+            self.check_batch(batch)
+            yield
+
+        # The documents, searched again by every batch: the catalog may
+        # have been committed meanwhile
+        database = self.database
+        start = 0
+        while True:
+            search = database.search(AllQuery())
+            documents = search.get_documents(start=start, size=self.batch_size)
+            if not documents:
+                break
+            for document in documents:
+                self.documents += 1
+                abspath = document.abspath
+                if not isfile(self.get_metadata_path(abspath)):
+                    self.add('orphan', abspath)
+            start += self.batch_size
+            yield
+
+
+    def run(self):
+        log.info('Check the catalog')
+        for x in self.iter_check():
+            pass
+        return self.get_report()
+
+
+    def get_report(self):
+        return {
+            'resources': self.resources,
+            'documents': self.documents,
+            'counts': self.counts,
+            'problems': self.problems,
+            'ok': not any(self.counts.values())}
+
+
+    def repair(self):
+        """Reindex the missing and stale resources, remove the orphan
+        documents.  This is done by a commit of the database, as any change,
+        so the catalog being rebuilt and the index of the dependencies (see
+        Database._before_commit) are kept up to date.
+
+        Must be called within a context, and the lists must be complete (see
+        limit).  Return the number of documents changed.
+        """
+        counts = self.counts
+        problems = self.problems
+        if any(counts[x] > len(problems[x]) for x in counts):
+            raise ValueError('too many problems, reindex the catalog')
+        context = get_context()
+        reindex = getattr(context.server, 'catalog_reindex', None)
+        if reindex is not None and reindex.running:
+            raise ValueError('the catalog is being rebuilt, try again later')
+
+        database = self.database
+        root = database.get_resource('/')
+        n = 0
+        for abspath, detail in problems['missing'] + problems['stale']:
+            resource = root.get_resource(abspath, soft=True)
+            if resource is None:
+                # Bad metadata, the resource cannot be loaded
+                log.error(f'Cannot load {abspath}')
+                continue
+            resource.reindex()
+            n += 1
+        # No resource, the commit unindexes them as removed
+        for abspath, detail in problems['orphan']:
+            if isfile(self.get_metadata_path(abspath)):
+                # Added since the check
+                continue
+            database.resources_old2new[abspath] = None
+            n += 1
+
+        if n:
+            # Only the catalog changes: the mtime is kept, and the database
+            # is not marked as changed by a reindex
+            context.set_mtime = False
+            context.git_message = 'Repair the catalog'
+            database.has_changed = True
+            database.save_changes()
+        log.info(f'Repaired {n} documents')
+        return n
+
+
+
+class OnlineCheck:
+    """Check and repair the catalog while the server runs.  The resources
+    and the documents are checked by batches (see CatalogCheck.iter_check),
+    between the batches the lock is released so the requests go on.  Then
+    the catalog is repaired, with the write lock.
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.check = CatalogCheck(server.database)
+        self.task = None
+        # Status
+        self.state = 'waiting'
+        self.total = 0
+        self.repaired = None
+        self.started = self.ended = None
+        self.error = None
+
+
+    @property
+    def running(self):
+        return self.state in ('waiting', 'checking', 'repairing')
+
+
+    def start(self):
+        # Out of the context of the request
+        self.task = contextvars.Context().run(asyncio.create_task, self.run())
+
+
+    def get_status(self):
+        check = self.check
+        # There are about as many documents as resources
+        done = check.resources + check.documents
+        percent = int(done * 50 / self.total) if self.total else 0
+        return {
+            'state': self.state,
+            'resources': check.resources,
+            'documents': check.documents,
+            'total': self.total,
+            'percent': min(percent, 100),
+            'report': check.get_report() if self.state == 'done' else None,
+            'repaired': self.repaired,
+            'started': self.started,
+            'ended': self.ended,
+            'error': self.error}
+
+
+    async def run(self):
+        database = self.server.database
+        self.state = 'checking'
+        self.started = time()
+        self.total = database.get_nb_metadatas()
+        log.info('Check the catalog (online)')
+        try:
+            batches = self.check.iter_check()
+            while await self.check_batch(batches):
+                # Let the requests go
+                await asyncio.sleep(0)
+
+            # Repair
+            self.state = 'repairing'
+            async with database.init_context(commit_at_exit=False):
+                self.repaired = self.check.repair()
+        except Exception as error:
+            log.error('Online check failed', exc_info=True)
+            self.state = 'failed'
+            self.error = str(error)
+        else:
+            self.state = 'done'
+        finally:
+            self.ended = time()
+
+
+    async def check_batch(self, batches):
+        """Check the next batch.  Return False at the end.
+        """
+        database = self.server.database
+        context_manager = database.init_context(read_only=True,
+                                                commit_at_exit=False)
+        async with context_manager:
+            return next(batches, False) is None
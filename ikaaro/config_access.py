@@ -13,6 +13,10 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+# Import from the Standard Library
+from copy import deepcopy
+from time import monotonic
+
 # Import from itools
 from itools.core import freeze, is_prototype, proto_property, merge_dicts
 from itools.database import AllQuery, AndQuery, OrQuery, PhraseQuery
@@ -330,13 +334,20 @@ class ConfigAccess(Folder):
         return user_groups, '/config/groups/admins' in user_groups
 
 
-    def get_search_query(self, user, permission, class_id=None):
-        # Special case: admins can see everything
-        user_groups, is_admin = self._get_user_groups(user)
-        if is_admin:
-            return AllQuery()
+    def get_rules_query(self, user_groups, permission, class_id=None):
+        """Return the query built from the access rules that apply to the
+        given groups.  It is kept in the database (see access_queries) until
+        a resource in /config/access or /config/groups changes; the caller
+        gets a copy, it may change it.
+        """
+        if permission != 'add':
+            class_id = None
+        key = (frozenset(user_groups), permission, class_id)
+        database = self.database
+        rules_query = database.access_queries.get(key)
+        if rules_query is not None:
+            return deepcopy(rules_query)
 
-        # 1. Back-office access rules
         rules_query = OrQuery()
         for rule in self.get_resources():
             if rule.get_value('permission') != permission:
@@ -352,6 +363,21 @@ class ConfigAccess(Folder):
 
             rules_query.append(rule.get_search_query())
 
+        # Do not keep a query built from changes not yet committed
+        if not getattr(database, 'has_changed', False):
+            database.access_queries[key] = deepcopy(rules_query)
+        return rules_query
+
+
+    def get_search_query(self, user, permission, class_id=None):
+        # Special case: admins can see everything
+        user_groups, is_admin = self._get_user_groups(user)
+        if is_admin:
+            return AllQuery()
+
+        # 1. Back-office access rules
+        rules_query = self.get_rules_query(user_groups, permission, class_id)
+
         # Case: anonymous
         if not user:
             return AndQuery(rules_query, PhraseQuery('share', 'everybody'))
@@ -368,15 +394,50 @@ class ConfigAccess(Folder):
         return query
 
 
+    def get_acl_key(self, context, user, permission, class_id):
+        """The ACL checks are cached in the context (see CMSContext.acl_cache)
+        until the end of the request or the next commit.
+        """
+        user = str(user.abspath) if user else None
+        generation = getattr(context.database, 'generation', 0)
+        return generation, user, permission, class_id
+
+
     def has_permission(self, user, permission, resource, class_id=None):
-        # The query
-        query = AndQuery(
-            self.get_search_query(user, permission, class_id),
-            PhraseQuery('abspath', str(resource.abspath)))
+        path = str(resource.abspath)
+        return self.has_permission_many(user, permission, [path],
+                                        class_id)[path]
+
+
+    def has_permission_many(self, user, permission, paths, class_id=None):
+        """Return a dict {path: bool} telling whether the user has the given
+        permission on the resources at the given paths.  The paths not yet
+        in the cache are checked with a single search.
+        """
+        context = get_context()
+        cache = context.acl_cache
+        key = self.get_acl_key(context, user, permission, class_id)
+        cached = cache.get(key)
+        if cached is None:
+            query = self.get_search_query(user, permission, class_id)
+            cached = cache[key] = {'query': query, 'paths': {}}
+        cached_paths = cached['paths']
 
         # Search
-        results = get_context().search(query, user=user)
-        return len(results) > 0
+        paths = [ str(x) for x in paths ]
+        to_check = [ x for x in set(paths) if x not in cached_paths ]
+        if to_check:
+            t0 = monotonic()
+            query = OrQuery(*[ PhraseQuery('abspath', x) for x in to_check ])
+            query = AndQuery(cached['query'], query)
+            results = context.search(query, user=user)
+            allowed = { x.abspath for x in results.get_documents() }
+            for path in to_check:
+                cached_paths[path] = path in allowed
+            if context.count_operations:
+                context.count('acl checks', monotonic() - t0)
+
+        return { x: cached_paths[x] for x in paths }
 
 
     def get_document_types(self):
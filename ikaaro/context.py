@@ -14,6 +14,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import datetime
+from heapq import heappush, heappushpop
 import json
 from logging import getLogger
 import urllib.parse
@@ -24,6 +25,7 @@ from jwcrypto.jws import InvalidJWSSignature, InvalidJWSObject
 from jwcrypto.jwt import JWT, JWTExpired
 from pytz import timezone
 from starlette.datastructures import UploadFile
+from starlette.formparsers import MultiPartParser
 
 # Import from itools
 from itools.core import freeze, proto_lazy_property
@@ -54,12 +56,63 @@ from .utils import dict_of_bytes_to_string
 log = getLogger("ikaaro.web")
 
 
+class UploadTooLarge(Exception):
+    pass
+
+
+async def iter_upload(request, upload_stats, max_size=0):
+    """Yield the chunks of the request body, and update the upload
+    statistics (see UploadStatsView) as they arrive.  Raise UploadTooLarge
+    if the body is larger than 'max_size' (if not 0).
+    """
+    upload_id = request.query_params.get('upload_id')
+    try:
+        upload_id = int(upload_id) if upload_id else None
+    except ValueError:
+        upload_id = None
+    total_size = int(request.headers.get('content-length') or 0)
+    uploaded_size = 0
+    try:
+        async for chunk in request.stream():
+            uploaded_size += len(chunk)
+            if max_size and uploaded_size > max_size:
+                raise UploadTooLarge
+            if upload_id is not None:
+                upload_stats[upload_id] = (uploaded_size, total_size)
+            yield chunk
+    finally:
+        if upload_id is not None:
+            upload_stats.pop(upload_id, None)
+
+
+def is_multipart(request):
+    content_type = request.headers.get('content-type', '')
+    return content_type.startswith('multipart/')
+
+
+async def receive_multipart(request, upload_stats, max_size=0):
+    """Parse a multipart body as it arrives, the files are spooled to
+    temporary files while they are received.  The form is kept in the
+    request state, for CMSContext.get_multipart_body_v3 (which reads the
+    files, the itools handlers are built from bytes).
+
+    This is called before the database lock is acquired, so the progress
+    of the upload can be followed by other requests.
+    """
+    if not is_multipart(request):
+        return
+    stream = iter_upload(request, upload_stats, max_size)
+    parser = MultiPartParser(request.headers, stream)
+    request.state.multipart_form = await parser.parse()
+
+
 class CMSContext(prototype):
 
     request = None  # Starlette's Request object
     accept_language = AcceptLanguageType.decode('')
     body = {}
     commit = True
+    commit_future = None # Set when the changes are saved by a group commit
     content_type = None
     session = None
     cookies = {}
@@ -67,6 +120,7 @@ class CMSContext(prototype):
     entity = None
     form = {}
     form_error = None
+    group_commit = False
     header_response = []
     is_cron = False
     message = None
@@ -86,7 +140,7 @@ class CMSContext(prototype):
     user = None
     view = None
 
-    async def init_from_request(self, request):
+    async def init_from_request(self, request, read_body=True):
         self.request = request
 
         # Set context variables
@@ -104,7 +158,8 @@ class CMSContext(prototype):
         # The request method
         self.method = request.method
         # Get body
-        self.body = await self.get_body_from_request()
+        if read_body:
+            self.body = await self.get_body_from_request()
         # The query
         self.query = request.query_params
 
@@ -147,6 +202,7 @@ class CMSContext(prototype):
         self.authenticate()
         # Search
         self._context_user_search = self._user_search(self.user)
+        self.acl_cache = {}
         self.site_root.before_traverse(self)  # Hook
         # Not a cron
         self.is_cron = False
@@ -468,6 +524,11 @@ class CMSContext(prototype):
 
 
     async def get_body_from_request(self):
+        # Multipart bodies are parsed as a stream, never read in memory
+        content_type = self.request.headers.get('content-type', '')
+        if content_type.startswith('multipart/'):
+            return await self.get_multipart_body_v3(None)
+
         body = await self.request.body()
         if not body:
             return {}
@@ -478,8 +539,6 @@ class CMSContext(prototype):
             return self.get_form_body(body)
         elif content_type.startswith('application/json'):
             return self.get_json_body(body)
-        elif content_type.startswith('multipart/'):
-            return await self.get_multipart_body_v3(body)
         elif content_type.startswith('application/'):
             return {'body': body}
 
@@ -525,14 +584,30 @@ class CMSContext(prototype):
         return form
 
     async def get_multipart_body_v3(self, body):
-        form_data = await self.request.form()  # starlette.datastructures.FormData
+        request = self.request
+        # starlette.datastructures.FormData
+        form_data = getattr(request.state, 'multipart_form', None)
+        if form_data is None:
+            server = self.server
+            await receive_multipart(request, server.upload_stats,
+                                    server.max_upload_size)
+            form_data = request.state.multipart_form
+
+        # The files are read from the spool, into memory, as the forms and
+        # the handlers expect bytes; then the spool is closed
         form = {}
-        for key, value in form_data.items():
-            if type(value) is UploadFile:
-                data = await value.read()
-                form[key] = (value.filename, value.headers['content-type'], data)
-            else:
-                form[key] = value
+        try:
+            for key, value in form_data.items():
+                if type(value) is UploadFile:
+                    await value.seek(0)
+                    data = await value.read()
+                    mimetype = value.headers.get('content-type', 'text/plain')
+                    form[key] = (value.filename, mimetype, data)
+                else:
+                    form[key] = value
+        finally:
+            await form_data.close()
+            request.state.multipart_form = None
 
         return form
 
@@ -629,18 +704,78 @@ class CMSContext(prototype):
         return self._user_search(self.user)
 
 
+    @proto_lazy_property
+    def timings(self):
+        # Seconds spent in every phase of the request (see ikaaro.asgi)
+        return {}
+
+
+    def add_timing(self, name, seconds):
+        timings = self.timings
+        timings[name] = timings.get(name, 0) + seconds
+
+
+    #######################################################################
+    # Operations of the request, for the slow-request log (see ikaaro.asgi)
+    #######################################################################
+    count_operations = False
+    # Number of slowest searches kept
+    slow_searches_size = 10
+
+    @proto_lazy_property
+    def counters(self):
+        # {name: [count, seconds]}
+        return {}
+
+
+    @proto_lazy_property
+    def slow_searches(self):
+        # Heap of (seconds, number, query)
+        return []
+
+
+    def count(self, name, seconds=0):
+        counter = self.counters.get(name)
+        if counter is None:
+            counter = self.counters[name] = [0, 0.0]
+        counter[0] += 1
+        counter[1] += seconds
+
+
+    def add_search(self, query, seconds):
+        self.count('searches', seconds)
+        item = (seconds, self.counters['searches'][0], query)
+        if len(self.slow_searches) < self.slow_searches_size:
+            heappush(self.slow_searches, item)
+        else:
+            heappushpop(self.slow_searches, item)
+
+
+    @proto_lazy_property
+    def acl_cache(self):
+        # {(generation, user, permission, class_id): {'query': .., 'paths': ..}}
+        return {}
+
+
     def search(self, query=None, user=None, **kw):
         if self.is_cron:
             # If the search is done by a CRON we don't
             # care about the default ACLs rules
             return self.database.search(query)
 
-        if user is None:
+        if user is None or user is self.user:
             _user_search = self._context_user_search
         else:
             _user_search = self._user_search(user)
 
-        return _user_search.search(query, **kw)
+        self.database.search_count += 1
+        if not self.count_operations:
+            return _user_search.search(query, **kw)
+
+        t0 = time.monotonic()
+        results = _user_search.search(query, **kw)
+        self.add_search(query, time.monotonic() - t0)
+        return results
 
     #######################################################################
     # Login API
@@ -653,6 +788,8 @@ class CMSContext(prototype):
         session = self.session
         session["user"] = user.name
         session["user_uuid"] = user.get_value("uuid")
+        # The search of the context user (see search)
+        self._context_user_search = self._user_search(user)
 
 
     def get_JWT_default_claims(self):
@@ -676,17 +813,42 @@ class CMSContext(prototype):
         if not token_string:
             return None
         token_string = token_string.strip()
-        key = self.server.JWK_SECRET
-        try:
-            jwt = JWT(jwt=token_string, key=key, algs=["RS512"])
-        except (InvalidJWSSignature, InvalidJWSObject):
-            # Manage error msg
+        # Try the current key first, then the keys of former algorithms
+        bad_signature = False
+        for algorithm, key in self.server.get_JWT_keys():
+            try:
+                return JWT(jwt=token_string, key=key, algs=[algorithm])
+            except (InvalidJWSSignature, InvalidJWSObject):
+                bad_signature = True
+            except JWTExpired:
+                raise JWTExpiredException
+            except ValueError:
+                # Not signed with the algorithm of this key
+                continue
+        # Manage error msg
+        if bad_signature:
             raise InvalidJWTSignatureException
-        except JWTExpired:
-            raise JWTExpiredException
-        except ValueError:
-            return
-        return jwt
+        return None
+
+
+    def get_JWT_claims(self, token_string):
+        """Return the claims of the given token.  The signature is verified
+        once, then the claims are kept in the server's cache until the token
+        expires (see ikaaro.tokens).
+        """
+        if not token_string:
+            return None
+        token_string = token_string.strip()
+        server = self.server
+        keys = server.get_JWT_key_ids()
+        claims = server.JWT_tokens.get(token_string, keys)
+        if claims is None:
+            jwt = self.get_auth_JWT(token_string)
+            if jwt is None:
+                return None
+            claims = json.loads(jwt.token.objects['payload'])
+            server.JWT_tokens.put(token_string, keys, claims)
+        return claims
 
 
     def generate_JWT(self, user):
@@ -694,7 +856,7 @@ class CMSContext(prototype):
         user_claims = self.get_JWT_user_claims(user)
         default_claims = self.get_JWT_default_claims()
         jwt = JWT(
-            header={"alg": "RS512"},
+            header={"alg": self.server.JWT_algorithm},
             claims=user_claims,
             default_claims=default_claims
         )
@@ -705,6 +867,7 @@ class CMSContext(prototype):
     def logout(self):
         self.user = None
         self.session.clear()
+        self._context_user_search = self._user_search(None)
 
 
     def authenticate(self):
@@ -734,9 +897,8 @@ class CMSContext(prototype):
 
     def decode_bearer(self, bearer):
         # Try to decode bearer token we may have a JWT
-        jwt = self.get_auth_JWT(bearer)
-        if jwt:
-            jwt_payload = json.loads(jwt.token.objects['payload'])
+        jwt_payload = self.get_JWT_claims(bearer)
+        if jwt_payload:
             user = jwt_payload.get('id')
             return user
 
@@ -13,27 +13,426 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from collections import OrderedDict, deque
+from logging import DEBUG, getLogger
+from os import stat
+from os.path import isabs, isfile
+from time import monotonic
 import asyncio
 import copy
 
 # Import from itools
+from itools.core import lazy
 from itools.database import RWDatabase, RODatabase as BaseRODatabase
-from itools.database import OrQuery, PhraseQuery, AndQuery
+from itools.database import PhraseQuery, AndQuery
+from itools.database import get_register_fields
+from itools.database.backends.catalog import Catalog
+from itools.fs import lfs
 from itools.uri import Path
 from itools.web import get_context, set_context, reset_context
 
+# Import from ikaaro
+from .group_commit import BatchAborted
+from .metrics import Histogram
+from .workers import write_generation
 
-rw_lock = asyncio.Lock()
-ro_lock = asyncio.Lock()
-active_ro = 0
 
+log = getLogger("ikaaro")
+
+
+def get_catalog_id(path):
+    """Return the inode of the catalog of the database at the given path,
+    it changes when the catalog is replaced (see Database.swap_catalog).
+    """
+    try:
+        return stat(f'{path}/catalog').st_ino
+    except OSError:
+        return None
+
+
+def is_access_path(path):
+    """Whether a change at the given path may change the access rules (see
+    ConfigAccess.get_rules_query).
+    """
+    path = str(path)
+    for folder in ('/config/access', '/config/groups'):
+        if path == folder or path.startswith(folder + '/'):
+            return True
+    return False
+
+
+
+class RWLock:
+    """Readers/writer lock for asyncio tasks.
+
+    The lock is fair: waiters are served in arrival order, and once a writer
+    is queued the readers that come after it wait for it (so a steady stream
+    of readers cannot starve the writers).  Consecutive readers at the head
+    of the queue are granted the lock together.  An exclusive reader holds
+    the lock alone, but as a reader: it waits for the changes of a group
+    commit to be saved (see 'batch').
+
+    Some statistics are kept, by mode ('read' or 'write'): number of
+    acquisitions, current queue depth, total and maximum wait and hold
+    times (in seconds), and the histograms of the wait times.
+    """
+
+    def __init__(self):
+        self.readers = 0         # Number of active readers
+        self.writer = False      # Whether a writer holds the lock
+        self.exclusive = False   # Whether an exclusive reader holds it
+        self.waiters = deque()   # Queue of (read_only, exclusive, future)
+        self.batch = False       # Changes not yet saved (see GroupCommit)
+        self.stats = {
+            mode: {'acquired': 0, 'waiting': 0,
+                   'wait_time': 0.0, 'wait_max': 0.0,
+                   'hold_time': 0.0, 'hold_max': 0.0}
+            for mode in ('read', 'write')}
+        self.wait_histograms = {'read': Histogram(), 'write': Histogram()}
+
+
+    def _can_grant(self, read_only, exclusive=False):
+        if self.writer or self.exclusive:
+            return False
+        if read_only and self.batch:
+            return False
+        if read_only and not exclusive:
+            return True
+        return self.readers == 0
+
+
+    def _grant(self, read_only, exclusive=False):
+        if read_only:
+            self.readers += 1
+            self.exclusive = exclusive
+        else:
+            self.writer = True
+
+
+    def _wake_up(self):
+        # Grant the lock to the waiters at the head of the queue, in order
+        waiters = self.waiters
+        while waiters:
+            read_only, exclusive, future = waiters[0]
+            if future.done():
+                # Cancelled
+                waiters.popleft()
+                continue
+            if not self._can_grant(read_only, exclusive):
+                break
+            waiters.popleft()
+            self._grant(read_only, exclusive)
+            future.set_result(True)
+            if exclusive or not read_only:
+                break
+
+
+    async def acquire(self, read_only, first=False, exclusive=False):
+        """Wait for the lock, and return the time spent waiting.  With
+        'first' the caller goes to the head of the queue.  With 'exclusive'
+        a reader holds the lock alone.
+        """
+        mode = 'read' if read_only else 'write'
+        stats = self.stats[mode]
+        t0 = monotonic()
+        # Fast path, only if nobody is waiting (fairness)
+        if not self.waiters and self._can_grant(read_only, exclusive):
+            self._grant(read_only, exclusive)
+        else:
+            waiter = (read_only, exclusive,
+                      asyncio.get_running_loop().create_future())
+            future = waiter[2]
+            if first:
+                self.waiters.appendleft(waiter)
+            else:
+                self.waiters.append(waiter)
+            # It may be granted already: e.g. a writer going first, in
+            # front of the readers held back by the batch
+            self._wake_up()
+            stats['waiting'] += 1
+            try:
+                await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    # The lock was granted just before the cancellation
+                    self._release(read_only)
+                else:
+                    self.waiters.remove(waiter)
+                    self._wake_up()
+                raise
+            finally:
+                stats['waiting'] -= 1
+
+        # Statistics
+        wait = monotonic() - t0
+        stats['acquired'] += 1
+        stats['wait_time'] += wait
+        stats['wait_max'] = max(stats['wait_max'], wait)
+        self.wait_histograms[mode].observe(wait)
+        return wait
+
+
+    def _release(self, read_only):
+        if read_only:
+            if self.readers <= 0:
+                raise RuntimeError('read lock released too many times')
+            self.readers -= 1
+            self.exclusive = False
+        else:
+            if not self.writer:
+                raise RuntimeError('write lock is not held')
+            self.writer = False
+        self._wake_up()
+
+
+    def release(self, read_only, acquired_at=None):
+        """Release the lock, 'acquired_at' is the monotonic time when the
+        lock was granted (used for the statistics).
+        """
+        self._release(read_only)
+        if acquired_at is not None:
+            stats = self.stats['read' if read_only else 'write']
+            hold = monotonic() - acquired_at
+            stats['hold_time'] += hold
+            stats['hold_max'] = max(stats['hold_max'], hold)
+
+
+    def get_stats(self):
+        stats = {mode: dict(value) for mode, value in self.stats.items()}
+        stats['readers'] = self.readers
+        stats['writer'] = self.writer
+        return stats
+
+
+
+class ReindexDependencies:
+    """In-memory reverse index of the 'onchange_reindex' field: for a path,
+    the paths of the resources that must be reindexed when it changes.
+
+    The dependents of a path are searched in the catalog the first time
+    they are needed, then they are kept up to date at every commit with the
+    values indexed (see Database._before_commit).  Only the 'size' paths
+    used last are kept, the others are searched again when needed.
+
+    The writers that change the catalog out of a commit do not go through
+    this index:
+
+    - the text queue (see ikaaro.text_queue) only adds the text, the
+      'onchange_reindex' values it writes are those of the last commit;
+    - the reindex of a subtree (see ikaaro.reindex.reindex_subset) and the
+      upgrade run offline, the index of the next server starts empty.
+
+    The repair of the catalog (see ikaaro.check) is done by a commit.
+    """
+
+    def __init__(self, size=10000):
+        self.size = size
+        self.dependents = OrderedDict()  # {target: set(dependents)}
+        self.targets = {}                # {dependent: set(targets known)}
+
+
+    def clear(self):
+        self.dependents.clear()
+        self.targets.clear()
+
+
+    def search(self, database, path):
+        search = database.search(PhraseQuery('onchange_reindex', path))
+        return { x.abspath for x in search.get_documents() }
+
+
+    def get_dependents(self, database, paths):
+        """Return the set of the resources that depend on the given paths.
+        """
+        dependents = self.dependents
+        result = set()
+        for path in paths:
+            path = str(path)
+            paths_found = dependents.get(path)
+            if paths_found is None:
+                # Not known yet, ask the catalog
+                paths_found = self.search(database, path)
+                dependents[path] = paths_found
+                for dependent in paths_found:
+                    self.targets.setdefault(dependent, set()).add(path)
+                self.evict()
+            else:
+                dependents.move_to_end(path)
+            result |= paths_found
+        return result
+
+
+    def evict(self):
+        """Forget the paths used least recently, beyond the size.
+        """
+        dependents = self.dependents
+        targets = self.targets
+        while len(dependents) > self.size:
+            target, paths = dependents.popitem(last=False)
+            for dependent in paths:
+                known = targets.get(dependent)
+                if known is not None:
+                    known.discard(target)
+                    if not known:
+                        del targets[dependent]
+
+
+    def remove(self, dependent):
+        for target in self.targets.pop(dependent, ()):
+            self.dependents[target].discard(dependent)
+
+
+    def update(self, dependent, targets):
+        """Update the index with the values indexed for a resource.
+        """
+        self.remove(dependent)
+        known = set()
+        for target in targets or ():
+            target = str(target)
+            paths = self.dependents.get(target)
+            if paths is not None:
+                paths.add(dependent)
+                known.add(target)
+        if known:
+            self.targets[dependent] = known
+
+
+
+class CommitStats:
+    """Time spent in every phase of the commit (see Database._before_commit),
+    and number of resources processed.  The figures of the last commit are
+    kept in 'last', {phase: (seconds, count)}, the totals since the start in
+    'totals', {phase: [seconds, count]}.
+    """
+
+    phases = ('update_resource', 'move_links', 'reindex_dependencies',
+              'invalidate', 'unindex', 'mtime', 'catalog_values', 'git_author',
+              'write')
+
+    def __init__(self):
+        self.commits = 0
+        self.last = {}
+        self.totals = { x: [0.0, 0] for x in self.phases }
+        self.t0 = self.t = None
+
+
+    def start(self):
+        self.last = {}
+        self.t0 = self.t = monotonic()
+
+
+    def phase(self, name, count):
+        """End the given phase, started when the previous one ended.
+        """
+        t = monotonic()
+        self.last[name] = (t - self.t, count)
+        self.t = t
+
+
+    def end(self):
+        self.commits += 1
+        for name, (seconds, count) in self.last.items():
+            total = self.totals[name]
+            total[0] += seconds
+            total[1] += count
+
+        if log.isEnabledFor(DEBUG):
+            phases = ' '.join(
+                f'{name}={seconds:.6f}s/{count}'
+                for name, (seconds, count) in self.last.items())
+            log.debug(f'Commit {self.t - self.t0:.6f}s: {phases}')
+
+
+
+class DatabaseStats:
+    """Count the catalog searches (see ikaaro.metrics), and the operations
+    of the current request when the context asks for it (see the
+    slow-request log in ikaaro.asgi).
+    """
+
+    # Number of catalog searches
+    search_count = 0
+
+    def search(self, query=None, **kw):
+        self.search_count += 1
+        context = get_context()
+        if context is None or not context.count_operations:
+            return super().search(query, **kw)
+
+        t0 = monotonic()
+        results = super().search(query, **kw)
+        context.add_search(query, monotonic() - t0)
+        return results
+
+
+    def get_resource(self, abspath, *args, **kw):
+        context = get_context()
+        if context is None or not context.count_operations:
+            return super().get_resource(abspath, *args, **kw)
+
+        t0 = monotonic()
+        resource = super().get_resource(abspath, *args, **kw)
+        context.count('get_resource', monotonic() - t0)
+        return resource
+
+
+    def get_handler(self, key, *args, **kw):
+        context = get_context()
+        if (context is None or not context.count_operations
+                or key in self.cache):
+            return super().get_handler(key, *args, **kw)
+
+        # Not in the cache, the handler is loaded
+        t0 = monotonic()
+        handler = super().get_handler(key, *args, **kw)
+        name = 'metadata loads' if key.endswith('.metadata') else 'handler loads'
+        context.count(name, monotonic() - t0)
+        return handler
+
+
+
+class RODatabase(DatabaseStats, BaseRODatabase):
+
+    def __init__(self, *args, **kw):
+        super().__init__(*args, **kw)
+        # The catalog opened, to know when it is replaced (see drop_cache)
+        self.catalog_id = get_catalog_id(self.path)
+
+
+    @lazy
+    def lock(self):
+        return RWLock()
+
+
+    @lazy
+    def access_queries(self):
+        # The queries built from the access rules (see ConfigAccess)
+        return {}
+
+
+    def drop_cache(self):
+        """Forget the loaded handlers and reopen the catalog, used when the
+        database has been changed by another process.  If the catalog was
+        replaced (see Database.swap_catalog) the new one is opened.
+        """
+        self.cache.clear()
+        self.access_queries.clear()
+        backend = self.backend
+        catalog_id = get_catalog_id(self.path)
+        if catalog_id == self.catalog_id:
+            backend.catalog._db.reopen()
+            return
+
+        backend.catalog.close()
+        backend.catalog = Catalog(f'{self.path}/catalog', get_register_fields(),
+                                  read_only=True)
+        self.catalog_id = catalog_id
 
-class RODatabase(BaseRODatabase):
 
     def init_context(self, user=None, username=None, email=None, commit_at_exit=True,
-                     read_only=True):
+                     read_only=True, exclusive=False):
 
-        return ContextManager(self, read_only=read_only)
+        return ContextManager(self, read_only=read_only, exclusive=exclusive)
 
 
 
@@ -46,7 +445,9 @@ class ContextManager:
             username=None,
             email=None,
             commit_at_exit=True,
-            read_only=False
+            read_only=False,
+            first=False,
+            exclusive=False
     ):
 
         self.database = database
@@ -55,8 +456,14 @@ class ContextManager:
         self.email = email
         self.commit_at_exit = commit_at_exit
         self.read_only = read_only
+        self.first = first
+        # Take the lock alone, as a reader: the request is handled in
+        # another thread, and the database is not thread-safe
+        self.exclusive = read_only and exclusive
 
         self.token = None  # Token to reset the context
+        self.lock_wait = 0  # Time spent waiting for the lock
+        self.acquired_at = None
 
 
     async def __aenter__(self):
@@ -68,14 +475,9 @@ class ContextManager:
             raise ValueError('Cannot acquire context. Already locked.')
 
         # Acquire lock on database
-        global active_ro
-        if self.read_only:
-            async with ro_lock:
-                active_ro += 1
-                if active_ro == 1:
-                    await rw_lock.acquire()
-        else:
-            await rw_lock.acquire()
+        self.lock_wait = await self.database.lock.acquire(
+            self.read_only, self.first, self.exclusive)
+        self.acquired_at = monotonic()
 
         # Build and set the context instance
         root = self.database.get_resource('/', soft=True)
@@ -112,33 +514,94 @@ class ContextManager:
         try:
             if self.commit_at_exit:
                 self.context.database.save_changes()
-            else:
+            elif self.context.commit_future is None:
                 if self.context.database.has_changed:
                     print('Warning: Some changes have not been commited')
         finally:
             reset_context(self.token)
             self.token = None
-            global active_ro
-            if self.read_only:
-                async with ro_lock:
-                    active_ro -= 1
-                    if active_ro == 0:
-                        rw_lock.release()
-            else:
-                rw_lock.release()
+            self.database.lock.release(self.read_only, self.acquired_at)
 
 
 
-class Database(RWDatabase):
+class Database(DatabaseStats, RWDatabase):
     """Adds a Git archive to the itools database.
     """
 
+    # The commit generation, and the file where to publish it (if any) so
+    # read-only workers know when to reload (see ikaaro.workers)
+    generation = 0
+    generation_path = None
+    # Group commit (see ikaaro.group_commit), and whether the current
+    # transaction changed something
+    group_commit = None
+    transaction_changed = False
+    # Number of documents to (un)index by the current commit
+    docs_to_write = 0
+    # The catalog being rebuilt (see ikaaro.reindex.OnlineReindex), and the
+    # documents to (un)index in it after the current commit
+    shadow_catalog = None
+    shadow_docs = None
+
+    @lazy
+    def lock(self):
+        return RWLock()
+
+
+    @lazy
+    def commit_histogram(self):
+        return Histogram()
+
+
+    @lazy
+    def reindex_dependencies(self):
+        return ReindexDependencies()
+
+
+    @lazy
+    def access_queries(self):
+        # The queries built from the access rules (see ConfigAccess)
+        return {}
+
+
+    @lazy
+    def commit_stats(self):
+        return CommitStats()
+
+
+    @lazy
+    def mtime_updated(self):
+        # The resources whose mtime has been set (see update_mtime)
+        return set()
+
+
     def init_context(self, user=None, username=None, email=None, commit_at_exit=True,
-                     read_only=False):
+                     read_only=False, first=False, exclusive=False):
 
         return ContextManager(self, read_only=read_only,
                               user=user, username=username, email=email,
-                              commit_at_exit=commit_at_exit)
+                              commit_at_exit=commit_at_exit, first=first,
+                              exclusive=exclusive)
+
+
+    def add_resource(self, *args, **kw):
+        self.transaction_changed = True
+        return super().add_resource(*args, **kw)
+
+
+    def change_resource(self, *args, **kw):
+        self.transaction_changed = True
+        return super().change_resource(*args, **kw)
+
+
+    def remove_resource(self, *args, **kw):
+        self.transaction_changed = True
+        return super().remove_resource(*args, **kw)
+
+
+    def move_resource(self, *args, **kw):
+        self.transaction_changed = True
+        return super().move_resource(*args, **kw)
 
 
     def _before_commit(self):
@@ -147,10 +610,15 @@ class Database(RWDatabase):
         if context.database != self:
             raise ValueError('The contextual database is not coherent')
 
+        stats = self.commit_stats
+        stats.start()
+
         # Update resources
-        for path in copy.deepcopy(self.resources_new2old):
+        paths = copy.deepcopy(self.resources_new2old)
+        for path in paths:
             resource = root.get_resource(path)
             resource.update_resource(context)
+        stats.phase('update_resource', len(paths))
 
         # 1. Update links when resources moved
         # XXX With this code '_on_move_resource' is called for new resources,
@@ -162,43 +630,40 @@ class Database(RWDatabase):
             target = Path(target)
             resource = root.get_resource(target)
             resource._on_move_resource(source)
+        stats.phase('move_links', len(old2new))
 
         # 2. Find out resources to re-index because they depend on another
-        # resource that changed
+        # resource that changed (transitively, see ReindexDependencies)
+        dependencies = self.reindex_dependencies
         to_reindex = set()
-        aux = set()
-        aux2 = set(self.resources_old2new.keys())
-        while len(aux) != len(aux2):
-            aux = set(aux2)
-            # XXX we regroup items by 200 because Xapian is slow
-            # when there's too much items in OrQuery
-            l_aux = list(aux)
-            for sub_aux in [l_aux[n:n+200] for n in range(0, len(l_aux), 200)]:
-                query = [ PhraseQuery('onchange_reindex', x) for x in sub_aux ]
-                query = OrQuery(*query)
-                search = self.search(query)
-                for brain in search.get_documents():
-                    path = brain.abspath
-                    aux2.add(path)
-                    to_reindex.add(path)
+        todo = set(self.resources_old2new.keys())
+        seen = set()
+        while todo:
+            seen |= todo
+            found = dependencies.get_dependents(self, todo)
+            to_reindex |= found
+            todo = found - seen
+        stats.phase('reindex_dependencies', len(to_reindex))
+
+        # Invalidate the caches of the resources that changed
+        changed = set(self.resources_new2old) | set(self.resources_old2new)
+        changed.update(x for x in self.resources_old2new.values() if x)
+        server = context.server
+        if server and server.page_cache:
+            server.page_cache.invalidate(changed | to_reindex)
+        if any(is_access_path(x) for x in changed):
+            self.access_queries.clear()
+        stats.phase('invalidate', len(changed | to_reindex))
 
         # 3. Documents to unindex (the update_links methods calls
         # 'change_resource' which may modify the resources_old2new dictionary)
         docs_to_unindex = list(self.resources_old2new.keys())
         self.resources_old2new.clear()
+        stats.phase('unindex', len(docs_to_unindex))
 
         # 4. Update mtime/last_author
-        user = context.user
-        userid = user.name if user else None
-        for path in self.resources_new2old:
-            if context.set_mtime:
-                resource = root.get_resource(path)
-                handler = resource.metadata
-                if handler.dirty:
-                    # Save mtime, only if there's really changes
-                    # (if we reindex resource, no need to update mtime)
-                    handler.set_property('mtime', context.timestamp)
-                    handler.set_property('last_author', userid)
+        n = self.update_mtime(context)
+        stats.phase('mtime', n)
         # Remove from to_reindex if resource has been deleted
         to_reindex = to_reindex - set(docs_to_unindex)
         # 5. Index
@@ -215,13 +680,73 @@ class Database(RWDatabase):
         docs_to_index = aux
         self.resources_new2old.clear()
 
+        # Keep the index of the dependencies up to date
+        for path in docs_to_unindex:
+            dependencies.remove(str(path))
+        for resource, values in docs_to_index:
+            targets = values.get('onchange_reindex')
+            if type(targets) is str:
+                targets = [targets]
+            dependencies.update(values['abspath'], targets)
+        stats.phase('catalog_values', len(docs_to_index))
+
         # 6. Find out commit author & message
+        git_author = self.get_commit_author(context)
+        git_msg = self.get_commit_message(context)
+        group_commit = self.group_commit
+        if group_commit and group_commit.pending:
+            if not self.transaction_changed:
+                git_msg = None
+            git_author, git_msg = group_commit.get_commit_info(git_author,
+                                                               git_msg)
+        stats.phase('git_author', 1)
+
+        # Ok
+        git_date = context.fix_tzinfo(context.timestamp)
+        self.docs_to_write = len(docs_to_index) + len(docs_to_unindex)
+        if self.shadow_catalog is not None:
+            self.shadow_docs = (docs_to_unindex,
+                                [ values for resource, values in docs_to_index ])
+        return git_author, git_date, git_msg, docs_to_index, docs_to_unindex
+
+
+    def update_mtime(self, context):
+        """Set the mtime and last_author of the resources changed, from the
+        given context, and return how many.
+        """
+        updated = self.mtime_updated
+        if not context.set_mtime:
+            updated.update(self.resources_new2old)
+            return 0
+
+        root = self.get_resource('/')
+        user = context.user
+        userid = user.name if user else None
+        n = 0
+        for path in self.resources_new2old:
+            if path in updated:
+                continue
+            resource = root.get_resource(path)
+            handler = resource.metadata
+            if handler.dirty:
+                # Save mtime, only if there's really changes
+                # (if we reindex resource, no need to update mtime)
+                handler.set_property('mtime', context.timestamp)
+                handler.set_property('last_author', userid)
+                updated.add(path)
+                n += 1
+        return n
+
+
+    def get_commit_author(self, context):
+        user = context.user
         if user:
             user_email = user.get_value('email')
-            git_author = (userid, user_email or 'nobody')
-        else:
-            git_author = ('nobody', 'nobody')
+            return (user.name, user_email or 'nobody')
+        return ('nobody', 'nobody')
 
+
+    def get_commit_message(self, context):
         git_msg = getattr(context, 'git_message', None)
         if not git_msg:
             if context.method and context.uri:
@@ -232,10 +757,95 @@ class Database(RWDatabase):
                     git_msg += f" action: {action}"
         else:
             git_msg = git_msg.encode('utf-8')
+        return git_msg
 
-        # Ok
-        git_date = context.fix_tzinfo(context.timestamp)
-        return git_author, git_date, git_msg, docs_to_index, docs_to_unindex
+
+    def save_changes(self, *args, **kw):
+        group_commit = self.group_commit
+        if group_commit and group_commit.defer(get_context()):
+            return
+
+        t0 = monotonic()
+        has_changed = self.has_changed
+        try:
+            super().save_changes(*args, **kw)
+        except Exception as error:
+            # The catalog may not have the values we expect
+            self.reindex_dependencies.clear()
+            if group_commit:
+                group_commit.done(error)
+            raise
+        finally:
+            self.transaction_changed = False
+            self.mtime_updated.clear()
+            shadow_docs, self.shadow_docs = self.shadow_docs, None
+        if group_commit:
+            group_commit.done()
+        if shadow_docs and self.shadow_catalog is not None:
+            # The catalog being rebuilt
+            docs_to_unindex, docs_to_index = shadow_docs
+            for path in docs_to_unindex:
+                self.shadow_catalog.unindex_document(path)
+            for values in docs_to_index:
+                self.shadow_catalog.index_document(values)
+        if has_changed:
+            # The git commit and the catalog commit
+            stats = self.commit_stats
+            stats.phase('write', self.docs_to_write)
+            stats.end()
+            self.catalog_changed()
+
+        # Time spent in the commit, for the access log and the metrics
+        seconds = monotonic() - t0
+        if has_changed:
+            self.commit_histogram.observe(seconds)
+        context = get_context()
+        if context is not None:
+            context.add_timing('commit', seconds)
+
+
+    def swap_catalog(self, path):
+        """Replace the catalog by the one at the given path.  The read-only
+        workers may still use the old catalog, it is kept as 'catalog.old'
+        until the next swap; the generation is bumped so they open the new
+        one (see RODatabase.drop_cache).
+        """
+        backend = self.backend
+        backend.catalog.close()
+        catalog_path = f'{self.path}/catalog'
+        old_path = f'{catalog_path}.old'
+        if lfs.exists(old_path):
+            # From the swap before, the workers have reopened since
+            lfs.remove(old_path)
+        lfs.move(catalog_path, old_path)
+        lfs.move(path, catalog_path)
+        backend.catalog = Catalog(catalog_path, get_register_fields())
+        # The catalog is new
+        self.reindex_dependencies.clear()
+        self.catalog_changed()
+
+
+    def abort_changes(self, *args, **kw):
+        group_commit = self.group_commit
+        if group_commit and group_commit.pending:
+            if not self.transaction_changed:
+                # Keep the batch, there is nothing to abort here
+                return
+            # The changes of the batch are lost too
+            group_commit.done(BatchAborted('transaction aborted'))
+        self.transaction_changed = False
+        self.mtime_updated.clear()
+        super().abort_changes(*args, **kw)
+
+
+    def catalog_changed(self):
+        """Bump the generation, so the read-only workers reopen the catalog.
+        Called after every commit, and when the catalog is updated out of a
+        commit (see ikaaro.text_queue).
+        """
+        self.generation += 1
+        if self.generation_path:
+            write_generation(self.generation_path, self.generation)
 
 
     def get_dynamic_classes(self):
@@ -246,6 +856,24 @@ class Database(RWDatabase):
 
 
 
+def get_handler_path(database, handler):
+    """Return the path of the file that holds the given handler, or None if
+    the handler has changes not yet saved (or it is not stored in a file).
+    """
+    key = getattr(handler, 'key', None)
+    if key is None or handler.dirty:
+        return None
+
+    if not isabs(key):
+        fs = getattr(database.backend, 'fs', None)
+        if fs is None:
+            return None
+        key = fs.get_absolute_path(key)
+
+    return key if isfile(key) else None
+
+
+
 def get_database(path, size_min, size_max, read_only=False, backend='git'):
     if read_only is True:
         return RODatabase(path, size_min, size_max, backend=backend)
@@ -33,7 +33,7 @@ from itools.office import MSPowerPointX as MSPowerPointXFile
 from itools.web import get_context
 
 # Import from ikaaro
-from .database import Database
+from .database import Database, get_handler_path
 from .fields import Char_Field, File_Field, Owner_Field
 from .file_views import File_NewInstance, File_View
 from .file_views import File_Edit, File_ExternalEdit, File_ExternalEdit_View
@@ -86,11 +86,27 @@ class File(DBResource):
     #######################################################################
     # Versioning & Indexing
     #######################################################################
+    index_text_later = True
+
     def to_text(self):
         data = self.get_value('data')
         return data and data.to_text() or ''
 
 
+    def get_text_source(self):
+        # Only if the text comes from the handler
+        if type(self).to_text is not File.to_text:
+            return None
+
+        data = self.get_value('data')
+        if data is None:
+            return None
+        path = get_handler_path(self.database, data)
+        if path is None:
+            return None
+        return type(data), path
+
+
     def get_files_to_archive(self, content=False):
         # Handlers
         files = [ x.key for x in self.get_handlers() ]
@@ -0,0 +1,137 @@
+"""Group commit: the changes of several write requests are saved with one git
+commit and one catalog commit.
+
+When a request saves its changes (Database.save_changes) they are kept in
+memory and the request releases the lock, then waits for the commit before
+sending the response (see asgi.catch_all).  The next write requests add
+their changes to the batch, the read requests wait.  The batch is saved
+after "group-commit-delay" milliseconds, or by the request that makes it
+reach "group-commit-size" transactions.
+
+No request is answered before its changes are saved.  The changes of the
+batch are kept in memory with those of the current transaction, they cannot
+be told apart: if a transaction that changed something is aborted, the batch
+is lost too.  Its requests, not answered yet, get a "503 Service Unavailable"
+and may be retried (see BatchAborted).
+"""
+
+import asyncio
+import contextvars
+import logging
+
+
+log = logging.getLogger("ikaaro.web")
+
+
+class BatchAborted(Exception):
+    """The changes of the batch were not saved: a later transaction of the
+    batch was aborted.
+    """
+
+
+class GroupCommit:
+
+    def __init__(self, database, delay, size):
+        self.database = database
+        self.delay = delay  # In seconds
+        self.size = size
+        self.pending = []   # [(git_author, git_msg, future)]
+        self.task = None
+        # Stats
+        self.commits = 0
+        self.transactions = 0
+
+
+    def defer(self, context):
+        """Called by Database.save_changes, return True if the changes of the
+        current transaction are added to the batch, False if they must be
+        saved now (with the batch if any).
+        """
+        if not getattr(context, 'group_commit', False):
+            return False
+
+        database = self.database
+        if not database.transaction_changed:
+            # Nothing of its own to save, but what it read is not saved yet
+            if not self.pending:
+                return False
+            context.commit_future = self.pending[-1][2]
+            return True
+        if len(self.pending) + 1 >= self.size:
+            return False
+
+        # The values that depend on the request
+        database.update_mtime(context)
+        git_author = database.get_commit_author(context)
+        git_msg = database.get_commit_message(context)
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((git_author, git_msg, future))
+        context.commit_future = future
+        database.transaction_changed = False
+
+        # The readers must not see the changes before they are saved
+        database.lock.batch = True
+        if self.task is None:
+            # Out of the context of the request
+            self.task = contextvars.Context().run(asyncio.create_task,
+                                                  self.run())
+        return True
+
+
+    def get_commit_info(self, git_author, git_msg):
+        """Return the author and message of the commit of the batch: the
+        messages of every transaction, and the author if they all have the
+        same.
+        """
+        authors = set()
+        messages = []
+        for author, msg, future in self.pending:
+            authors.add(author)
+            messages.append(msg)
+        if git_msg is not None:
+            authors.add(git_author)
+            messages.append(git_msg)
+
+        if len(authors) > 1:
+            git_author = ('nobody', 'nobody')
+        elif authors:
+            git_author = authors.pop()
+        messages = [ x.decode('utf-8') if type(x) is bytes else x
+                     for x in messages if x ]
+        return git_author, '\n'.join(messages) or None
+
+
+    def done(self, error=None):
+        """Called when the batch is saved, or aborted.
+        """
+        if self.pending:
+            self.commits += 1
+            self.transactions += len(self.pending)
+        for author, msg, future in self.pending:
+            if future.done():
+                continue
+            if error is None:
+                future.set_result(True)
+            else:
+                future.set_exception(error)
+        self.pending = []
+        lock = self.database.lock
+        lock.batch = False
+        lock._wake_up()
+
+
+    async def run(self):
+        await asyncio.sleep(self.delay)
+        database = self.database
+        # The batch holds back the waiting readers, go first
+        context_manager = database.init_context(commit_at_exit=False,
+                                                first=True)
+        async with context_manager:
+            self.task = None
+            if not self.pending:
+                # Saved already, by the last transaction of the batch
+                return
+            try:
+                database.save_changes()
+            except Exception:
+                log.error('Group commit failed', exc_info=True)
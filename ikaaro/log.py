@@ -1,8 +1,25 @@
 from logging.config import dictConfig
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
+import atexit
+import logging
 import sys
 
 
+# The thread writing the access log (see config_logging)
+access_listener = None
+
+
+def stop_access_listener():
+    global access_listener
+    if access_listener is not None:
+        access_listener.stop()
+        access_listener = None
+
+
 def config_logging(logdir, loglevel):
+    global access_listener
+
     access_handler = {
         'class': 'logging.StreamHandler',
         'stream': sys.stdout,
@@ -16,6 +33,7 @@ def config_logging(logdir, loglevel):
         'stream': sys.stderr,
     }
 
+    stop_access_listener()
     dictConfig({
         'version': 1,
         'formatters': {
@@ -49,3 +67,16 @@ def config_logging(logdir, loglevel):
             'ikaaro': {},
         },
     })
+
+    # The access log is written by another thread, through a queue, so a
+    # slow output never blocks the event loop
+    logger = logging.getLogger('ikaaro.access')
+    queue = SimpleQueue()
+    access_listener = QueueListener(queue, *logger.handlers,
+                                    respect_handler_level=True)
+    logger.handlers = [QueueHandler(queue)]
+    access_listener.start()
+
+
+# Flush the access log at exit
+atexit.register(stop_access_listener)
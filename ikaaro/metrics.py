@@ -0,0 +1,160 @@
+"""Runtime metrics of the server, exported in the Prometheus text format by
+the ApiDevPanel_Metrics view (/api/devpanel/metrics).
+"""
+
+from bisect import bisect_left
+
+# Import from itools
+from itools.core import is_prototype
+from itools.web.views import ItoolsView
+
+
+# Upper bounds of the buckets, in seconds
+default_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+
+
+def format_value(value):
+    if value is None:
+        return 'NaN'
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    labels = [
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\')
+                                          .replace('"', '\\"')
+                                          .replace('\n', '\\n'))
+        for name, value in labels ]
+    return '{' + ','.join(labels) + '}'
+
+
+
+class Histogram:
+
+    def __init__(self, buckets=default_buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        index = bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            self.counts[index] += 1
+
+
+    def get_lines(self, name, labels=()):
+        labels = tuple(labels)
+        lines = []
+        total = 0
+        for bucket, count in zip(self.buckets, self.counts):
+            total += count
+            le = format_labels(labels + (('le', format_value(bucket)),))
+            lines.append(f'{name}_bucket{le} {total}')
+        le = format_labels(labels + (('le', '+Inf'),))
+        lines.append(f'{name}_bucket{le} {self.count}')
+        labels = format_labels(labels)
+        lines.append(f'{name}_sum{labels} {format_value(self.sum)}')
+        lines.append(f'{name}_count{labels} {self.count}')
+        return lines
+
+
+
+class Metrics:
+    """Registry of the metrics: histograms are observed as things happen,
+    the other values (gauges and counters) are added when exporting.
+    """
+
+    def __init__(self):
+        self.histograms = {}  # {name: (help, {labels: Histogram})}
+        self.routes = {}      # {id(view): pattern}
+        self.nb_patterns = None
+
+
+    def get_histogram(self, name, help, **labels):
+        histograms = self.histograms.setdefault(name, (help, {}))[1]
+        key = tuple(sorted(labels.items()))
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = Histogram()
+        return histogram
+
+
+    def add_histogram(self, name, help, histogram, **labels):
+        """Export a histogram observed elsewhere (e.g. by the lock).
+        """
+        histograms = self.histograms.setdefault(name, (help, {}))[1]
+        histograms[tuple(sorted(labels.items()))] = histogram
+
+
+    def observe(self, name, help, value, **labels):
+        self.get_histogram(name, help, **labels).observe(value)
+
+
+    def get_route(self, context):
+        """Return the label of the request: the pattern of the route that
+        matched (see Server.dispatcher), or the class and view names.  The
+        view name comes from the URL, it is used only if the class defines
+        that view; 'other' otherwise, so the clients cannot make new labels.
+        """
+        patterns = context.server.dispatcher.patterns
+        if len(patterns) != self.nb_patterns:
+            self.routes = { id(x): pattern
+                            for pattern, (regex, x) in patterns.items() }
+            self.nb_patterns = len(patterns)
+
+        route = self.routes.get(id(context.view))
+        if route is not None:
+            return route
+        resource = context.resource
+        if resource is None or context.view is None:
+            return 'other'
+        view_name = context.view_name
+        if view_name is None:
+            return f'{resource.class_id};'
+        view = getattr(type(resource), view_name, None)
+        if not is_prototype(view, ItoolsView):
+            return 'other'
+        return f'{resource.class_id};{view_name}'
+
+
+    def observe_request(self, context, status, seconds):
+        route = self.get_route(context)
+        self.observe('ikaaro_request_duration_seconds',
+                     'Time spent handling the requests', seconds,
+                     route=route, method=context.request.method,
+                     status=f'{status // 100}xx')
+
+
+    def get_lines(self, values=()):
+        """Return the lines of the export, 'values' is a list of
+        (name, type, help, [(labels, value), ...]) with the gauges and
+        counters to add.
+        """
+        lines = []
+        for name, (help, histograms) in sorted(self.histograms.items()):
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} histogram')
+            for labels, histogram in sorted(histograms.items()):
+                lines.extend(histogram.get_lines(name, labels))
+
+        for name, kind, help, samples in values:
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in samples:
+                labels = format_labels(sorted(labels.items()))
+                lines.append(f'{name}{labels} {format_value(value)}')
+
+        return lines
+
+
+    def to_str(self, values=()):
+        return '\n'.join(self.get_lines(values)) + '\n'
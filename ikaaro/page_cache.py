@@ -0,0 +1,190 @@
+"""Full-page cache for the anonymous GET requests (see catch_all in
+ikaaro.asgi).  The pages are invalidated at every commit by the paths of the
+resources that changed (see Database._before_commit).
+
+The pages are looked up before the database lock is taken, so the key is
+computed from the request only: the languages of the site are those seen
+when the last page was rendered (see 'languages').
+
+Only the page of a resource is invalidated when it changes (with the pages
+of its ancestors and descendants): a page that lists or searches other
+resources (a listing in another folder, a search page...) is stale until it
+expires (see "page-cache-ttl").
+"""
+
+from collections import OrderedDict
+from time import monotonic
+
+# Import from itools
+from itools.i18n import AcceptLanguageType
+
+
+class CachedPage:
+
+    __slots__ = ('path', 'status', 'headers', 'content', 'stored')
+
+    def __init__(self, path, status, headers, content):
+        self.path = path
+        self.status = status
+        self.headers = headers
+        self.content = content
+        self.stored = None
+
+
+
+class PageCache:
+    """Size-bounded LRU cache of rendered pages.  A page is invalidated when
+    its resource, one of its ancestors or one of its descendants changes.
+    """
+
+    # A change in these folders invalidates all the pages (menus, footer,
+    # theme...)
+    dependencies = ('/config', '/theme')
+
+    # Session keys that do not change the page (the language is in the key)
+    session_keys = frozenset(['language'])
+
+
+    def __init__(self, size, ttl=0):
+        self.size = size
+        self.ttl = ttl              # In seconds, 0 for no expiration
+        self.pages = OrderedDict()  # {key: CachedPage}
+        self.paths = {}             # {path: set(keys)}
+        self.languages = None       # The languages of the site
+        # Bumped by every invalidation, pages rendered before are not stored
+        self.version = 0
+        # Stats
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+
+    #######################################################################
+    # Keys
+    #######################################################################
+    def get_key(self, request):
+        """Return the cache key for the given Starlette request, or None if
+        the request cannot be served from the cache: not anonymous (the user
+        is in the session or in the Authorization header), or the languages
+        of the site are not known yet.  The skin is a function of the host
+        and the query, so it is covered by the key.
+        """
+        languages = self.languages
+        if languages is None or request.method != 'GET':
+            return None
+        if 'authorization' in request.headers:
+            return None
+        session = request.scope.get('session')
+        if session and not set(session) <= self.session_keys:
+            return None
+
+        accept_language = request.headers.get('accept-language', '')
+        try:
+            accept_language = AcceptLanguageType.decode(accept_language)
+        except Exception:
+            accept_language = AcceptLanguageType.decode('')
+        language = accept_language.select_language(languages)
+        url = request.url
+        return (url.scheme, request.headers.get('host'), url.path, url.query,
+                language)
+
+
+    def is_cacheable(self, context, headers):
+        if context.user is not None:
+            return False
+        if context.status != 200 or context.resource is None:
+            return False
+        if type(context.entity) not in (str, bytes):
+            return False
+        if 'set-cookie' in headers:
+            return False
+        cache_control = headers.get('cache-control', '')
+        return 'no-store' not in cache_control and 'private' not in cache_control
+
+
+    #######################################################################
+    # API
+    #######################################################################
+    def get(self, key):
+        page = self.pages.get(key)
+        if page is not None and self.ttl:
+            if monotonic() - page.stored > self.ttl:
+                self.remove(key)
+                page = None
+        if page is None:
+            self.misses += 1
+            return None
+        self.pages.move_to_end(key)
+        self.hits += 1
+        return page
+
+
+    def put(self, key, page, version):
+        # Something changed while the page was rendered
+        if version != self.version:
+            return
+
+        self.remove(key)
+        page.stored = monotonic()
+        self.pages[key] = page
+        self.paths.setdefault(page.path, set()).add(key)
+        while len(self.pages) > self.size:
+            old_key = next(iter(self.pages))
+            self.remove(old_key)
+            self.evictions += 1
+
+
+    def remove(self, key):
+        page = self.pages.pop(key, None)
+        if page is None:
+            return
+        keys = self.paths[page.path]
+        keys.discard(key)
+        if not keys:
+            del self.paths[page.path]
+
+
+    def clear(self):
+        self.version += 1
+        self.languages = None
+        self.invalidations += len(self.pages)
+        self.pages.clear()
+        self.paths.clear()
+
+
+    def invalidate(self, paths):
+        """Remove the pages of the resources that changed, of their
+        ancestors and of their descendants.
+        """
+        self.version += 1
+        paths = [ str(x).rstrip('/') or '/' for x in paths ]
+        if '/' in paths:
+            # The languages of the site may have changed
+            self.languages = None
+        for path in paths:
+            for dependency in self.dependencies:
+                if path == dependency or path.startswith(dependency + '/'):
+                    self.clear()
+                    return
+
+        to_remove = set()
+        for page_path in self.paths:
+            for path in paths:
+                if (page_path == path or page_path == '/' or path == '/'
+                    or page_path.startswith(path + '/')
+                    or path.startswith(page_path + '/')):
+                    to_remove.add(page_path)
+                    break
+
+        for page_path in to_remove:
+            for key in list(self.paths[page_path]):
+                self.remove(key)
+                self.invalidations += 1
+
+
+    def get_stats(self):
+        return {'size': len(self.pages), 'max_size': self.size,
+                'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations}
@@ -0,0 +1,126 @@
+"""Profile a live request: admins add '?__profile=1' to the URL (or send the
+'X-Ikaaro-Profile: 1' header) and the profile of the request is saved in
+{target}/log/profiles/, with a text report next to it.  With the value
+'html' the response is replaced by the report.
+"""
+
+from cProfile import Profile
+from hashlib import sha1
+from html import escape
+from io import StringIO
+from os import makedirs
+from time import strftime
+import pstats
+import re
+
+
+def get_profile_name(method, path, max_length=60):
+    """Return the name of the profile file of a request: the path, with the
+    characters that are not safe in a file name replaced, truncated, and a
+    hash of the full path.
+    """
+    name = path.strip('/').replace('/', '_') or 'root'
+    name = re.sub(r'[^A-Za-z0-9._-]', '-', name)[:max_length]
+    digest = sha1(path.encode('utf-8')).hexdigest()[:8]
+    method = re.sub(r'[^A-Z]', '', method.upper())[:10]
+    return f'{strftime("%Y%m%d-%H%M%S")}-{method}-{name}-{digest}.prof'
+
+
+def get_profile_mode(context):
+    """Return 'file', 'html' or None (no profiling).  Only the admins can
+    profile a request.
+    """
+    request = context.request
+    value = request.query_params.get('__profile')
+    if value is None:
+        value = request.headers.get('x-ikaaro-profile')
+    if not value or value == '0':
+        return None
+
+    root = context.root
+    if not root.is_admin(context.user, root):
+        return None
+    return 'html' if value == 'html' else 'file'
+
+
+
+class RequestProfiler:
+
+    # Number of lines of the report
+    limit = 60
+
+    def __init__(self, context):
+        self.context = context
+        self.profile = Profile()
+        self.searches = 0
+        self.counters = {}
+
+
+    def run(self, function, *args):
+        # The database operations are counted by the context (see
+        # ikaaro.database.Database)
+        context = self.context
+        database = context.database
+        search_count = database.search_count
+        count_operations = context.count_operations
+        before = { name: counter[0]
+                   for name, counter in context.counters.items() }
+        context.count_operations = True
+        try:
+            return self.profile.runcall(function, *args)
+        finally:
+            context.count_operations = count_operations
+            self.searches = database.search_count - search_count
+            self.counters = {
+                name: counter[0] - before.get(name, 0)
+                for name, counter in context.counters.items()
+                if name != 'searches' }
+
+
+    def get_stats(self, stream=None):
+        return pstats.Stats(self.profile, stream=stream)
+
+
+    def get_counters(self):
+        counters = {'catalog searches': self.searches}
+        counters.update(sorted(self.counters.items()))
+        return counters
+
+
+    def get_text(self):
+        """Return the profile as text: the counters, then the functions
+        sorted by cumulative time.
+        """
+        stream = StringIO()
+        request = self.context.request
+        stream.write(f'{request.method} {request.url}\n\n')
+        for name, value in self.get_counters().items():
+            stream.write(f'{name}: {value}\n')
+        stream.write('\n')
+        stats = self.get_stats(stream)
+        stats.sort_stats('cumulative').print_stats(self.limit)
+        return stream.getvalue()
+
+
+    def save(self, target):
+        """Write the profile to {target}/log/profiles/, in the format of the
+        pstats module, and its text report (see get_text) next to it.  Return
+        the file name of the profile.
+        """
+        folder = f'{target}/log/profiles'
+        makedirs(folder, exist_ok=True)
+        request = self.context.request
+        name = get_profile_name(request.method, request.url.path)
+        self.profile.dump_stats(f'{folder}/{name}')
+        with open(f'{folder}/{name[:-5]}.txt', 'w') as file:
+            file.write(self.get_text())
+        return name
+
+
+    def get_report(self):
+        request = self.context.request
+        return (
+            '<!DOCTYPE html>\n<html><head><title>Profile</title></head><body>'
+            f'<h1>{escape(request.method)} {escape(str(request.url))}</h1>'
+            f'<pre>{escape(self.get_text())}</pre>'
+            '</body></html>')
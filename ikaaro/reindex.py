@@ -0,0 +1,449 @@
+"""Rebuild of the catalog (see Server.reindex_catalog and the script
+icms-update-catalog.py).
+
+The resources are traversed in a deterministic order (the names sorted), and
+every 10000 resources the new catalog is committed and a checkpoint is
+written next to it ({catalog}.checkpoint): with --resume a rebuild that
+died continues after the last resource of the checkpoint.
+
+With several jobs the resources are shared between worker processes by a
+hash of their path: every worker opens the database read-only, walks the
+metadata files (see ikaaro.walk), loads and indexes its share into a partial
+catalog; then the partial
+catalogs are merged into one (as xapian-compact does).  The catalog gives its
+fields their slots in the order it first sees them, the partial catalogs are
+given the same map of fields beforehand (see register_fields).
+
+With --only-path or --only-class the resources of the subtree, or of the
+classes, are reindexed into the current catalog.
+
+While the server runs, OnlineReindex rebuilds the catalog in the background
+into a shadow catalog, which replaces the catalog at the end.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from logging import getLogger
+from multiprocessing import get_context
+from time import time
+from zlib import crc32
+import asyncio
+import contextvars
+import json
+
+# Import from itools
+from itools.database import AndQuery, OrQuery, PhraseQuery
+from itools.database import get_register_fields
+from itools.database.backends.catalog import Catalog, make_catalog
+from itools.database.backends.catalog import dumps as dump_metadata
+from itools.fs import lfs
+from xapian import Database as XapianDatabase
+
+# Import from ikaaro
+from .utils import get_base_path_query
+from .walk import get_path_key, walk_resources
+
+
+log = getLogger("ikaaro")
+
+
+def in_partition(abspath, job, jobs):
+    return crc32(str(abspath).encode('utf-8')) % jobs == job
+
+
+class Checkpoint:
+    """The progress of a rebuild: the last resource indexed, the number of
+    resources indexed and the revision of the catalog then.
+    """
+
+    # Number of resources between two checkpoints
+    interval = 10000
+
+    def __init__(self, catalog_path, jobs=1):
+        self.path = f'{catalog_path}.checkpoint'
+        self.jobs = jobs
+
+
+    def load(self):
+        try:
+            with open(self.path) as file:
+                state = json.load(file)
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            log.warning(f'Bad checkpoint {self.path}, ignored')
+            return None
+
+        if state.get('jobs', 1) != self.jobs:
+            log.warning(f'The checkpoint {self.path} is for {state["jobs"]}'
+                        ' jobs, ignored')
+            return None
+        return state
+
+
+    def save(self, catalog, abspath, doc_n):
+        catalog.save_changes()
+        state = {
+            'abspath': str(abspath),
+            'count': doc_n,
+            'revision': catalog._db.get_revision(),
+            'jobs': self.jobs}
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump(state, file)
+        lfs.move(tmp_path, self.path)
+
+
+    def remove(self):
+        if lfs.exists(self.path):
+            lfs.remove(self.path)
+
+
+
+def register_fields(catalog, languages):
+    """Give every registered field, and its versions in the given languages,
+    its slot and prefix in the catalog, in a fixed order; so catalogs built
+    apart have the same map of fields and can be merged.
+    """
+    fields = catalog._fields
+    metadata = catalog._metadata
+    for name in sorted(fields):
+        field_cls = fields[name]
+        if name not in metadata:
+            metadata[name] = catalog._get_info(field_cls, name)
+        # Multilingual values are indexed by language too
+        for language in sorted(languages):
+            lang_name = f'{name}_{language}'
+            if lang_name not in metadata:
+                info = catalog._get_info(field_cls, lang_name)
+                info['from'] = name
+                metadata[lang_name] = info
+    catalog._db.set_metadata('metadata', dump_metadata(metadata))
+
+
+def get_catalog_languages(catalog):
+    """Return the languages of the multilingual values indexed in the given
+    catalog.
+    """
+    languages = set()
+    for name, info in catalog._metadata.items():
+        source = info.get('from')
+        if source:
+            languages.add(name[len(source) + 1:])
+    return languages
+
+
+def open_new_catalog(catalog_path, resume=False, jobs=1, languages=None):
+    """Return the catalog to rebuild, its checkpoint and the state where to
+    resume (None to start from the beginning).  If 'languages' is given the
+    fields of the catalog are registered (see register_fields).
+    """
+    checkpoint = Checkpoint(catalog_path, jobs)
+    state = checkpoint.load() if resume else None
+    if state and lfs.exists(catalog_path):
+        catalog = Catalog(catalog_path, get_register_fields())
+        # The resources indexed after the checkpoint are indexed again
+        if catalog._db.get_revision() >= state['revision']:
+            log.info(f'Resume after {state["abspath"]} ({state["count"]})')
+            if languages is not None:
+                register_fields(catalog, languages)
+            return catalog, checkpoint, state
+        catalog.close()
+        log.warning(f'The checkpoint does not match {catalog_path}, start'
+                    ' again')
+
+    if lfs.exists(catalog_path):
+        lfs.remove(catalog_path)
+    checkpoint.remove()
+    catalog = make_catalog(catalog_path, get_register_fields())
+    if languages is not None:
+        register_fields(catalog, languages)
+    return catalog, checkpoint, None
+
+
+
+async def index_resources(database, catalog, nb_docs, quiet=False,
+                          as_test=False, partition=None, checkpoint=None,
+                          state=None, base_path='/', class_ids=None,
+                          seen=None):
+    """Index the resources of the database into the given catalog.  Only
+    those of the partition (job, jobs) if given, of the subtree 'base_path'
+    and of the given classes.  The paths indexed are added to 'seen'.
+
+    Return True if errors were detected (only in test mode, otherwise the
+    exception is raised).
+    """
+    prefix = f'[{partition[0] + 1}/{partition[1]}] ' if partition else ''
+    doc_n = state['count'] if state else 0
+    after = get_path_key(state['abspath']) if state else None
+    abspath = None
+    error_detected = False
+
+    # The resources of the other partitions, or classes, are not loaded
+    def accept(path, class_id):
+        if partition and not in_partition(path, *partition):
+            return False
+        return not class_ids or class_id in class_ids
+
+    async with database.init_context() as context:
+        for obj in walk_resources(database, base_path, after, accept):
+            display_more_details = doc_n % 10000 == 0
+            if not quiet or display_more_details:
+                log.info(f'{prefix}{doc_n}/{nb_docs} - {obj.abspath}')
+                if display_more_details:
+                    percent = int((doc_n / nb_docs) * 100) if nb_docs else 100
+                    log.info(f'{prefix}Progress reindex: {percent}%')
+            doc_n += 1
+            context.resource = obj
+            values = obj.get_catalog_values()
+            # Index the document
+            abspath = obj.abspath
+            try:
+                catalog.index_document(values)
+            except Exception:
+                if as_test:
+                    error_detected = True
+                    log.error(f"Error, Abspath of the resource: {str(abspath)}")
+                else:
+                    raise
+            if seen is not None:
+                seen.add(str(abspath))
+            # Checkpoint
+            if checkpoint and doc_n % checkpoint.interval == 0:
+                checkpoint.save(catalog, abspath, doc_n)
+            # Free Memory (the handlers of the resource are released by
+            # walk_resources, those loaded by get_catalog_values may remain)
+            del obj
+            database.make_room()
+
+    return error_detected
+
+
+async def reindex_subset(database, base_path='/', class_ids=None, quiet=False,
+                         as_test=False):
+    """Reindex the resources of the subtree, or of the given classes, into
+    the catalog of the database; the documents of the resources that no
+    longer exist are removed.  Return True if errors were detected.
+    """
+    catalog = database.catalog
+    # The documents now
+    query = get_base_path_query(base_path, min_depth=0)
+    if class_ids:
+        query = AndQuery(
+            query, OrQuery(*[ PhraseQuery('format', x) for x in class_ids ]))
+    before = { str(x.abspath) for x in database.search(query).get_documents() }
+
+    seen = set()
+    error_detected = await index_resources(
+        database, catalog, len(before), quiet=quiet, as_test=as_test,
+        base_path=base_path, class_ids=class_ids, seen=seen)
+    if error_detected:
+        # Leave the catalog as it was
+        catalog.abort_changes()
+        return True
+
+    for abspath in before - seen:
+        catalog.unindex_document(abspath)
+    catalog.save_changes()
+    return False
+
+
+def reindex_partition(target, cache_size, catalog_path, job, jobs, quiet,
+                      as_test, resume, languages):
+    """Run in the worker processes: index the share of the given job into a
+    new catalog at 'catalog_path'.
+    """
+    from .server import Server
+
+    with Server(target, read_only=True, cache_size=cache_size) as server:
+        server.set_log_level('INFO')
+        database = server.database
+        catalog, checkpoint, state = open_new_catalog(catalog_path, resume,
+                                                      jobs, languages)
+        nb_docs = database.get_nb_metadatas() // jobs
+        error_detected = asyncio.run(
+            index_resources(database, catalog, nb_docs, quiet, as_test,
+                            partition=(job, jobs), checkpoint=checkpoint,
+                            state=state))
+        catalog.save_changes()
+        catalog.close()
+    return error_detected
+
+
+def merge_catalogs(paths, catalog_path):
+    """Merge the catalogs into a new one at 'catalog_path'.  They must have
+    the same map of fields (see register_fields), only one is kept.
+    """
+    maps = set()
+    for path in paths:
+        catalog = XapianDatabase(path)
+        maps.add(catalog.get_metadata('metadata'))
+        catalog.close()
+    if len(maps) > 1:
+        raise ValueError('the catalogs to merge have different fields')
+
+    database = XapianDatabase()
+    for path in paths:
+        database.add_database(XapianDatabase(path))
+    database.compact(catalog_path)
+    database.close()
+
+
+async def reindex_parallel(server, catalog_path, jobs, quiet=False,
+                           as_test=False, resume=False):
+    """Build the new catalog at 'catalog_path' with 'jobs' worker processes,
+    return True if errors were detected.
+    """
+    target = server.target
+    cache_size = '{}:{}'.format(*server.database_size)
+    paths = [ f'{catalog_path}.{job}' for job in range(jobs) ]
+    if lfs.exists(catalog_path):
+        lfs.remove(catalog_path)
+
+    # The languages of the multilingual fields (see register_fields): those
+    # of the site, and those found in the values indexed so far
+    database = server.database
+    async with database.init_context(read_only=True, commit_at_exit=False):
+        root = database.get_resource('/')
+        languages = set(root.get_value('website_languages'))
+    if database.catalog is not None:
+        languages.update(get_catalog_languages(database.catalog))
+
+    loop = asyncio.get_running_loop()
+    # Spawn, the workers must not inherit the open database
+    pool = ProcessPoolExecutor(jobs, mp_context=get_context('spawn'))
+    with pool:
+        futures = [
+            loop.run_in_executor(pool, reindex_partition, target, cache_size,
+                                 path, job, jobs, quiet, as_test, resume,
+                                 languages)
+            for job, path in enumerate(paths) ]
+        results = await asyncio.gather(*futures)
+
+    error_detected = any(results)
+    if not error_detected:
+        log.info(f'[Merge] {jobs} catalogs')
+        merge_catalogs(paths, catalog_path)
+        for path in paths:
+            lfs.remove(path)
+            Checkpoint(path, jobs).remove()
+
+    return error_detected
+
+
+
+class OnlineReindex:
+    """Rebuild the catalog while the server runs.  The resources are indexed
+    into a shadow catalog by batches, between the batches the lock is
+    released so the requests go on.  The commits index their changes in
+    both catalogs (see Database.shadow_catalog).  At the end the shadow
+    catalog replaces the catalog, with the write lock.
+    """
+
+    batch_size = 100
+
+    def __init__(self, server, batch_size=None):
+        self.server = server
+        if batch_size is not None:
+            self.batch_size = batch_size
+        self.path = f'{server.target}/catalog.shadow'
+        self.task = None
+        # Status
+        self.state = 'waiting'
+        self.count = 0
+        self.total = 0
+        self.abspath = None
+        self.started = self.ended = None
+        self.error = None
+
+
+    @property
+    def running(self):
+        return self.state in ('waiting', 'running', 'swapping')
+
+
+    def start(self):
+        # Out of the context of the request
+        self.task = contextvars.Context().run(asyncio.create_task, self.run())
+
+
+    def get_status(self):
+        percent = int(self.count * 100 / self.total) if self.total else 0
+        return {
+            'state': self.state,
+            'count': self.count,
+            'total': self.total,
+            'percent': min(percent, 100),
+            'abspath': self.abspath,
+            'started': self.started,
+            'ended': self.ended,
+            'error': self.error}
+
+
+    async def run(self):
+        database = self.server.database
+        self.state = 'running'
+        self.started = time()
+        self.total = database.get_nb_metadatas()
+        log.info('Reindex catalog (online)')
+        if lfs.exists(self.path):
+            lfs.remove(self.path)
+        shadow = make_catalog(self.path, get_register_fields())
+        database.shadow_catalog = shadow
+        try:
+            # The walk goes on from a batch to the next
+            resources = walk_resources(database, '/')
+            while await self.index_batch(shadow, resources):
+                # Let the requests go
+                await asyncio.sleep(0)
+
+            # Swap
+            self.state = 'swapping'
+            async with database.init_context(commit_at_exit=False):
+                database.shadow_catalog = None
+                shadow.save_changes()
+                shadow.close()
+                database.swap_catalog(self.path)
+            page_cache = self.server.page_cache
+            if page_cache:
+                page_cache.clear()
+            # The text of the resources removed or changed
+            text_cache = self.server.text_cache
+            if text_cache:
+                text_cache.prune(self.started)
+        except Exception as error:
+            log.error('Online reindex failed', exc_info=True)
+            self.state = 'failed'
+            self.error = str(error)
+            if database.shadow_catalog is shadow:
+                database.shadow_catalog = None
+                shadow.close()
+            if lfs.exists(self.path):
+                lfs.remove(self.path)
+        else:
+            self.state = 'done'
+            log.info(f'Reindex catalog (online): {self.count} resources')
+        finally:
+            self.ended = time()
+
+
+    async def index_batch(self, shadow, resources):
+        """Index the next batch of resources from the walk (see
+        walk_resources).  Return False at the end.
+        """
+        database = self.server.database
+        context_manager = database.init_context(read_only=True,
+                                                commit_at_exit=False)
+        async with context_manager as context:
+            n = 0
+            for resource in resources:
+                context.resource = resource
+                shadow.index_document(resource.get_catalog_values())
+                self.abspath = str(resource.abspath)
+                self.count += 1
+                n += 1
+                if n == self.batch_size:
+                    break
+            shadow.save_changes()
+            database.make_room()
+
+        return n == self.batch_size
@@ -20,7 +20,9 @@
 
 # Import from the Standard Library
 from datetime import datetime
+from hashlib import sha1
 from logging import getLogger
+from os import stat
 from pickle import dumps
 from uuid import uuid4
 
@@ -40,6 +42,7 @@ from itools.web import ItoolsView, get_context
 # Import from ikaaro
 from .autoadd import AutoAdd
 from .autoedit import AutoEdit
+from .database import get_handler_path
 from .enumerates import Groups_Datatype
 from .fields import File_Field, HTMLFile_Field, SelectAbspath_Field, UUID_Field, CTime_Field, MTime_Field, LastAuthor_Field,\
     Title_Field, Description_Field, Subject_Field, URI_Field
@@ -545,6 +548,10 @@ class DBResource(Resource):
     ########################################################################
     # Indexing
     ########################################################################
+
+    # Extract the text in the background, if enabled (see ikaaro.text_queue)
+    index_text_later = False
+
     def to_text(self):
         """This function must return:
            1) An unicode text.
@@ -556,6 +563,38 @@ class DBResource(Resource):
         return None
 
 
+    def get_text_source(self):
+        """Return the handler class and the path of the file to extract the
+        text from, in another process, or None if the text must be extracted
+        by 'to_text'.
+        """
+        return None
+
+
+    def get_fingerprint(self):
+        """Return a hash of what the text depends on: the metadata, the
+        files (their modification time and size) and the class version; or
+        None if a file has changes not yet saved.  See ikaaro.text_cache.
+
+        Override it if the text depends on other resources.
+        """
+        fingerprint = sha1()
+        fingerprint.update(f'{self.class_id}:{self.class_version}\n'.encode())
+        metadata = self.metadata.to_str()
+        if type(metadata) is str:
+            metadata = metadata.encode('utf-8')
+        fingerprint.update(metadata)
+        for handler in self.get_fields_handlers():
+            path = get_handler_path(self.database, handler)
+            if path is None:
+                return None
+            info = stat(path)
+            name = path.rsplit('/', 1)[-1]
+            fingerprint.update(
+                f'\n{name}:{info.st_mtime_ns}:{info.st_size}'.encode())
+        return fingerprint.hexdigest()
+
+
     def get_catalog_values(self):
         values = {}
         # Step 1. Automatically index fields
@@ -593,10 +632,29 @@ class DBResource(Resource):
         context = get_context()
         server = context.server
         if server and server.index_text:
-            try:
-                values['text'] = self.to_text()
-            except Exception:
-                log.error(f"Indexation failed: {abspath}", exc_info=True)
+            text_queue = server.text_queue
+            text_cache = server.text_cache
+            text = fingerprint = None
+            if text_cache:
+                fingerprint = self.get_fingerprint()
+                values['fingerprint'] = fingerprint
+                if fingerprint:
+                    text = text_cache.get(fingerprint)
+            if text is not None:
+                # Not changed since the text was extracted
+                values['text'] = text
+            elif self.index_text_later and text_queue and text_queue.add(abspath):
+                # The text will be indexed by the background queue
+                pass
+            else:
+                try:
+                    text = self.to_text()
+                except Exception:
+                    log.error(f"Indexation failed: {abspath}", exc_info=True)
+                else:
+                    values['text'] = text
+                    if fingerprint and text is not None:
+                        text_cache.set(fingerprint, text)
         # Time events for the CRON
         reminder, payload = self.next_time_event()
         values['next_time_event'] = reminder
@@ -1017,6 +1075,7 @@ register_field('links', String(multiple=True, indexed=True))
 register_field('onchange_reindex', String(multiple=True, indexed=True))
 # Full text search
 register_field('text', Unicode(indexed=True))
+register_field('fingerprint', String(stored=True))
 # Time events
 register_field('next_time_event', DateTime(stored=True))
 register_field('next_time_event_payload', String(stored=True))
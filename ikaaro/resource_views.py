@@ -42,9 +42,11 @@ from ikaaro.datatypes import FileDataType
 # Import from ikaaro
 from .autoform import AutoForm
 from .buttons import Remove_Button
+from .database import get_handler_path
 from .emails import send_email
 from .exceptions import ConsistencyError
 from .messages import MSG_LOGIN_WRONG_NAME_OR_PASSWORD
+from .responses import FileBody
 
 
 
@@ -129,8 +131,11 @@ class DBResource_GetFile(BaseView):
         disposition = 'attachment'
         filename = self.get_filename(handler, field_name, resource)
         context.set_content_disposition(disposition, filename)
-        # Ok
-        return handler.to_str()
+        # Ok: stream the file from disk (supports range requests)
+        path = get_handler_path(context.database, handler)
+        if path is None:
+            return FileBody(data=handler.to_str(), mtime=handler.get_mtime())
+        return FileBody(path=path)
 
 
 
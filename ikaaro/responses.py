@@ -0,0 +1,146 @@
+"""Response bodies that are not built in memory: files are streamed from
+disk, with support for HTTP range requests.
+"""
+
+from email.utils import formatdate, parsedate_to_datetime
+from hashlib import sha1
+from io import BytesIO
+from os import fstat
+
+# Requirements
+from starlette.responses import Response, StreamingResponse
+
+
+def parse_range(value, size):
+    """Parse the value of a Range header (single range only), return the
+    tuple (start, end) with 'end' included, None if the header must be
+    ignored, or False if the range cannot be satisfied.
+    """
+    if not value:
+        return None
+    unit, sep, ranges = value.partition('=')
+    if unit.strip().lower() != 'bytes' or not sep or ',' in ranges:
+        return None
+    start, sep, end = ranges.strip().partition('-')
+    if not sep:
+        return None
+    try:
+        if start:
+            start = int(start)
+            end = int(end) if end else None
+        elif end:
+            # Suffix range: the last N bytes
+            start = max(size - int(end), 0)
+            end = size - 1
+        else:
+            return None
+    except ValueError:
+        return None
+
+    if start < 0 or (end is not None and end < start):
+        return None
+    if start >= size:
+        return False
+    if end is None or end >= size:
+        end = size - 1
+    return start, end
+
+
+def iter_file(file, start, length, chunk_size=64 * 1024):
+    try:
+        file.seek(start)
+        while length > 0:
+            chunk = file.read(min(chunk_size, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        file.close()
+
+
+
+class FileBody:
+    """A body to be streamed from a file on disk (or from a byte string, for
+    files not yet saved).  Returned by the views instead of the data, see
+    ikaaro.asgi.prepare_response.
+    """
+
+    chunk_size = 64 * 1024
+
+    def __init__(self, path=None, data=None, mtime=None):
+        if (path is None) == (data is None):
+            raise ValueError('expected either "path" or "data"')
+        self.path = path
+        self.data = data
+        self.mtime = mtime
+        self.file = None
+
+
+    def open(self):
+        """Open the file and return its size, the modification time and the
+        ETag.  This is called while the database context is still held, the
+        open file stays readable even if a writer replaces it afterwards.
+        """
+        if self.path is None:
+            self.file = BytesIO(self.data)
+            size = len(self.data)
+            mtime = self.mtime.timestamp() if self.mtime else None
+            etag = f'"{sha1(self.data).hexdigest()}"'
+            return size, mtime, etag
+
+        self.file = open(self.path, 'rb')
+        st = fstat(self.file.fileno())
+        etag = f'"{st.st_mtime_ns:x}-{st.st_size:x}"'
+        return st.st_size, st.st_mtime, etag
+
+
+    def is_range_allowed(self, if_range, etag, mtime):
+        """The If-Range header: the range applies only if the file is still
+        the same (same ETag, or not modified since the given date).
+        """
+        if not if_range:
+            return True
+        if if_range.startswith('"') or if_range.startswith('W/'):
+            return if_range == etag
+        if mtime is None:
+            return False
+        try:
+            since = parsedate_to_datetime(if_range).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return int(mtime) <= since
+
+
+    def get_response(self, request, status_code, headers):
+        size, mtime, etag = self.open()
+        headers = { name.lower(): value for name, value in headers.items() }
+        headers['accept-ranges'] = 'bytes'
+        headers['etag'] = etag
+        if mtime is not None:
+            headers.setdefault('last-modified', formatdate(int(mtime), usegmt=True))
+
+        # Range
+        start, end = 0, size - 1
+        if status_code == 200 and request.method == 'GET':
+            request_headers = request.headers
+            byte_range = parse_range(request_headers.get('range'), size)
+            if byte_range is not None:
+                if_range = request_headers.get('if-range')
+                if not self.is_range_allowed(if_range, etag, mtime):
+                    byte_range = None
+            if byte_range is False:
+                # 416 Range Not Satisfiable
+                self.file.close()
+                headers['content-range'] = f'bytes */{size}'
+                return Response(status_code=416, headers=headers)
+            if byte_range is not None:
+                start, end = byte_range
+                status_code = 206
+                headers['content-range'] = f'bytes {start}-{end}/{size}'
+
+        length = end - start + 1 if size else 0
+        headers['content-length'] = str(length)
+        content = iter_file(self.file, start, length, self.chunk_size)
+        return StreamingResponse(content, status_code=status_code,
+                                 headers=headers)
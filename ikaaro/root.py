@@ -26,6 +26,7 @@ from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.utils import formatdate
 from logging import getLogger
+from time import time
 import importlib
 import sys
 import traceback
@@ -53,6 +54,7 @@ from .root_views import PoweredBy, ContactForm
 from .root_views import NotFoundView, ForbiddenView, NotAllowedView
 from .root_views import UploadStatsView, UpdateDocs, UnavailableView
 from .update import UpdateInstanceView
+from .walk import walk_resources
 
 log = getLogger("ikaaro")
 
@@ -291,8 +293,10 @@ class Root(Folder):
         # Standard page, wrap the content into the general template
         if is_str:
             body = XMLParser(body, doctype=xhtml_doctype)
+        t0 = time()
         context.entity = self.get_skin(context).template(body)
         context.content_type = 'text/html; charset=UTF-8'
+        context.add_timing('render', time() - t0)
 
 
     def get_available_languages(self):
@@ -505,6 +509,11 @@ class Root(Folder):
         return access.has_permission(user, permission, resource, class_id)
 
 
+    def has_permission_many(self, user, permission, paths, class_id=None):
+        access = self.get_resource('config/access')
+        return access.has_permission_many(user, permission, paths, class_id)
+
+
     def is_allowed_to_view(self, user, resource):
         return self.has_permission(user, 'view', resource)
 
@@ -568,7 +577,7 @@ class Root(Folder):
         i = 0
         context = get_context()
         context.set_mtime = False
-        for resource in self.traverse_resources():
+        for resource in walk_resources(context.database):
             if not resource.get_value('uuid'):
                 resource.set_uuid()
                 i+=1
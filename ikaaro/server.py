@@ -17,10 +17,11 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from concurrent.futures import ThreadPoolExecutor
 import datetime
 from email.parser import BytesHeaderParser
 from importlib import import_module
-from os import fdopen, getpgid, getpid, mkdir, remove, path
+from os import fdopen, getpgid, getpid, mkdir, remove, path, stat
 from os.path import join
 from signal import SIGINT, SIGTERM
 from smtplib import SMTP, SMTPRecipientsRefused, SMTPResponseException
@@ -46,8 +47,7 @@ import uvicorn
 # Import from itools
 from itools.core import vmsize
 from itools.database import Metadata, RangeQuery
-from itools.database import make_database, get_register_fields
-from itools.database.backends.catalog import make_catalog
+from itools.database import make_database
 from itools.datatypes import Boolean, Email, Integer, String, Tokens
 from itools.fs import lfs
 from itools.handlers import ConfigFile
@@ -56,12 +56,23 @@ from itools.uri import get_reference, Path
 from itools.web.dispatcher import URIDispatcher
 
 # Import from ikaaro.web
-from .database import get_database
+from .check import OnlineCheck
+from .database import Database, get_database
 from .datatypes import ExpireValue
+from .group_commit import GroupCommit
 from .log import config_logging
+from .metrics import Metrics
+from .page_cache import PageCache
+from .reindex import OnlineReindex, index_resources, open_new_catalog
+from .reindex import reindex_parallel, reindex_subset
+from .text_cache import TextCache
+from .text_queue import TextQueue
+from .tokens import VerifiedTokens
 from .views import CachedStaticView
 from .skins import skin_registry
+from .static import StaticFiles
 from .views import IkaaroStaticView
+from .workers import get_generation_path, get_writer_socket, read_generation
 
 
 log_ikaaro = logging.getLogger("ikaaro")
@@ -141,12 +152,77 @@ session-timeout = 0
 database-size = {size_min}:{size_max}
 database-readonly = 0
 
+# The "request-executor" variable defines where read-only requests (GET and
+# OPTIONS) are handled.  With the value 'inline' (the default) they run on
+# the event loop.  With the value 'threads:N' they run in a pool of N worker
+# threads, so a slow page does not stall the event loop: the static files,
+# the uploads and the cached pages are still served.  The database is not
+# thread-safe, so the handlers still run one at a time: a page that is not
+# cached waits for the slow one.  Read-write requests always run on the
+# event loop.
+#
+request-executor = inline
+
+# The "group-commit-delay" variable, in milliseconds, enables the group
+# commit: the changes of the write requests received within this delay are
+# saved together, with one git commit, the requests wait for it before
+# responding.  The "group-commit-size" variable defines the maximum number of
+# requests saved together.  By default the delay is 0 (disabled).
+#
+group-commit-delay = 0
+group-commit-size = 20
+
+# The "page-cache" variable defines the number of pages kept in the cache of
+# anonymous pages.  The GET requests of anonymous users are served from this
+# cache, pages are removed when the resources they show change.  By default
+# it is 0 (no cache).  Only the page of the resource that changed (and of its
+# ancestors and descendants) is removed: the pages that list or search other
+# resources stay stale until they expire, after "page-cache-ttl" seconds (0
+# for never).
+#
+page-cache = 0
+page-cache-ttl = 300
+
+# The "slow-request-time" variable defines a threshold, in milliseconds: the
+# requests slower than this are logged in the events log, with the number
+# and duration of the catalog searches, resource and handler loads, and
+# ACL checks they did.  By default it is 0 (disabled).
+#
+slow-request-time = 0
+
+# The "jwt-algorithm" variable defines the algorithm used to sign the JSON
+# Web Tokens: RS512 (the default), ES256 or EdDSA.  The last two are much
+# cheaper to verify.  After a change, the tokens signed with RS512 are still
+# accepted until they expire.
+#
+jwt-algorithm = RS512
+
 # The "index-text" variable defines whether the catalog must process full-text
 # indexing. It requires (much) more time and third-party applications.
 # To speed up catalog updates, set this option to 0 (default is 1).
 #
 index-text = 1
 
+# The "text-workers" variable defines the number of processes extracting the
+# text of the files (office documents, PDF, etc.) in the background: the
+# commit indexes the other fields and the text is indexed a bit later.  By
+# default it is 0, the text is extracted during the commit.
+#
+text-workers = 0
+
+# The "text-cache" variable enables the cache of the text extracted from the
+# resources ({target}/text-cache.db): the text of the resources that have not
+# changed is not extracted again, for example when the catalog is rebuilt.
+# By default it is 0 (disabled).
+#
+text-cache = 0
+
+# The "max-upload-size" variable defines the maximum size, in megabytes, of
+# the body of a multipart request (file uploads): larger uploads are refused
+# before they are received.  By default it is 0 (no limit).
+#
+max-upload-size = 0
+
 # The "accept-cors" variable defines whether the web server accept
 # cross origin requests or not.
 # To accept cross origin requests, set this option to 1 (default is 1)
@@ -185,6 +261,33 @@ def load_modules(config):
         __import__(name)
 
 
+# The type of the key for every algorithm supported to sign the JWT
+JWT_key_types = {
+    'RS512': ('RSA', {'size': 4096}),
+    'ES256': ('EC', {'crv': 'P-256'}),
+    'EdDSA': ('OKP', {'crv': 'Ed25519'}),
+}
+
+
+def make_request_executor(value):
+    """Build the executor used to handle read-only requests, from the
+    "request-executor" configuration variable.  Return None for the 'inline'
+    mode.
+    """
+    value = (value or 'inline').strip()
+    if value == 'inline':
+        return None
+
+    kind, sep, size = value.partition(':')
+    if kind != 'threads':
+        raise ValueError(f'unexpected request-executor "{value}"')
+    size = int(size) if sep else None
+    if size is not None and size < 1:
+        raise ValueError(f'unexpected request-executor "{value}"')
+    return ThreadPoolExecutor(max_workers=size,
+                              thread_name_prefix='ikaaro-request')
+
+
 def get_pid(target):
     try:
         pid = open(target).read()
@@ -331,13 +434,32 @@ class Server:
     asgi_server = None
     cron_statistics = {}
     log_level = None
-
-
-    def __init__(self, target, read_only=False, cache_size=None, port=None):
+    request_executor = None
+    page_cache = None
+    text_queue = None
+    text_cache = None
+    # The rebuild of the catalog while running (see ikaaro.reindex)
+    catalog_reindex = None
+    catalog_check = None
+    slow_request_time = 0
+    max_upload_size = 0
+    # The JWT keys, and their thumbprints (see get_JWT_key_ids)
+    JWT_keys_seen = None
+    JWT_key_ids = None
+    # Multi-process mode (see ikaaro.workers)
+    worker_role = None
+    writer_address = None
+    generation_path = None
+    # The database generation when the catalog was last reopened
+    database_generation = None
+
+
+    def __init__(self, target, read_only=False, cache_size=None, port=None,
+                 timestamp=None):
         set_server(self)
 
         # Set instance variables
-        self.timestamp = str(int(time() / 2))
+        self.timestamp = timestamp or str(int(time() / 2))
         self.target = lfs.get_absolute_path(target)
         self.read_only = read_only
         # Load the config
@@ -358,9 +480,26 @@ class Server:
 
         # Full-text indexing
         self.index_text = config.get_value('index-text', type=Boolean, default=True)
+        text_workers = config.get_value('text-workers')
+        if self.index_text and text_workers:
+            self.text_queue = TextQueue(self, text_workers)
+        if self.index_text and config.get_value('text-cache'):
+            self.text_cache = TextCache(f'{self.target}/text-cache.db')
         # Accept cors
         self.accept_cors = config.get_value(
             'accept-cors', type=Boolean, default=False)
+        # Where to handle read-only requests
+        self.request_executor = make_request_executor(
+            config.get_value('request-executor'))
+        # Log the requests slower than this (in milliseconds)
+        self.slow_request_time = config.get_value('slow-request-time')
+        # Refuse the uploads larger than this (in bytes)
+        self.max_upload_size = config.get_value('max-upload-size') * 1024 * 1024
+        # Cache of anonymous pages
+        page_cache = config.get_value('page-cache')
+        page_cache_ttl = config.get_value('page-cache-ttl')
+        self.page_cache = (PageCache(page_cache, page_cache_ttl)
+                           if page_cache else None)
 
         # The database
         if cache_size is None:
@@ -374,6 +513,23 @@ class Server:
         # Get database
         database = get_database(target, size_min, size_max, read_only)
         self.database = database
+        # Save the changes of several requests together
+        delay = config.get_value('group-commit-delay')
+        if delay and isinstance(database, Database):
+            database.group_commit = GroupCommit(
+                database, delay / 1000, config.get_value('group-commit-size'))
+        self.database_size = (size_min, size_max)
+        # Runtime metrics (see ApiDevPanel_Metrics)
+        self.metrics = Metrics()
+        for mode, histogram in database.lock.wait_histograms.items():
+            self.metrics.add_histogram(
+                'ikaaro_lock_wait_seconds',
+                'Time spent waiting for the database lock', histogram,
+                mode=mode)
+        if isinstance(database, Database):
+            self.metrics.add_histogram(
+                'ikaaro_commit_duration_seconds', 'Time spent committing',
+                database.commit_histogram)
         # Find out the root class
         root = get_root(database)
         self.root = root
@@ -403,9 +559,21 @@ class Server:
         # Session timeout
         self.session_timeout = get_value('session-timeout')
         # Register routes
+        self.static_files = StaticFiles()
         self.register_dispatch_routes()
-        # Register JWT key
-        self.JWK_SECRET = self.get_JWT_key()
+        # Register JWT keys: the key of the configured algorithm signs the
+        # new tokens, the keys of the former algorithms are kept to verify
+        # the tokens they signed
+        algorithm = config.get_value('jwt-algorithm')
+        if algorithm not in JWT_key_types:
+            raise ValueError(f'unexpected jwt-algorithm "{algorithm}"')
+        self.JWT_algorithm = algorithm
+        self.JWK_SECRET = self.get_JWT_key(algorithm)
+        self.JWT_former_keys = [
+            (name, self.get_JWT_key(name)) for name in JWT_key_types
+            if name != algorithm and lfs.exists(self.get_JWT_key_path(name))]
+        # Tokens already verified
+        self.JWT_tokens = VerifiedTokens()
 
 
     def set_log_level(self, log_level):
@@ -413,13 +581,15 @@ class Server:
         config_logging(logdir, log_level)
         self.log_level = log_level
 
-    def get_JWT_key_path(self):
+    def get_JWT_key_path(self, algorithm='RS512'):
         target = self.target
-        return path.join(target, "jwt_key.PEM")
+        if algorithm == 'RS512':
+            return path.join(target, "jwt_key.PEM")
+        return path.join(target, f"jwt_key_{algorithm.lower()}.PEM")
 
 
-    def get_JWT_key(self):
-        key_path = self.get_JWT_key_path()
+    def get_JWT_key(self, algorithm='RS512'):
+        key_path = self.get_JWT_key_path(algorithm)
         try:
             with open(key_path, mode="rb") as key_file:
                 lines = key_file.readlines()
@@ -427,20 +597,38 @@ class Server:
                 jwk = JWK.from_pem(key_pem_string)
         except OSError:
             # No pem file found generating one
-            jwk = self.generate_JWT_key()
-            self.save_JWT_key(jwk)
+            jwk = self.generate_JWT_key(algorithm)
+            self.save_JWT_key(jwk, algorithm)
         return jwk
 
 
-    def save_JWT_key(self, jwk):
-        key_path = self.get_JWT_key_path()
+    def get_JWT_keys(self):
+        """Return the list of (algorithm, key) accepted to verify tokens.
+        """
+        return [(self.JWT_algorithm, self.JWK_SECRET)] + self.JWT_former_keys
+
+
+    def get_JWT_key_ids(self):
+        """Return the thumbprints of the keys accepted to verify tokens, they
+        change when a key is rotated (see VerifiedTokens).
+        """
+        keys = self.get_JWT_keys()
+        if keys != self.JWT_keys_seen:
+            self.JWT_keys_seen = list(keys)
+            self.JWT_key_ids = [ key.thumbprint() for algorithm, key in keys ]
+        return self.JWT_key_ids
+
+
+    def save_JWT_key(self, jwk, algorithm='RS512'):
+        key_path = self.get_JWT_key_path(algorithm)
         with open(key_path, mode="wb") as key_file:
             key_pem_string = jwk.export_to_pem(private_key=True, password=None)
             key_file.write(key_pem_string)
 
 
-    def generate_JWT_key(self):
-        jwk = JWK(generate="RSA", size=4096)
+    def generate_JWT_key(self, algorithm='RS512'):
+        kty, kw = JWT_key_types[algorithm]
+        jwk = JWK(generate=kty, **kw)
         return jwk
 
 
@@ -460,10 +648,77 @@ class Server:
             self.launch_cron()
 
 
+    def set_worker_role(self, role):
+        """Configure the server as a worker of the multi-process mode, role
+        is either 'writer' or 'reader'.
+        """
+        generation_path = get_generation_path(self.target)
+        if role == 'writer':
+            if self.read_only:
+                raise ValueError('the writer cannot be read-only')
+            database = self.database
+            database.generation = read_generation(generation_path)
+            database.generation_path = generation_path
+        elif role == 'reader':
+            if not self.read_only:
+                raise ValueError('readers must be read-only')
+            self.writer_address = get_writer_socket(self.target)
+            self.generation_path = generation_path
+        else:
+            raise ValueError(f'unexpected worker role "{role}"')
+        self.worker_role = role
+
+
+    def get_database_generation(self):
+        """Return a value that changes every time the database is committed.
+        """
+        # Read-write: our own commits
+        database = self.database
+        if isinstance(database, Database):
+            return database.generation
+
+        # Read-only worker: the writer publishes its generation
+        if self.generation_path:
+            return read_generation(self.generation_path)
+
+        # Read-only replica: watch the catalog version file and the git HEAD
+        target = self.target
+        paths = [f'{target}/catalog/iamglass', f'{target}/catalog/iamchert']
+        git_path = f'{target}/database/.git'
+        try:
+            with open(f'{git_path}/HEAD') as file:
+                head = file.read().strip()
+        except OSError:
+            pass
+        else:
+            if head.startswith('ref: '):
+                paths.append(f'{git_path}/{head[5:]}')
+            paths.append(f'{git_path}/HEAD')
+
+        generation = []
+        for filename in paths:
+            try:
+                st = stat(filename)
+            except OSError:
+                continue
+            generation.append((st.st_mtime_ns, st.st_size))
+        return tuple(generation)
+
+
     def get_database(self):
         database = self.database
-        # Reopen so if we have one readonly request it will works
-        database.backend.catalog._db.reopen()
+        # Reopen the catalog only if the database has changed since the
+        # last time, so that read-only requests see the last commit
+        generation = self.get_database_generation()
+        if generation != self.database_generation:
+            if not isinstance(database, Database):
+                # Changed by another process, drop the stale handlers too
+                database.drop_cache()
+                if self.page_cache:
+                    self.page_cache.clear()
+            else:
+                database.backend.catalog._db.reopen()
+            self.database_generation = generation
         # Ok
         return database
 
@@ -482,7 +737,11 @@ class Server:
         return True
 
 
-    async def start(self):
+    async def start(self, fd=None, uds=None):
+        """Start the web server.  By default it listens on the configured
+        address and port, the worker processes of the multi-process mode
+        listen either on an inherited socket (fd) or on a unix socket (uds).
+        """
         target = pathlib.Path(self.target)
 
         # Find out the IP to listen to
@@ -494,8 +753,10 @@ class Server:
             raise ValueError('listen-port is missing from config.conf')
 
         # Save PID (XXX Remove: do with gunicorn/supervisor/etc)
-        pid = getpid()
-        (target / 'pid').write_text(str(pid))
+        # Workers do not, the supervisor does
+        if self.worker_role is None:
+            pid = getpid()
+            (target / 'pid').write_text(str(pid))
 
         # Call method on root at start
         async with self.database.init_context() as context:
@@ -503,6 +764,8 @@ class Server:
 
         if not self.read_only:
             await self.launch_cron()
+            if self.text_queue:
+                self.text_queue.start()
 
         # Listen & set context
         port = self.port
@@ -526,10 +789,14 @@ class Server:
         }
 
         # Create server config
+        if uds and lfs.exists(uds):
+            remove(uds)
         server_config = uvicorn.Config(
             app=app,
             host=address,
             port=port,
+            fd=fd,
+            uds=uds,
             #http=CustomH11Protocol,
             log_config=logging_config,
             # Additional uvicorn config options can go here
@@ -561,51 +828,50 @@ class Server:
             self.cron_statistics['started'] = False
 
 
-    async def reindex_catalog(self, quiet=False, quick=False, as_test=False):
+    async def reindex_catalog(self, quiet=False, quick=False, as_test=False,
+                              jobs=1, resume=False, only_path=None,
+                              only_classes=None):
         # FIXME: should be moved into backend
         log_ikaaro.info('Reindex catalog')
         # Set log level as INFO
         log_level = self.log_level
         self.set_log_level('INFO')
-        # Database is opend as RW ?
-        if self.is_running_in_rw_mode():
-            log_ikaaro.error("Cannot proceed, the server is running in read-write mode.")
+        # A server is running on the database, read-write ?
+        if self.is_running() and not self.config.get_value('database-readonly'):
+            log_ikaaro.error("Cannot proceed, the server is running in read-write mode."
+                             " Use the online reindex: POST /api/devpanel/catalog/reindex")
             return
-        # Create a temporary new catalog
+
+        # Reindex a part, into the current catalog
+        if only_path or only_classes:
+            t0 = time()
+            error_detected = await reindex_subset(
+                self.database, only_path or '/', only_classes, quiet=quiet,
+                as_test=as_test)
+            if error_detected:
+                log_ikaaro.error("[Update] Error(s) detected, the catalog was NOT changed")
+            else:
+                log_ikaaro.info(f"[Update] Time: {time() - t0:.02f} seconds.")
+            self.set_log_level(log_level)
+            return not error_detected
+
+        # Create a temporary new catalog (or resume)
         catalog_path = f'{self.target}/catalog.new'
-        if lfs.exists(catalog_path):
-            lfs.remove(catalog_path)
-        catalog = make_catalog(catalog_path, get_register_fields())
-        # Get the root
-        root = self.root
+        checkpoint = None
         # Update
         t0, v0 = time(), vmsize()
-        doc_n = 0
-        error_detected = False
-        nb_docs = self.database.get_nb_metadatas()
-        async with self.database.init_context() as context:
-            for obj in root.traverse_resources():
-                display_more_details = doc_n % 10000 == 0
-                if not quiet or display_more_details:
-                    log_ikaaro.info(f'{doc_n}/{nb_docs} - {obj.abspath}')
-                    if display_more_details:
-                        percent = int((doc_n / nb_docs) * 100)
-                        log_ikaaro.info(f'Progress reindex: {percent}%')
-                doc_n += 1
-                context.resource = obj
-                values = obj.get_catalog_values()
-                # Index the document
-                try:
-                    catalog.index_document(values)
-                except Exception:
-                    if as_test:
-                        error_detected = True
-                        log_ikaaro.error(f"Error, Abspath of the resource: {str(obj.abspath)}")
-                    else:
-                        raise
-                # Free Memory
-                del obj
-                self.database.make_room()
+        if jobs > 1:
+            # Several processes, they build the new catalog
+            catalog = None
+            error_detected = await reindex_parallel(
+                self, catalog_path, jobs, quiet=quiet, as_test=as_test,
+                resume=resume)
+        else:
+            catalog, checkpoint, state = open_new_catalog(catalog_path, resume)
+            nb_docs = self.database.get_nb_metadatas()
+            error_detected = await index_resources(
+                self.database, catalog, nb_docs, quiet=quiet, as_test=as_test,
+                checkpoint=checkpoint, state=state)
 
         if not error_detected:
             if as_test:
@@ -618,13 +884,19 @@ class Server:
             log_ikaaro.info(f"[Update] Time: {t1 - t0:.02f} seconds. Memory: {v} Kb")
             # Commit
             log_ikaaro.info("[Commit]")
-            catalog.save_changes()
-            catalog.close()
+            if catalog is not None:
+                catalog.save_changes()
+                catalog.close()
             # Commit / Replace
             old_catalog_path = f'{self.target}/catalog'
             if lfs.exists(old_catalog_path):
                 lfs.remove(old_catalog_path)
             lfs.move(catalog_path, old_catalog_path)
+            if checkpoint:
+                checkpoint.remove()
+            # The text of the resources removed or changed
+            if self.text_cache and not resume:
+                self.text_cache.prune(t0)
             # Commit / Report
             t2, v2 = time(), vmsize()
             v = (v2 - v1)/1024
@@ -663,6 +935,13 @@ class Server:
 
     def close(self):
         log_ikaaro.info("Close server")
+        if self.request_executor:
+            self.request_executor.shutdown(wait=True)
+            self.request_executor = None
+        if self.text_queue:
+            self.text_queue.stop()
+        if self.text_cache:
+            self.text_cache.close()
         self.database.close()
 
 
@@ -688,6 +967,33 @@ class Server:
             raise NotImplementedError
 
 
+    def start_catalog_reindex(self):
+        """Rebuild the catalog in the background, return the rebuild (the
+        one running if any).  Raise ValueError if the database is read-only.
+        """
+        if self.read_only:
+            raise ValueError('the database is read-only')
+        reindex = self.catalog_reindex
+        if reindex is None or not reindex.running:
+            reindex = self.catalog_reindex = OnlineReindex(self)
+            reindex.start()
+        return reindex
+
+
+    def start_catalog_check(self):
+        """Check and repair the catalog in the background, return the check
+        (the one running if any).  Raise ValueError if the database is
+        read-only.
+        """
+        if self.read_only:
+            raise ValueError('the database is read-only')
+        check = self.catalog_check
+        if check is None or not check.running:
+            check = self.catalog_check = OnlineCheck(self)
+            check.start()
+        return check
+
+
     #######################################################################
     # Mailing
     #######################################################################
@@ -821,9 +1127,12 @@ class Server:
             skin_key = skin.get_environment_key(self)
             view = IkaaroStaticView(local_path=skin_key, mount_path=mount_path)
             self.dispatcher.add('/ui/%s/{name:any}' % name, view)
+            self.static_files.mount(mount_path, skin_key, fallback=skin.key)
             mount_path = f'/ui/cached/{ts}/{name}'
             view = CachedStaticView(local_path=skin_key, mount_path=mount_path)
             self.dispatcher.add('/ui/cached/{}/{}/{{name:any}}'.format(ts, name), view)
+            self.static_files.mount(mount_path, skin_key, cached=True,
+                                    fallback=skin.key)
 
 
     def register_urlpatterns_from_package(self, package):
@@ -951,7 +1260,17 @@ class ServerConfig(ConfigFile):
         # Tuning
         'database-size': String(default='19500:20500'),
         'database-readonly': Boolean(default=False),
+        'request-executor': String(default='inline'),
+        'group-commit-delay': Integer(default=0),
+        'group-commit-size': Integer(default=20),
+        'page-cache': Integer(default=0),
+        'page-cache-ttl': Integer(default=300),
+        'slow-request-time': Integer(default=0),
+        'jwt-algorithm': String(default='RS512'),
         'index-text': Boolean(default=True),
+        'text-workers': Integer(default=0),
+        'text-cache': Boolean(default=False),
+        'max-upload-size': Integer(default=0),
         'max-width': Integer(default=None),
         'max-height': Integer(default=None),
         'accept-cors': Integer(default=1),
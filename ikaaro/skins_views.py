@@ -101,13 +101,20 @@ class LocationTemplate(CMSTemplate):
             'name': title,
             'short_name': reduce_string(title, 15, 30)}]
 
-        # Complete the breadcrumb
+        # The resources, check the access to all of them with one search
+        resources = []
         resource = root
         for name in context.uri.path:
-            path = path + f'{name}/'
             resource = resource.get_resource(name, soft=True)
             if resource is None:
                 break
+            resources.append((name, resource))
+        paths = [ x.abspath for name, x in resources ]
+        root.has_permission_many(context.user, 'view', paths)
+
+        # Complete the breadcrumb
+        for name, resource in resources:
+            path = path + f'{name}/'
             # Display resource title only if allowed
             if not root.is_allowed_to_view(context.user, resource):
                 title = name
@@ -0,0 +1,193 @@
+"""Serve the skins files (/ui/...) straight from Starlette, without
+acquiring a database context.
+"""
+
+from email.utils import formatdate, parsedate_to_datetime
+from os import stat
+from os.path import basename, isfile, join, normpath, sep
+import logging
+
+# Requirements
+from starlette.responses import FileResponse, Response
+
+# Import from itools
+from itools.fs import lfs
+from itools.fs.common import get_mimetype
+from itools.i18n import AcceptLanguageType, has_language
+
+
+log = logging.getLogger("ikaaro.web")
+
+
+class StaticFile:
+    """What we keep in memory about a static file.
+    """
+
+    def __init__(self, path, st, data=None):
+        self.path = path
+        self.mtime = st.st_mtime
+        self.mtime_ns = st.st_mtime_ns
+        self.size = st.st_size
+        self.data = data
+        # Guessed from the name, the file is not loaded (it may be large)
+        self.mimetype = get_mimetype(basename(path))
+        self.etag = f'"{st.st_mtime_ns:x}-{st.st_size:x}"'
+        self.last_modified = formatdate(int(st.st_mtime), usegmt=True)
+
+
+
+class StaticFiles:
+    """Registry of the mount points of the skins, with a cache of the files
+    served (small files are kept in memory, large files are sent from disk).
+    """
+
+    # Files bigger than this (in bytes) are not kept in memory
+    max_cached_size = 256 * 1024
+    # Cache-Control for the URLs that include the server's timestamp
+    cached_max_age = 315360000
+
+
+    def __init__(self):
+        self.mounts = {}  # {mount_path: ([local_path, ...], cached)}
+        self.files = {}   # {local_path: StaticFile}
+
+
+    def mount(self, mount_path, local_path, cached=False, fallback=None):
+        """Serve the files of the folder 'local_path' at 'mount_path'.  The
+        files not found there are looked for in the folder 'fallback' (as
+        the development skin falls back to the standard skin).
+        """
+        local_paths = [local_path.rstrip('/')]
+        if fallback and fallback.rstrip('/') != local_paths[0]:
+            local_paths.append(fallback.rstrip('/'))
+        self.mounts[mount_path.rstrip('/')] = (local_paths, cached)
+
+
+    def resolve(self, path):
+        """Return the local paths to try, in order (empty if the path is out
+        of the mounted folders), and whether the response can be cached
+        forever; or None if the path is not mounted.
+        """
+        mount_path = path
+        while mount_path:
+            mount_path = mount_path.rsplit('/', 1)[0]
+            mount = self.mounts.get(mount_path)
+            if mount is None:
+                continue
+            local_paths, cached = mount
+            name = path[len(mount_path):].lstrip('/')
+            candidates = []
+            for local_path in local_paths:
+                local = normpath(join(local_path, name))
+                # Security: do not go out of the mount point
+                if local.startswith(local_path + sep):
+                    candidates.append(local)
+            return candidates, cached
+        return None, False
+
+
+    def find(self, candidates, accept_language):
+        """Return the first file found: the exact match, or the best
+        language variant, of every candidate in order.
+        """
+        for local_path in candidates:
+            if isfile(local_path):
+                return local_path
+            local_path = self.negotiate(local_path, accept_language)
+            if local_path is not None and isfile(local_path):
+                return local_path
+        return None
+
+
+    def negotiate(self, local_path, accept_language):
+        """Language negotiation: find the best variant of 'local_path' (e.g.
+        'template.xml.fr' for 'template.xml').
+        """
+        folder_path, name = local_path.rsplit('/', 1)
+        if not lfs.exists(folder_path):
+            return None
+        name = name + '.'
+        n = len(name)
+        languages = [ x[n:] for x in lfs.get_names(folder_path)
+                      if x[:n] == name and has_language(x[n:]) ]
+        if not languages:
+            return None
+        try:
+            accept = AcceptLanguageType.decode(accept_language)
+        except Exception:
+            accept = AcceptLanguageType.decode('')
+        language = accept.select_language(languages) or languages[0]
+        return f'{local_path}.{language}'
+
+
+    def get_file(self, local_path):
+        try:
+            st = stat(local_path)
+        except OSError:
+            return None
+
+        file = self.files.get(local_path)
+        if file and file.mtime_ns == st.st_mtime_ns and file.size == st.st_size:
+            return file
+
+        # Load
+        data = None
+        if st.st_size <= self.max_cached_size:
+            with open(local_path, 'rb') as f:
+                data = f.read()
+        file = StaticFile(local_path, st, data)
+        self.files[local_path] = file
+        return file
+
+
+    def is_not_modified(self, file, headers):
+        etag = headers.get('if-none-match')
+        if etag is not None:
+            etags = [ x.strip() for x in etag.split(',') ]
+            return file.etag in etags or '*' in etags
+        since = headers.get('if-modified-since')
+        if since:
+            try:
+                since = parsedate_to_datetime(since).timestamp()
+            except (TypeError, ValueError):
+                return False
+            return int(file.mtime) <= since
+        return False
+
+
+    def get_response(self, request):
+        """Return the response for the given request, or None if the path
+        is not in a mounted folder.
+        """
+        candidates, cached = self.resolve(request.url.path)
+        if candidates is None:
+            return None
+
+        headers = request.headers
+        local_path = self.find(candidates, headers.get('accept-language', ''))
+        if local_path is None:
+            return Response('404 Not Found', status_code=404,
+                            media_type='text/plain')
+
+        file = self.get_file(local_path)
+        if file is None:
+            return Response('404 Not Found', status_code=404,
+                            media_type='text/plain')
+
+        # Headers
+        response_headers = {'etag': file.etag,
+                            'last-modified': file.last_modified}
+        if cached:
+            response_headers['cache-control'] = f'max-age={self.cached_max_age}'
+
+        # 304 Not Modified
+        if self.is_not_modified(file, headers):
+            return Response(status_code=304, headers=response_headers)
+
+        # 200 Ok
+        if file.data is None:
+            return FileResponse(file.path, headers=response_headers,
+                                media_type=file.mimetype,
+                                stat_result=stat(file.path))
+        return Response(file.data, headers=response_headers,
+                        media_type=file.mimetype)
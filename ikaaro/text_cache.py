@@ -0,0 +1,133 @@
+"""Cache of the full text extracted from the resources.
+
+The text of a resource is stored with its fingerprint (see
+DBResource.get_fingerprint), a hash of the metadata, of the files and of the
+class version.  When the catalog values of a resource are computed again, and
+the resource has not changed, the text is taken from the cache instead of
+being extracted again: a rebuild of the catalog only extracts the text of
+the resources changed since the previous rebuild.
+
+The cache is a SQLite database ({target}/text-cache.db), so it is shared by
+the worker processes of a rebuild; every thread has its own connection.
+Every entry records the last time it was used, the hits are kept in memory
+and written by batches; the entries not used by a full rebuild are removed
+at its end (prune).  See the "text-cache" configuration variable.
+"""
+
+from logging import getLogger
+from os import getpid
+from threading import Lock, local
+from time import time
+import json
+import sqlite3
+
+
+log = getLogger("ikaaro")
+
+
+class TextCache:
+
+    # Number of hits kept in memory before they are written
+    used_size = 1000
+
+    def __init__(self, path):
+        self.path = path
+        self.local = local()
+        self.connections = []  # [(pid, connection)], to close them
+        self.lock = Lock()
+        self.used = {}  # {fingerprint: time}, the hits not written yet
+        # Stats
+        self.hits = 0
+        self.misses = 0
+
+
+    def connect(self):
+        # One connection per thread, and per process
+        pid = getpid()
+        state = self.local
+        if getattr(state, 'pid', None) != pid:
+            # Closed from any thread (see close), used by this one only
+            connection = sqlite3.connect(self.path, timeout=60,
+                                         isolation_level=None,
+                                         check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS text ('
+                ' fingerprint TEXT PRIMARY KEY, value TEXT, used REAL)')
+            state.connection = connection
+            state.pid = pid
+            with self.lock:
+                self.connections.append((pid, connection))
+        return state.connection
+
+
+    def close(self):
+        self.flush()
+        pid = getpid()
+        with self.lock:
+            connections, self.connections = self.connections, []
+        for connection_pid, connection in connections:
+            if connection_pid == pid:
+                connection.close()
+        self.local = local()
+
+
+    def flush(self):
+        """Write the last time the entries were used.
+        """
+        with self.lock:
+            used, self.used = self.used, {}
+        if not used:
+            return
+        connection = self.connect()
+        connection.execute('BEGIN')
+        try:
+            connection.executemany(
+                'UPDATE text SET used = ? WHERE fingerprint = ?',
+                [ (t, x) for x, t in used.items() ])
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+
+    def get(self, fingerprint):
+        """Return the text of the given fingerprint, or None if not in the
+        cache.
+        """
+        connection = self.connect()
+        row = connection.execute(
+            'SELECT value FROM text WHERE fingerprint = ?',
+            (fingerprint,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        with self.lock:
+            self.used[fingerprint] = time()
+            flush = len(self.used) >= self.used_size
+        if flush:
+            self.flush()
+        return json.loads(row[0])
+
+
+    def set(self, fingerprint, text):
+        """Store the text (a string, or a dict {language: string}).
+        """
+        self.connect().execute(
+            'INSERT OR REPLACE INTO text VALUES (?, ?, ?)',
+            (fingerprint, json.dumps(text), time()))
+
+
+    def prune(self, before):
+        """Remove the entries not used since the given time, return their
+        number.
+        """
+        self.flush()
+        cursor = self.connect().execute('DELETE FROM text WHERE used < ?',
+                                        (before,))
+        n = cursor.rowcount
+        log.info(f'Text cache: {n} entries removed')
+        return n
@@ -0,0 +1,180 @@
+"""Full-text extraction in the background.
+
+Extracting the text of office and PDF documents is slow, so it is not done
+during the commit: DBResource.get_catalog_values indexes the other fields
+and adds the path of the resource to the queue, then a background task
+extracts the text (in a pool of processes) and updates the catalog in small
+batches.  See the "text-workers" configuration variable.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import asyncio
+import logging
+
+
+log = logging.getLogger("ikaaro.web")
+
+
+def extract_text(handler_class, path):
+    """Run in the worker processes: load the handler from the given file and
+    return its text.
+    """
+    return handler_class(path).to_text()
+
+
+
+class TextQueue:
+
+    # Number of resources reindexed per catalog commit
+    batch_size = 20
+
+    def __init__(self, server, nb_workers):
+        self.server = server
+        self.nb_workers = nb_workers
+        self.paths = {}      # Paths waiting, in order
+        self.enabled = False
+        self.indexing = False
+        self.pool = None
+        self.task = None
+        self.event = None
+
+
+    def enable(self):
+        """From now on the text is extracted in the background.  Without a
+        running task (see start) the queue is processed by drain.
+        """
+        self.enabled = True
+
+
+    def start(self):
+        self.enable()
+        self.event = asyncio.Event()
+        self.task = asyncio.create_task(self.run())
+
+
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+        if self.pool:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+        if self.paths:
+            log.warning(f'The text of {len(self.paths)} resources has not'
+                        ' been indexed, reindex the catalog')
+
+
+    def add(self, path):
+        """Add the given path to the queue, return False if the text must be
+        extracted now.
+        """
+        if not self.enabled:
+            return False
+        if self.indexing:
+            # Called by process, that sets the text itself
+            return True
+        self.paths[path] = None
+        if self.event:
+            self.event.set()
+        return True
+
+
+    async def run(self):
+        while True:
+            await self.event.wait()
+            self.event.clear()
+            try:
+                await self.drain()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.error('Text extraction failed', exc_info=True)
+
+
+    async def drain(self):
+        """Process the queue until it is empty.
+        """
+        while self.paths:
+            paths = list(self.paths)[:self.batch_size]
+            for path in paths:
+                del self.paths[path]
+            await self.process(paths)
+
+
+    async def extract(self, sources):
+        """Extract the text of the files in the process pool, 'sources' is a
+        dict {path: (handler_class, file_path)}.
+        """
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(max_workers=self.nb_workers)
+        loop = asyncio.get_running_loop()
+        futures = {
+            path: loop.run_in_executor(self.pool, extract_text, *source)
+            for path, source in sources.items() }
+
+        texts = {}
+        for path, future in futures.items():
+            try:
+                texts[path] = await future
+            except Exception:
+                log.error(f"Indexation failed: {path}", exc_info=True)
+                texts[path] = None
+        return texts
+
+
+    async def process(self, paths):
+        database = self.server.database
+
+        # 1. Find out the files to read (read lock)
+        sources = {}
+        async with database.init_context(read_only=True, commit_at_exit=False):
+            for path in paths:
+                resource = database.get_resource(path, soft=True)
+                if resource is not None:
+                    sources[path] = resource.get_text_source()
+
+        # 2. Extract the text, without lock
+        texts = await self.extract(
+            { x: y for x, y in sources.items() if y is not None })
+
+        # 3. Update the catalog (write lock)
+        async with database.init_context(commit_at_exit=False):
+            catalog = database.catalog
+            indexed = []
+            self.indexing = True
+            try:
+                for path in sources:
+                    if path in self.paths:
+                        # Changed again meanwhile, will be processed later
+                        continue
+                    resource = database.get_resource(path, soft=True)
+                    if resource is None:
+                        continue
+                    values = resource.get_catalog_values()
+                    if path in texts:
+                        text = texts[path]
+                    else:
+                        # Not from a file, extract it here
+                        try:
+                            text = resource.to_text()
+                        except Exception:
+                            log.error(f"Indexation failed: {path}",
+                                      exc_info=True)
+                            text = None
+                    if text is not None:
+                        values['text'] = text
+                        fingerprint = values.get('fingerprint')
+                        if fingerprint:
+                            self.server.text_cache.set(fingerprint, text)
+                    catalog.index_document(values)
+                    if database.shadow_catalog is not None:
+                        database.shadow_catalog.index_document(values)
+                    indexed.append(path)
+            finally:
+                self.indexing = False
+            if not indexed:
+                return
+            catalog.save_changes()
+            database.catalog_changed()
+            if self.server.page_cache:
+                self.server.page_cache.invalidate(indexed)
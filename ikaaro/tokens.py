@@ -0,0 +1,61 @@
+"""Cache of the JSON Web Tokens already verified, so the signature of a
+token is checked once and not on every request (see CMSContext.get_JWT_claims).
+"""
+
+from collections import OrderedDict
+from hashlib import sha256
+from time import time
+
+
+class VerifiedTokens:
+    """LRU cache mapping the digest of a verified token to its claims.  The
+    entries expire with the token ('exp' claim), and the whole cache is
+    flushed when the signing keys change ('keys' are their thumbprints).
+    """
+
+    size = 10000
+
+    def __init__(self, size=None):
+        if size is not None:
+            self.size = size
+        self.tokens = OrderedDict()  # {digest: (exp, claims)}
+        self.keys = None
+        # Stats
+        self.hits = 0
+        self.misses = 0
+
+
+    def check_keys(self, keys):
+        keys = tuple(keys)
+        if keys != self.keys:
+            self.tokens.clear()
+            self.keys = keys
+
+
+    def get(self, token, keys):
+        self.check_keys(keys)
+        digest = sha256(token.encode('utf-8')).digest()
+        value = self.tokens.get(digest)
+        if value is None:
+            self.misses += 1
+            return None
+
+        exp, claims = value
+        if exp is not None and exp <= time():
+            # Expired, the caller will verify the token again
+            del self.tokens[digest]
+            self.misses += 1
+            return None
+
+        self.tokens.move_to_end(digest)
+        self.hits += 1
+        return claims
+
+
+    def put(self, token, keys, claims):
+        self.check_keys(keys)
+        digest = sha256(token.encode('utf-8')).digest()
+        self.tokens[digest] = (claims.get('exp'), claims)
+        self.tokens.move_to_end(digest)
+        while len(self.tokens) > self.size:
+            self.tokens.popitem(last=False)
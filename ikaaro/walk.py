@@ -0,0 +1,160 @@
+"""Walk the database on the filesystem, without loading the resources: for
+every resource yield its abspath, the path of its metadata file, and the
+class id and version read from the header of the metadata.
+
+The resources are yielded with the names sorted (see get_path_key), a
+directory at a time, so the memory does not grow with the size of the
+database.  With walk_resources the resources are loaded only when they pass
+the filter, and their handlers are removed from the cache as soon as the
+next one is asked for.  This is for the bulk operations (rebuild and check
+of the catalog, upgrades): the resources added or removed and not yet saved are not
+seen, use Folder.traverse_resources for them.
+"""
+
+from logging import getLogger
+from os import scandir
+
+# Import from itools
+from itools.core import is_prototype
+
+# Import from ikaaro
+from .fields import File_Field
+
+
+log = getLogger("ikaaro")
+
+
+def get_path_key(abspath):
+    """The order of the traversal: a resource comes after its ancestors and
+    before the resources that follow them.
+    """
+    abspath = str(abspath).strip('/')
+    return tuple(abspath.split('/')) if abspath else ()
+
+
+def read_metadata_header(path):
+    """Return the class id and the class version (None if not set) from the
+    first line of the metadata file, for example:
+
+        format;version=20090122:webpage
+    """
+    with open(path, 'rb') as file:
+        for line in file:
+            line = line.strip()
+            if line:
+                break
+        else:
+            return None, None
+
+    line = line.decode('utf-8')
+    name, sep, class_id = line.partition(':')
+    name, *params = name.split(';')
+    if name != 'format':
+        return None, None
+
+    version = None
+    for param in params:
+        key, sep, value = param.partition('=')
+        if key == 'version':
+            version = value
+    return class_id, version
+
+
+def walk_metadata(database_path, abspath='/', after=None):
+    """Yield (abspath, metadata path, class_id, version) for the resource at
+    the given abspath and all its descendants.  'database_path' is the
+    folder with the metadata files ({target}/database).  If 'after' is given
+    (a key from get_path_key) start after that resource.
+    """
+    abspath = str(abspath).strip('/')
+    abspath = f'/{abspath}' if abspath else ''
+    if after is None or get_path_key(abspath) > after:
+        if abspath:
+            metadata_path = f'{database_path}{abspath}.metadata'
+        else:
+            metadata_path = f'{database_path}/.metadata'
+        class_id, version = read_metadata_header(metadata_path)
+        yield abspath or '/', metadata_path, class_id, version
+    yield from walk_folder(database_path, abspath, after)
+
+
+def walk_folder(database_path, abspath, after=None):
+    try:
+        entries = scandir(f'{database_path}{abspath}')
+    except (FileNotFoundError, NotADirectoryError):
+        return
+
+    with entries:
+        names = sorted(
+            x.name[:-9] for x in entries
+            if x.name.endswith('.metadata') and x.name != '.metadata'
+            and x.is_file())
+
+    key = get_path_key(abspath)
+    for name in names:
+        path = f'{abspath}/{name}'
+        child_key = key + (name,)
+        if after is not None and child_key < after:
+            # Skip the subtrees done already
+            if after[:len(child_key)] != child_key:
+                continue
+        if after is None or child_key > after:
+            metadata_path = f'{database_path}{path}.metadata'
+            try:
+                class_id, version = read_metadata_header(metadata_path)
+            except FileNotFoundError:
+                # Removed meanwhile
+                continue
+            yield path, metadata_path, class_id, version
+        yield from walk_folder(database_path, path, after)
+
+
+def release_resource(database, resource):
+    """Remove the handlers of the given resource (the metadata and the files)
+    from the cache of the database, but those with changes not saved.
+    """
+    metadata = resource.metadata
+    keys = [metadata.key, metadata.key[:-9]]
+    languages = None
+    for name, field in resource.get_fields():
+        if not is_prototype(field, File_Field):
+            continue
+        if field.multilingual:
+            if languages is None:
+                languages = resource.get_root().get_value('website_languages')
+            keys.extend(field._get_key(resource, name, x) for x in languages)
+        else:
+            keys.append(field._get_key(resource, name, None))
+
+    cache = database.cache
+    for key in keys:
+        handler = cache.get(key)
+        if handler is not None and not handler.dirty:
+            del cache[key]
+
+
+def walk_resources(database, abspath='/', after=None, accept=None):
+    """Yield the resources at the given abspath and below, in the order of
+    walk_metadata.  If given, 'accept' is called with the abspath and the
+    class id, the resource is loaded only if it returns True.  The handlers
+    of a resource are released when the next resource is asked for.
+    """
+    database_path = f'{database.path}/database'
+    items = walk_metadata(database_path, abspath, after)
+    for path, metadata_path, class_id, version in items:
+        if accept is not None and not accept(path, class_id):
+            continue
+        try:
+            resource = database.get_resource(path, soft=True)
+        except StopIteration:
+            resource = None
+        if resource is None:
+            log.error(f"The resource can't be read - {path}")
+            continue
+
+        try:
+            yield resource
+        finally:
+            # The root is used by the others
+            if path != '/':
+                release_resource(database, resource)
@@ -0,0 +1,281 @@
+"""Multi-process serving: one read-write worker plus N read-only workers
+sharing the same instance.
+
+The supervisor (see 'icms-start.py --workers N') opens the listening socket
+and spawns the workers:
+
+- the writer opens the database in read-write mode and listens on a unix
+  socket ({target}/writer.sock);
+- the readers open the database in read-only mode and accept connections
+  on the public socket.  They handle the read-only requests and forward the
+  others to the writer.
+
+After every commit the writer bumps the generation file ({target}/generation),
+when the readers see it changed they reopen the catalog and drop their
+handlers cache.
+"""
+
+from os import getpid, remove, replace
+from signal import SIGINT, SIGTERM, signal
+from subprocess import Popen
+from time import sleep
+import asyncio
+import logging
+import socket
+import sys
+
+# Requirements
+from starlette.middleware.sessions import SessionMiddleware as BaseSessionMiddleware
+from starlette.responses import Response, StreamingResponse
+import h11
+
+
+log = logging.getLogger("ikaaro.workers")
+
+
+# Hop-by-hop headers, they are not forwarded
+hop_by_hop = {b'connection', b'keep-alive', b'proxy-authenticate',
+              b'proxy-authorization', b'te', b'trailers',
+              b'transfer-encoding', b'upgrade'}
+
+
+def get_writer_socket(target):
+    return f'{target}/writer.sock'
+
+
+def get_generation_path(target):
+    return f'{target}/generation'
+
+
+def read_generation(path):
+    try:
+        with open(path) as file:
+            return int(file.read().strip() or 0)
+    except (OSError, ValueError):
+        return 0
+
+
+def write_generation(path, generation):
+    # Atomic write, readers never see a partial file
+    tmp_path = f'{path}.{getpid()}.tmp'
+    with open(tmp_path, 'w') as file:
+        file.write(str(generation))
+    replace(tmp_path, path)
+
+
+###########################################################################
+# Readers: forward write requests to the writer
+###########################################################################
+async def receive_event(connection, reader):
+    while True:
+        event = connection.next_event()
+        if event is not h11.NEED_DATA:
+            return event
+        connection.receive_data(await reader.read(65536))
+
+
+async def forward_request(request, address, body=None):
+    """Forward the given Starlette request to the writer process listening
+    on the given unix socket, and return its response.
+
+    The body (an async iterator of chunks, by default the request stream) and
+    the response are streamed, not buffered.
+    """
+    if body is None:
+        body = request.stream()
+
+    # The request
+    headers = [ (name, value) for name, value in request.headers.raw
+                if name.lower() not in hop_by_hop
+                and name.lower() not in (b'content-length', b'x-forwarded-for') ]
+    size = request.headers.get('content-length', '')
+    if size.isdigit():
+        headers.append((b'content-length', size.encode()))
+    elif 'chunked' in request.headers.get('transfer-encoding', ''):
+        headers.append((b'transfer-encoding', b'chunked'))
+    headers.append((b'connection', b'close'))
+    # The address of the client, for the writer's logs (see get_remote_ip)
+    forwarded_for = request.headers.get('x-forwarded-for')
+    if request.client:
+        client = request.client.host
+        forwarded_for = f'{forwarded_for}, {client}' if forwarded_for else client
+    if forwarded_for:
+        headers.append((b'x-forwarded-for', forwarded_for.encode()))
+    target = request.scope.get('raw_path') or request.url.path.encode()
+    query = request.scope.get('query_string')
+    if query:
+        target = target + b'?' + query
+
+    try:
+        reader, writer = await asyncio.open_unix_connection(address)
+    except OSError:
+        log.error(f'The writer process is not available ({address})',
+                  exc_info=True)
+        return Response('503 Service Unavailable', status_code=503,
+                        media_type='text/plain')
+
+    # Send the request, read the response head
+    connection = h11.Connection(h11.CLIENT)
+    response = None
+    try:
+        try:
+            writer.write(connection.send(
+                h11.Request(method=request.method, target=target,
+                            headers=headers)))
+            async for chunk in body:
+                if chunk:
+                    writer.write(connection.send(h11.Data(data=chunk)))
+                    await writer.drain()
+            writer.write(connection.send(h11.EndOfMessage()))
+            await writer.drain()
+        except OSError:
+            # The writer may answer (e.g. an error) before the whole body
+            log.warning('The writer closed the connection', exc_info=True)
+        while response is None:
+            event = await receive_event(connection, reader)
+            if isinstance(event, h11.Response):
+                response = event
+            elif isinstance(event, h11.ConnectionClosed):
+                break
+    except BaseException:
+        writer.close()
+        raise
+
+    if response is None:
+        writer.close()
+        return Response('502 Bad Gateway', status_code=502,
+                        media_type='text/plain')
+
+    # Stream the response body
+    async def iter_response():
+        try:
+            while True:
+                event = await receive_event(connection, reader)
+                if not isinstance(event, h11.Data):
+                    # EndOfMessage or ConnectionClosed
+                    break
+                yield event.data
+        finally:
+            writer.close()
+
+    # Keep repeated headers (e.g. Set-Cookie)
+    headers = [ (name, value) for name, value in response.headers
+                if name.lower() not in hop_by_hop ]
+    forwarded = StreamingResponse(iter_response(),
+                                  status_code=response.status_code)
+    forwarded.raw_headers = headers
+    # The session cookie is the writer's, see SessionMiddleware
+    request.scope['forwarded_headers'] = list(headers)
+    return forwarded
+
+
+class SessionMiddleware(BaseSessionMiddleware):
+    """The session of a forwarded request is the writer's: its Set-Cookie
+    header is sent as is, the reader's (stale) session cookie is not added.
+    """
+
+    async def __call__(self, scope, receive, send):
+        async def send_wrapper(message):
+            if message['type'] == 'http.response.start':
+                headers = scope.get('forwarded_headers')
+                if headers is not None:
+                    message['headers'] = headers
+            await send(message)
+
+        await super().__call__(scope, receive, send_wrapper)
+
+
+###########################################################################
+# Supervisor
+###########################################################################
+class Supervisor:
+    """Spawn and watch the worker processes, restart the ones that die.
+    """
+
+    def __init__(self, script, target, address, port, nb_readers,
+                 timestamp):
+        self.script = script
+        self.target = target
+        self.address = '0.0.0.0' if address == '*' else address
+        self.port = port
+        self.nb_readers = nb_readers
+        self.timestamp = timestamp
+        self.sock = None
+        self.writer = None
+        self.readers = []
+        self.stopping = False
+
+
+    def get_command(self, role):
+        command = [sys.executable, self.script, self.target,
+                   f'--role={role}', f'--timestamp={self.timestamp}']
+        if role == 'reader':
+            command.append(f'--fd={self.sock.fileno()}')
+        return command
+
+
+    def spawn(self, role):
+        log.info(f'Start {role} worker')
+        if role == 'reader':
+            fd = self.sock.fileno()
+            return Popen(self.get_command(role), pass_fds=[fd])
+        return Popen(self.get_command(role))
+
+
+    def get_pid_path(self):
+        return f'{self.target}/pid'
+
+
+    def stop(self, signum, frame):
+        self.stopping = True
+
+
+    def run(self):
+        # The public socket, shared by the readers
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.address, self.port))
+        sock.listen(2048)
+        sock.set_inheritable(True)
+        self.sock = sock
+        with open(self.get_pid_path(), 'w') as file:
+            file.write(str(getpid()))
+        log.info(f'Listen {self.address}:{self.port}'
+                 f' (1 writer, {self.nb_readers} readers)')
+
+        # Spawn workers
+        signal(SIGTERM, self.stop)
+        signal(SIGINT, self.stop)
+        self.writer = self.spawn('writer')
+        self.readers = [ self.spawn('reader')
+                         for i in range(self.nb_readers) ]
+
+        # Watch
+        try:
+            while not self.stopping:
+                sleep(1)
+                if self.writer.poll() is not None:
+                    log.error('The writer worker died, restart it')
+                    self.writer = self.spawn('writer')
+                for i, reader in enumerate(self.readers):
+                    if reader.poll() is not None:
+                        log.error('A reader worker died, restart it')
+                        self.readers[i] = self.spawn('reader')
+        finally:
+            self.terminate()
+
+
+    def terminate(self):
+        log.info('Stop workers')
+        processes = self.readers + [self.writer]
+        for process in processes:
+            if process and process.poll() is None:
+                process.terminate()
+        for process in processes:
+            if process:
+                process.wait()
+        self.sock.close()
+        try:
+            remove(self.get_pid_path())
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+from logging import getLogger
+from optparse import OptionParser
+from sys import exit
+from xapian import DatabaseLockError
+
+# Import from itools
+import itools
+
+# Import from ikaaro
+from ikaaro.check import CatalogCheck
+from ikaaro.server import Server, ask_confirmation
+
+log = getLogger("ikaaro")
+
+
+async def check(parser, options, target):
+    # To repair the server must be stopped
+    try:
+        server = Server(target, read_only=not options.repair)
+    except (FileNotFoundError, LookupError):
+        log.error(f"Error: {target} instance do not exists")
+        exit(1)
+    except DatabaseLockError:
+        log.error(f'Error: Database {target} is already opened')
+        exit(1)
+    server.set_log_level('INFO')
+
+    database = server.database
+    async with database.init_context(commit_at_exit=False):
+        catalog_check = CatalogCheck(database)
+        report = catalog_check.run()
+
+    print(f"{report['resources']} resources, {report['documents']} documents")
+    for kind, problems in report['problems'].items():
+        count = report['counts'][kind]
+        if not count:
+            continue
+        print(f'{count} {kind}:')
+        for abspath, detail in problems:
+            if detail:
+                print(f'  {abspath} ({detail})')
+            else:
+                print(f'  {abspath}')
+        if count > len(problems):
+            print(f'  ... {count - len(problems)} more')
+
+    if report['ok']:
+        print('The catalog is consistent')
+        return True
+    if not options.repair:
+        return False
+
+    # Repair
+    message = 'Repair the catalog (y/N)? '
+    if ask_confirmation(message, options.confirm) is False:
+        return False
+    async with database.init_context(commit_at_exit=False):
+        catalog_check.repair()
+    return True
+
+
+if __name__ == '__main__':
+    # The command line parser
+    usage = '%prog [OPTIONS] TARGET'
+    version = f'itools {itools.__version__}'
+    description = (
+        'Checks the catalog against the database: reports the resources'
+        ' missing from the catalog, the stale documents and the orphan'
+        ' documents; and optionally repairs them.')
+    parser = OptionParser(usage, version=version, description=description)
+    parser.add_option(
+        '-r', '--repair', action='store_true', default=False,
+        help="reindex the missing and stale resources, remove the orphan"
+             " documents (the server must be stopped)")
+    parser.add_option(
+        '-y', '--yes', action='store_true', dest='confirm',
+        help="repair without asking confirmation")
+
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error('incorrect number of arguments')
+
+    target = args[0]
+
+    # Action!
+    ok = asyncio.run(check(parser, options, target))
+    exit(0 if ok else 1)
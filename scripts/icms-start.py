@@ -16,6 +16,7 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from time import time
 import asyncio
 import logging
 import optparse
@@ -28,7 +29,8 @@ import xapian
 from itools import __version__
 
 # Import from ikaaro
-from ikaaro.server import Server
+from ikaaro.server import Server, get_config, get_pid
+from ikaaro.workers import Supervisor, get_writer_socket
 
 
 log = logging.getLogger("ikaaro")
@@ -53,6 +55,38 @@ async def main(target, options):
     await server.start()
 
 
+async def start_worker(target, options):
+    """Start a worker of the multi-process mode (spawned by the supervisor).
+    """
+    read_only = options.role == 'reader'
+    server = Server(target, read_only=read_only, timestamp=options.timestamp)
+    server.set_worker_role(options.role)
+    if read_only:
+        await server.start(fd=int(options.fd))
+    else:
+        await server.start(uds=get_writer_socket(server.target))
+
+
+def supervise(target, options):
+    """Run one read-write worker plus N read-only workers.
+    """
+    config = get_config(target)
+    address = config.get_value('listen-address').strip()
+    if not address:
+        raise ValueError('listen-address is missing from config.conf')
+    port = options.port or config.get_value('listen-port')
+    if port is None:
+        raise ValueError('listen-port is missing from config.conf')
+    if get_pid(f'{target}/pid') is not None:
+        log.error(f'[{target}] The Web Server is already running.')
+        sys.exit(1)
+    # The workers must share the same timestamp (for /ui/cached/ URLs)
+    timestamp = str(int(time() / 2))
+    supervisor = Supervisor(sys.argv[0], target, address, int(port),
+                            options.workers, timestamp)
+    supervisor.run()
+
+
 if __name__ == '__main__':
     # The command line parser
     usage = '%prog [OPTIONS] TARGET'
@@ -70,6 +104,14 @@ if __name__ == '__main__':
     parser.add_option(
         '--quick', action="store_true", default=False,
         help="Do not check the database consistency.")
+    parser.add_option(
+        '-w', '--workers', type='int', default=0,
+        help="Start one read-write worker process plus this number of "
+             "read-only worker processes.")
+    # Internal options, used by the supervisor to spawn the workers
+    parser.add_option('--role', help=optparse.SUPPRESS_HELP)
+    parser.add_option('--fd', help=optparse.SUPPRESS_HELP)
+    parser.add_option('--timestamp', help=optparse.SUPPRESS_HELP)
 
     # Parse arguments
     options, args = parser.parse_args()
@@ -78,4 +120,11 @@ if __name__ == '__main__':
         parser.error('Wrong number of arguments.')
 
     target = args[0]
-    asyncio.run(main(target, options))
+    if options.role:
+        asyncio.run(start_worker(target, options))
+    elif options.workers > 0:
+        if options.read_only:
+            parser.error('--workers cannot be used with --read-only')
+        supervise(target, options)
+    else:
+        asyncio.run(main(target, options))
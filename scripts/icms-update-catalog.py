@@ -46,7 +46,10 @@ async def update_catalog(parser, options, target):
         return
 
     # Server reindex
-    await server.reindex_catalog(as_test=options.test, quiet=options.quiet, quick=options.quick)
+    await server.reindex_catalog(as_test=options.test, quiet=options.quiet, quick=options.quick,
+                                 jobs=options.jobs, resume=options.resume,
+                                 only_path=options.only_path,
+                                 only_classes=options.only_class)
 
 
 if __name__ == '__main__':
@@ -71,6 +74,16 @@ if __name__ == '__main__':
         help="do not check the database consistency.")
     parser.add_option('-t', '--test', action='store_true', default=False,
         help="a test mode, don't stop the indexation when an error occurs")
+    parser.add_option('-j', '--jobs', type='int', default=1,
+        help="index with the given number of processes (default 1)")
+    parser.add_option('--resume', action='store_true', default=False,
+        help="continue a rebuild that was interrupted, from its last checkpoint")
+    parser.add_option('--only-path',
+        help="reindex only the resources of the given subtree, into the"
+             " current catalog")
+    parser.add_option('--only-class', action='append',
+        help="reindex only the resources of the given class_id, into the"
+             " current catalog (may be repeated)")
 
     options, args = parser.parse_args()
     if len(args) != 1:
@@ -1,6 +1,8 @@
 import asyncio
 import pytest
 
+from ikaaro.database import RWLock
+
 
 @pytest.mark.asyncio(loop_scope="module")
 async def test_ro_concurrency(database):
@@ -102,3 +104,121 @@ async def test_rw_serialization(database):
     end_time = asyncio.get_event_loop().time()
     # Should take ~0.3s if running serially (3 × 0.1s)
     assert end_time - start_time > 0.25
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_rw_not_starved(database):
+    """Test that a queued RW operation is not starved by new RO operations"""
+    results = []
+
+    async def operation(read_only, duration=0.1):
+        name = asyncio.current_task().get_name()
+        async with database.init_context(read_only=read_only):
+            results.append(('start', name))
+            await asyncio.sleep(duration)
+            results.append(('end', name))
+
+    # Schedule: RO starts, then RW is queued, then another RO arrives
+    ro1 = asyncio.create_task(operation(True), name='ro-1')
+    await asyncio.sleep(0.01)
+    rw1 = asyncio.create_task(operation(False), name='rw-1')
+    await asyncio.sleep(0.01)
+    ro2 = asyncio.create_task(operation(True), name='ro-2')
+    await asyncio.gather(ro1, rw1, ro2)
+
+    # The second RO waits for the queued RW
+    assert results == [
+        ('start', 'ro-1'),
+        ('end', 'ro-1'),
+        ('start', 'rw-1'),
+        ('end', 'rw-1'),
+        ('start', 'ro-2'),
+        ('end', 'ro-2'),
+    ]
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_fifo_order(database):
+    """Test that waiters are served in arrival order, consecutive RO
+    operations being granted together"""
+    results = []
+
+    async def operation(read_only):
+        name = asyncio.current_task().get_name()
+        async with database.init_context(read_only=read_only):
+            results.append(name)
+            await asyncio.sleep(0.05)
+
+    tasks = []
+    for name, read_only in [('rw-1', False), ('rw-2', False), ('ro-1', True),
+                            ('ro-2', True), ('rw-3', False)]:
+        task = asyncio.create_task(operation(read_only), name=name)
+        tasks.append(task)
+        await asyncio.sleep(0.01)
+    await asyncio.gather(*tasks)
+
+    assert results == ['rw-1', 'rw-2', 'ro-1', 'ro-2', 'rw-3']
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_lock_stats(database):
+    """Test the lock statistics"""
+
+    async def operation(read_only):
+        async with database.init_context(read_only=read_only):
+            await asyncio.sleep(0.05)
+
+    await asyncio.gather(operation(False), operation(True), operation(True))
+
+    stats = database.lock.get_stats()
+    assert stats['write']['acquired'] >= 1
+    assert stats['read']['acquired'] >= 2
+    assert stats['read']['waiting'] == 0
+    assert stats['read']['wait_max'] >= 0.04
+    assert stats['write']['hold_max'] >= 0.04
+    assert stats['readers'] == 0
+    assert stats['writer'] is False
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_cancelled_waiter(database):
+    """Test that a cancelled waiter does not keep the lock"""
+
+    async def operation(read_only):
+        async with database.init_context(read_only=read_only):
+            await asyncio.sleep(0.05)
+
+    ro1 = asyncio.create_task(operation(True))
+    await asyncio.sleep(0.01)
+    rw1 = asyncio.create_task(operation(False))
+    await asyncio.sleep(0.01)
+    rw1.cancel()
+    await asyncio.gather(ro1, rw1, return_exceptions=True)
+
+    # The lock is free
+    await asyncio.wait_for(operation(False), timeout=1)
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_exclusive_reader():
+    """Test that an exclusive reader holds the lock alone, as a reader"""
+    lock = RWLock()
+    await lock.acquire(True, exclusive=True)
+    reader = asyncio.create_task(lock.acquire(True))
+    await asyncio.sleep(0.01)
+    assert not reader.done()
+    lock.release(True)
+    await asyncio.wait_for(reader, timeout=1)
+    lock.release(True)
+    assert lock.get_stats()['read']['acquired'] == 2
+
+    # It waits for the changes of a group commit to be saved
+    lock.batch = True
+    reader = asyncio.create_task(lock.acquire(True, exclusive=True))
+    await asyncio.sleep(0.01)
+    assert not reader.done()
+    lock.batch = False
+    lock._wake_up()
+    await asyncio.wait_for(reader, timeout=1)
+    lock.release(True)
+    assert lock.get_stats()['readers'] == 0
@@ -13,19 +13,29 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import asyncio
 import datetime
 
 import pytest
 
 # Import from itools
 from itools.database import AndQuery, PhraseQuery
+from itools.database import get_register_fields
+from itools.database.backends.catalog import Catalog, make_catalog
+from itools.fs import lfs
 
 # Import from ikaaro
-from ikaaro.database import Database
+from ikaaro.check import CatalogCheck
+from ikaaro.database import Database, ReindexDependencies
 from ikaaro.folder import Folder
+from ikaaro.group_commit import BatchAborted, GroupCommit
+from ikaaro.reindex import get_path_key, in_partition
+from ikaaro.reindex import get_catalog_languages, merge_catalogs
+from ikaaro.reindex import open_new_catalog
 from ikaaro.file import File
 from ikaaro.utils import get_base_path_query
 from ikaaro.text import Text
+from ikaaro.walk import read_metadata_header, walk_metadata, walk_resources
 
 
 @pytest.mark.xfail
@@ -322,3 +332,273 @@ async def test_cache_error_on_move(database):
             lst.append(container)
             context.database.save_changes()
             container.parent.move_resource(name, name + 'newname')
+
+
+def test_reindex_dependencies():
+    # The catalog: /b depends on /a, /c depends on /b
+    catalog = {'/a': {'/b'}, '/b': {'/c'}}
+
+    class Dependencies(ReindexDependencies):
+        searches = 0
+        def search(self, database, path):
+            self.searches += 1
+            return set(catalog.get(path, ()))
+
+    dependencies = Dependencies()
+    assert dependencies.get_dependents(None, ['/a']) == {'/b'}
+    assert dependencies.get_dependents(None, ['/a', '/b']) == {'/b', '/c'}
+    assert dependencies.searches == 2
+    # /c now depends on /a too, and no longer on /b
+    dependencies.update('/c', ['/a'])
+    assert dependencies.get_dependents(None, ['/a']) == {'/b', '/c'}
+    assert dependencies.get_dependents(None, ['/b']) == set()
+    # /b is removed
+    dependencies.remove('/b')
+    assert dependencies.get_dependents(None, ['/a']) == {'/c'}
+    assert dependencies.searches == 2
+    # Only the paths used last are kept
+    dependencies = Dependencies(size=1)
+    assert dependencies.get_dependents(None, ['/a']) == {'/b'}
+    assert dependencies.get_dependents(None, ['/b']) == {'/c'}
+    assert list(dependencies.dependents) == ['/b']
+    assert dependencies.targets == {'/c': {'/b'}}
+    assert dependencies.get_dependents(None, ['/a']) == {'/b'}
+    assert dependencies.searches == 3
+
+
+async def test_group_commit(database):
+    group_commit = GroupCommit(database, 0.01, 3)
+    database.group_commit = group_commit
+    root = database.get_resource('/')
+
+    async def write(title):
+        async with database.init_context(commit_at_exit=False) as context:
+            context.group_commit = True
+            context.git_message = title
+            root.set_value('title', title, language='en')
+            database.save_changes()
+            return context.commit_future
+
+    try:
+        # Deferred, the readers wait
+        future1 = await write('Group 1')
+        future2 = await write('Group 2')
+        assert not future1.done()
+        assert len(group_commit.pending) == 2
+        assert database.lock.batch is True
+        assert database.has_changed
+        # The author and the messages of the batch
+        author, msg = group_commit.get_commit_info(('nobody', 'nobody'), None)
+        assert msg == 'Group 1\nGroup 2'
+        # The third transaction saves the batch
+        future3 = await write('Group 3')
+        assert future3 is None
+        assert future1.done() and future2.done()
+        assert not database.has_changed
+        assert database.lock.batch is False
+        assert group_commit.commits == 1
+
+        # Saved after the delay
+        future = await write('Group 4')
+        await future
+        assert not database.has_changed
+        assert group_commit.commits == 2
+        async with database.init_context():
+            assert root.get_value('title', language='en') == 'Group 4'
+
+        # Aborted by a later transaction, the batch is not saved
+        future5 = await write('Group 5')
+        async with database.init_context(commit_at_exit=False) as context:
+            context.group_commit = True
+            database.save_changes()
+            # Nothing changed, it waits for the batch
+            assert context.commit_future is future5
+        async with database.init_context(commit_at_exit=False):
+            root.set_value('title', 'Group 6', language='en')
+            database.abort_changes()
+        with pytest.raises(BatchAborted):
+            await future5
+        assert not group_commit.pending
+        assert database.lock.batch is False
+        async with database.init_context():
+            assert root.get_value('title', language='en') == 'Group 4'
+    finally:
+        database.group_commit = None
+
+
+async def test_group_commit_reader(database):
+    group_commit = GroupCommit(database, 0.01, 10)
+    database.group_commit = group_commit
+    root = database.get_resource('/')
+
+    async def read():
+        async with database.init_context(read_only=True):
+            return root.get_value('title', language='en')
+
+    try:
+        async with database.init_context(commit_at_exit=False) as context:
+            context.group_commit = True
+            root.set_value('title', 'Group reader', language='en')
+            database.save_changes()
+            future = context.commit_future
+        # The reader waits for the batch, the batch is saved anyway
+        reader = asyncio.create_task(read())
+        await asyncio.sleep(0)
+        assert not reader.done()
+        await asyncio.wait_for(future, 5)
+        assert await asyncio.wait_for(reader, 5) == 'Group reader'
+        assert database.lock.batch is False
+    finally:
+        database.group_commit = None
+
+
+async def test_commit_stats(database):
+    stats = database.commit_stats
+    async with database.init_context():
+        root = database.get_resource('/')
+        container = root.make_resource('test-commit-stats', Folder)
+        container.make_resource('a', Text, data='A')
+        database.save_changes()
+        commits = stats.commits
+        assert list(stats.last) == list(stats.phases)
+        assert stats.last['catalog_values'][1] == 2
+        assert stats.last['mtime'][1] == 2
+        assert stats.last['move_links'][1] == 0
+        assert stats.last['invalidate'][1] >= 2
+        assert stats.last['write'][1] == 2
+
+        # Move
+        container.move_resource('a', 'b')
+        database.save_changes()
+        assert stats.commits == commits + 1
+        assert stats.last['move_links'][1] == 1
+        assert stats.last['unindex'][1] >= 1
+        assert stats.totals['move_links'][1] >= 1
+
+
+def test_in_partition():
+    paths = ['/', '/users', '/users/1', '/config', '/config/access']
+    for path in paths:
+        jobs = [ x for x in range(3) if in_partition(path, x, 3) ]
+        assert len(jobs) == 1
+    assert all(in_partition(x, 0, 1) for x in paths)
+
+
+def test_merge_catalogs(tmp_path):
+    # The partial catalogs see the fields in a different order
+    documents = [
+        [{'abspath': '/a', 'email_domain': 'example.com'},
+         {'abspath': '/b', 'format': 'folder'}],
+        [{'abspath': '/c', 'format': 'user'},
+         {'abspath': '/d', 'email_domain': 'example.org'}]]
+    paths = [ str(tmp_path / f'catalog.{x}') for x in range(2) ]
+    for path, docs in zip(paths, documents):
+        catalog = open_new_catalog(path, languages=['en', 'fr'])[0]
+        for values in docs:
+            catalog.index_document(values)
+        catalog.save_changes()
+        catalog.close()
+
+    catalog_path = str(tmp_path / 'catalog')
+    merge_catalogs(paths, catalog_path)
+    catalog = Catalog(catalog_path, get_register_fields())
+    def search(name, value):
+        results = catalog.search(PhraseQuery(name, value))
+        return [ x.abspath for x in results.get_documents() ]
+    assert search('email_domain', 'example.com') == ['/a']
+    assert search('email_domain', 'example.org') == ['/d']
+    assert search('format', 'folder') == ['/b']
+    assert search('format', 'user') == ['/c']
+    assert get_catalog_languages(catalog) == {'en', 'fr'}
+    catalog.close()
+
+    # The languages of the values indexed
+    catalog = make_catalog(str(tmp_path / 'catalog.de'), get_register_fields())
+    catalog.index_document({'abspath': '/e', 'title': {'de': 'Titel'}})
+    assert get_catalog_languages(catalog) == {'de'}
+    catalog.close()
+
+    # Without the same map of fields the merge is refused
+    for path, docs in zip(paths, documents):
+        lfs.remove(path)
+        catalog = make_catalog(path, get_register_fields())
+        for values in docs:
+            catalog.index_document(values)
+        catalog.save_changes()
+        catalog.close()
+    with pytest.raises(ValueError):
+        merge_catalogs(paths, str(tmp_path / 'catalog.bad'))
+
+
+def test_walk_metadata(tmp_path):
+    files = {
+        '.metadata': 'format;version=20071215:root\n',
+        'b.metadata': 'format;version=20090122:webpage\n',
+        'a.metadata': '\nformat:folder\n',
+        'a/x.metadata': 'format;version=20071215:text\n',
+        'a/x.txt': 'x',
+    }
+    for name, data in files.items():
+        path = tmp_path / name
+        path.parent.mkdir(exist_ok=True)
+        path.write_text(data)
+
+    assert read_metadata_header(tmp_path / 'b.metadata') == \
+        ('webpage', '20090122')
+    assert read_metadata_header(tmp_path / 'a.metadata') == ('folder', None)
+    items = [ (x[0], x[2]) for x in walk_metadata(str(tmp_path)) ]
+    assert items == [
+        ('/', 'root'), ('/a', 'folder'), ('/a/x', 'text'), ('/b', 'webpage')]
+    items = [ x[0] for x in walk_metadata(str(tmp_path), '/a') ]
+    assert items == ['/a', '/a/x']
+    # Resume
+    after = get_path_key('/a')
+    items = [ x[0] for x in walk_metadata(str(tmp_path), after=after) ]
+    assert items == ['/a/x', '/b']
+    after = get_path_key('/a/x')
+    items = [ x[0] for x in walk_metadata(str(tmp_path), after=after) ]
+    assert items == ['/b']
+
+
+async def test_walk_resources(database):
+    async with database.init_context():
+        paths = [ str(x.abspath) for x in walk_resources(database) ]
+        assert paths[0] == '/'
+        assert len(paths) == database.get_nb_metadatas()
+        assert paths == sorted(paths, key=get_path_key)
+
+        # Only the users are loaded, and released
+        accept = lambda path, class_id: class_id == 'user'
+        users = list(walk_resources(database, '/users', accept=accept))
+        assert users
+        assert all(x.class_id == 'user' for x in users)
+        assert users[-1].metadata.key not in database.cache
+
+
+async def test_catalog_check(database):
+    async with database.init_context():
+        root = database.get_resource('/')
+        root.make_resource('test-check', Text, data='check')
+        database.save_changes()
+        report = CatalogCheck(database).run()
+        assert report['ok']
+        assert report['resources'] == report['documents']
+
+        # Missing and orphan documents
+        catalog = database.catalog
+        catalog.unindex_document('/test-check')
+        values = root.get_resource('test-check').get_catalog_values()
+        values['abspath'] = '/test-check-orphan'
+        catalog.index_document(values)
+        catalog.save_changes()
+        check = CatalogCheck(database)
+        report = check.run()
+        assert not report['ok']
+        assert report['problems']['missing'] == [('/test-check', None)]
+        assert report['problems']['orphan'] == [('/test-check-orphan', None)]
+
+        # Repair, by a commit
+        commits = database.commit_stats.commits
+        assert check.repair() == 2
+        assert database.commit_stats.commits == commits + 1
+        assert CatalogCheck(database).run()['ok']
@@ -13,7 +13,15 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import asyncio
 import io
+import logging
+import os
+import threading
+import time
+
+import pytest
+from jwcrypto.jwt import JWT
 
 # Import from itools
 from itools.database import PhraseQuery
@@ -21,7 +29,19 @@ from itools.datatypes import String, Unicode
 from itools.web.views import ItoolsView, BaseView
 
 # Import from ikaaro
-from ikaaro.server import Server
+from ikaaro.context import iter_upload
+from ikaaro.database import get_database, is_access_path
+from ikaaro.metrics import Metrics
+from ikaaro.page_cache import CachedPage, PageCache
+from ikaaro.profiler import get_profile_name
+from ikaaro.reindex import OnlineReindex
+from ikaaro.responses import parse_range
+from ikaaro.server import Server, make_request_executor
+from ikaaro.static import StaticFiles
+from ikaaro.text import Text
+from ikaaro.text_cache import TextCache
+from ikaaro.text_queue import TextQueue
+from ikaaro.tokens import VerifiedTokens
 
 
 class HTML_View(ItoolsView):
@@ -43,6 +63,16 @@ class PlainText_View(ItoolsView):
         return 'hello world'
 
 
+class Thread_View(ItoolsView):
+
+    access = True
+    known_methods = ['GET']
+
+    def GET(self, resource, context):
+        context.set_content_type('text/plain')
+        return threading.current_thread().name
+
+
 class Json_View(ItoolsView):
 
     access = True
@@ -125,6 +155,351 @@ async def test_plain_text(client, server):
     assert response.text == 'hello world'
 
 
+async def test_request_executor(client, server):
+    server.dispatcher.add('/test/thread', Thread_View)
+    # Inline (default)
+    response = client.get('/test/thread')
+    assert response.status_code == 200
+    assert not response.text.startswith('ikaaro-request')
+    # Thread pool, the request holds the lock alone, as a reader
+    server.request_executor = make_request_executor('threads:2')
+    stats = server.database.lock.get_stats()
+    acquired = stats['read']['acquired']
+    try:
+        response = client.get('/test/thread')
+        assert response.status_code == 200
+        assert response.text.startswith('ikaaro-request')
+        stats = server.database.lock.get_stats()
+        assert stats['read']['acquired'] == acquired + 1
+    finally:
+        server.request_executor.shutdown()
+        server.request_executor = None
+
+
+def test_make_request_executor():
+    assert make_request_executor('inline') is None
+    assert make_request_executor('') is None
+    executor = make_request_executor('threads:4')
+    assert executor._max_workers == 4
+    executor.shutdown()
+    for value in ['processes:2', 'threads:0']:
+        with pytest.raises(ValueError):
+            make_request_executor(value)
+
+
+async def test_static(client, server):
+    stats = server.database.lock.get_stats()
+    acquired = stats['read']['acquired']
+    # 200 Ok
+    response = client.get('/ui/ikaaro/javascript.js')
+    assert response.status_code == 200
+    assert 'javascript' in response.headers['content-type']
+    etag = response.headers['etag']
+    # 304 Not Modified
+    response = client.get('/ui/ikaaro/javascript.js',
+                          headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    # Cached forever
+    ts = server.timestamp
+    response = client.get(f'/ui/cached/{ts}/ikaaro/javascript.js')
+    assert response.status_code == 200
+    assert response.headers['cache-control'] == 'max-age=315360000'
+    # 404 Not Found
+    response = client.get('/ui/ikaaro/not-found.js')
+    assert response.status_code == 404
+    # No database context was needed
+    stats = server.database.lock.get_stats()
+    assert stats['read']['acquired'] == acquired
+
+
+def test_static_fallback(tmp_path):
+    # The development skin falls back to the standard skin
+    dev, std = tmp_path / 'dev', tmp_path / 'std'
+    for path in [dev / 'a.js', std / 'a.js', std / 'b.js']:
+        path.parent.mkdir(exist_ok=True)
+        path.write_text('')
+    static_files = StaticFiles()
+    static_files.mount('/ui/x', str(dev), fallback=str(std))
+    candidates, cached = static_files.resolve('/ui/x/a.js')
+    assert static_files.find(candidates, '') == str(dev / 'a.js')
+    candidates, cached = static_files.resolve('/ui/x/b.js')
+    assert static_files.find(candidates, '') == str(std / 'b.js')
+    candidates, cached = static_files.resolve('/ui/x/c.js')
+    assert static_files.find(candidates, '') is None
+    # Out of the mount points
+    assert static_files.resolve('/ui/x/../../b.js')[0] == []
+    assert static_files.resolve('/ui/y/b.js')[0] is None
+
+
+async def test_page_cache(client, server):
+    server.page_cache = PageCache(10)
+    try:
+        # Stored, then served before the lock is taken
+        response = client.get('/')
+        assert response.status_code == 200
+        stats = server.database.lock.get_stats()
+        acquired = stats['read']['acquired']
+        response2 = client.get('/')
+        assert response2.content == response.content
+        stats = server.page_cache.get_stats()
+        assert stats['hits'] == 1
+        assert stats['size'] == 1
+        assert server.database.lock.get_stats()['read']['acquired'] == acquired
+        # A commit invalidates the page
+        async with server.database.init_context():
+            server.root.set_value('title', 'Page cache', language='en')
+            server.database.save_changes()
+        assert server.page_cache.get_stats()['size'] == 0
+        response = client.get('/')
+        assert server.page_cache.get_stats()['size'] == 1
+    finally:
+        server.page_cache = None
+
+
+def test_page_cache_invalidate():
+    cache = PageCache(2)
+    for path in ('/a', '/a/b', '/c'):
+        cache.put(path, CachedPage(path, 200, {}, b''), cache.version)
+    # LRU eviction
+    assert list(cache.pages) == ['/a/b', '/c']
+    assert cache.evictions == 1
+    # The resource, its ancestors and descendants
+    cache.put('/', CachedPage('/', 200, {}, b''), cache.version)
+    cache.invalidate(['/a'])
+    assert list(cache.pages) == ['/c']
+    # Pages rendered before an invalidation are not stored
+    version = cache.version
+    cache.invalidate(['/x'])
+    cache.put('/y', CachedPage('/y', 200, {}, b''), version)
+    assert '/y' not in cache.pages
+    # Dependencies invalidate everything
+    cache.invalidate(['/config/menu'])
+    assert not cache.pages
+    # Expired
+    cache = PageCache(2, ttl=60)
+    cache.put('/a', CachedPage('/a', 200, {}, b''), cache.version)
+    assert cache.get('/a') is not None
+    cache.pages['/a'].stored -= 61
+    assert cache.get('/a') is None
+    assert not cache.pages
+
+
+async def test_has_permission_many(server):
+    async with server.database.init_context() as context:
+        root = server.root
+        admin = root.get_user_from_login('test@hforge.org')
+        paths = ['/', '/config/theme', '/users']
+        # Anonymous
+        allowed = root.has_permission_many(None, 'view', paths)
+        for path in paths:
+            resource = root.get_resource(path)
+            assert allowed[path] == root.is_allowed_to_view(None, resource)
+        # Admin
+        allowed = root.has_permission_many(admin, 'edit', paths)
+        assert all(allowed.values())
+        # Cached in the context
+        assert len(context.acl_cache) == 2
+
+
+async def test_access_queries(server):
+    database = server.database
+    async with database.init_context():
+        access = server.root.get_resource('/config/access')
+        query = access.get_rules_query({'everybody'}, 'view')
+        assert database.access_queries
+        # The caller gets a copy
+        n = len(query.atoms)
+        query.append(PhraseQuery('abspath', '/changed'))
+        query2 = access.get_rules_query({'everybody'}, 'view')
+        assert query2 is not query
+        assert len(query2.atoms) == n
+
+        # Changing a rule clears the cache
+        rule = next(access.get_resources())
+        rule.set_value('permission', rule.get_value('permission'))
+        database.save_changes()
+        assert not database.access_queries
+
+
+def test_is_access_path():
+    assert is_access_path('/config/access')
+    assert is_access_path('/config/groups/admins')
+    assert not is_access_path('/config/accessX')
+    assert not is_access_path('/config')
+
+
+async def test_jwt_claims(server):
+    async with server.database.init_context() as context:
+        user = server.root.get_user_from_login('test@hforge.org')
+        token = context.generate_JWT(user).serialize()
+        claims = context.get_JWT_claims(token)
+        assert claims['id'] == user.name
+        # The second time it comes from the cache
+        hits = server.JWT_tokens.hits
+        assert context.get_JWT_claims(token) == claims
+        assert server.JWT_tokens.hits == hits + 1
+
+        # A token signed with a former key (another algorithm)
+        key = server.generate_JWT_key('ES256')
+        former_keys = server.JWT_former_keys
+        server.JWT_former_keys = [('ES256', key)]
+        try:
+            jwt = JWT(header={'alg': 'ES256'}, claims={'id': user.name})
+            jwt.make_signed_token(key)
+            token = jwt.serialize()
+            assert context.get_auth_JWT(token) is not None
+            # The keys changed, the cache was flushed
+            assert context.get_JWT_claims(token)['id'] == user.name
+            assert len(server.JWT_tokens.tokens) == 1
+        finally:
+            server.JWT_former_keys = former_keys
+
+
+def test_verified_tokens():
+    key1, key2 = 'thumbprint-1', 'thumbprint-2'
+    tokens = VerifiedTokens(size=2)
+    tokens.put('a', [key1], {'exp': time.time() + 60, 'id': 'a'})
+    assert tokens.get('a', [key1])['id'] == 'a'
+    # Expired
+    tokens.put('b', [key1], {'exp': time.time() - 1, 'id': 'b'})
+    assert tokens.get('b', [key1]) is None
+    # LRU
+    tokens.put('c', [key1], {'id': 'c'})
+    tokens.put('d', [key1], {'id': 'd'})
+    assert tokens.get('a', [key1]) is None
+    # The keys changed
+    assert tokens.get('d', [key2]) is None
+    assert not tokens.tokens
+
+
+async def test_access_log(client, server):
+    class Handler(logging.Handler):
+        def emit(self, record):
+            messages.append(record.getMessage())
+
+    messages = []
+    handler = Handler()
+    logger = logging.getLogger('ikaaro.access')
+    logger.addHandler(handler)
+    try:
+        client.get('/;login')
+    finally:
+        logger.removeHandler(handler)
+
+    message = messages[-1]
+    assert '"GET /;login HTTP/1.1" 200' in message
+    for phase in ('lock', 'handler', 'render', 'commit'):
+        assert f' {phase}=' in message
+
+
+async def test_metrics(auth, server):
+    auth.get('/api/status')
+    response = auth.get('/api/devpanel/metrics')
+    assert response.status_code == 200
+    assert response.headers['content-type'].startswith('text/plain')
+    text = response.text
+    assert '# TYPE ikaaro_request_duration_seconds histogram' in text
+    assert 'method="GET"' in text
+    assert 'ikaaro_lock_wait_seconds_count{mode="read"}' in text
+    assert 'ikaaro_catalog_searches_total' in text
+    assert 'ikaaro_spool_size' in text
+
+
+async def test_metrics_route(client, server):
+    metrics = server.metrics
+    # A view name from the URL is a label only if the class defines it
+    client.get('/;login')
+    client.get('/;no-such-view-1')
+    client.get('/;no-such-view-2')
+    routes = { x.split('route="')[1].split('"')[0]
+               for x in metrics.get_lines()
+               if x.startswith('ikaaro_request_duration_seconds_count') }
+    assert any(x.endswith(';login') for x in routes)
+    assert not any('no-such-view' in x for x in routes)
+    assert 'other' in routes
+
+
+def test_histogram():
+    metrics = Metrics()
+    for value in (0.0005, 0.02, 20):
+        metrics.observe('x_seconds', 'Some help', value, route='/a')
+    lines = metrics.get_lines()
+    assert lines[0] == '# HELP x_seconds Some help'
+    assert 'x_seconds_bucket{route="/a",le="0.001"} 1' in lines
+    assert 'x_seconds_bucket{route="/a",le="0.025"} 2' in lines
+    assert 'x_seconds_bucket{route="/a",le="+Inf"} 3' in lines
+    assert 'x_seconds_count{route="/a"} 3' in lines
+
+
+def test_get_profile_name():
+    name = get_profile_name('GET', '/a/../b;view/' + 'x' * 500)
+    assert len(name) < 120
+    assert '/' not in name and ';' not in name
+    assert name.endswith('.prof')
+    # Paths that read the same once sanitized still get different names
+    a = get_profile_name('GET', '/a;b').split('-', 2)[2]
+    b = get_profile_name('GET', '/a:b').split('-', 2)[2]
+    assert a != b
+
+
+async def test_profile(auth, client, server):
+    # Report
+    response = auth.get('/;login?__profile=html')
+    assert response.status_code == 200
+    assert 'catalog searches' in response.text
+    assert 'cumulative' in response.text
+    # File
+    response = auth.get('/;login', headers={'X-Ikaaro-Profile': '1'})
+    name = response.headers['x-ikaaro-profile']
+    assert os.path.exists(f'{server.target}/log/profiles/{name}')
+    with open(f'{server.target}/log/profiles/{name[:-5]}.txt') as file:
+        text = file.read()
+    assert 'catalog searches' in text
+    assert 'get_resource' in text
+    # Not for anonymous users
+    response = client.get('/;login?__profile=html')
+    assert 'x-ikaaro-profile' not in response.headers
+    assert 'catalog searches' not in response.text
+
+
+async def test_slow_request(client, server):
+    class Handler(logging.Handler):
+        def emit(self, record):
+            messages.append(record.getMessage())
+
+    messages = []
+    handler = Handler()
+    logger = logging.getLogger('ikaaro.web')
+    logger.addHandler(handler)
+    server.slow_request_time = 1
+    try:
+        client.get('/;login')
+    finally:
+        server.slow_request_time = 0
+        logger.removeHandler(handler)
+
+    message = [ x for x in messages if x.startswith('Slow request') ][-1]
+    assert '/;login' in message
+    assert 'get_resource:' in message
+
+
+async def test_database_generation(server):
+    # Not committed, same generation
+    server.get_database()
+    generation = server.database_generation
+    assert server.get_database_generation() == generation
+    server.get_database()
+    assert server.database_generation == generation
+
+    # Commit, new generation
+    async with server.database.init_context():
+        server.root.set_value('title', 'Generation', language='fr')
+        server.database.save_changes()
+    assert server.get_database_generation() != generation
+    server.get_database()
+    assert server.database_generation == server.get_database_generation()
+
+
 async def test_json(client, server):
     server.dispatcher.add('/test/json', Json_View)
     response = client.get('/test/json?name=world')
@@ -161,6 +536,101 @@ async def test_upload_file(auth, server):
         assert handler.to_str() == text
 
 
+async def test_upload_stats(auth, server):
+    data = {'title:en': 'My big file'}
+    text = b'x' * 300000
+    files = {'data': ('big.txt', io.BytesIO(text), 'text/plain')}
+    response = auth.post('/;new_resource?type=file&upload_id=42', data=data,
+                         files=files, follow_redirects=False)
+    assert response.status_code == 302
+    # Done with the upload
+    assert 42 not in server.upload_stats
+
+    async with server.database.init_context():
+        root = server.database.get_resource('/')
+        handler = root.get_resource('my-big-file').get_value('data')
+        assert handler.to_str() == text
+
+
+async def test_upload_refused(client, auth, server):
+    files = {'data': ('refused.txt', io.BytesIO(b'x' * 1000), 'text/plain')}
+    # Anonymous
+    response = client.post('/;new_resource?type=file', files=files,
+                           follow_redirects=False)
+    assert response.status_code == 401
+    # Too large
+    server.max_upload_size = 100
+    try:
+        response = auth.post('/;new_resource?type=file', files=files,
+                             follow_redirects=False)
+        assert response.status_code == 413
+    finally:
+        server.max_upload_size = 0
+
+
+async def test_iter_upload():
+    class Request:
+        query_params = {'upload_id': '7'}
+        headers = {'content-length': '6'}
+        async def stream(self):
+            yield b'abc'
+            yield b'def'
+
+    stats = {}
+    seen = []
+    async for chunk in iter_upload(Request(), stats):
+        seen.append(stats[7])
+    assert seen == [(3, 6), (6, 6)]
+    assert stats == {}
+
+
+async def test_download_range(auth, server):
+    data = {'title:en': 'My range file'}
+    text = b'0123456789'
+    files = {'data': ('range.txt', io.BytesIO(text), 'text/plain')}
+    response = auth.post('/;new_resource?type=file', data=data, files=files,
+                         follow_redirects=False)
+    assert response.status_code == 302
+
+    # Full download
+    response = auth.get('/my-range-file/;download')
+    assert response.status_code == 200
+    assert response.content == text
+    assert response.headers['accept-ranges'] == 'bytes'
+    assert response.headers['content-length'] == '10'
+    etag = response.headers['etag']
+    # Partial content
+    response = auth.get('/my-range-file/;download', headers={'Range': 'bytes=2-5'})
+    assert response.status_code == 206
+    assert response.content == b'2345'
+    assert response.headers['content-range'] == 'bytes 2-5/10'
+    # If-Range
+    headers = {'Range': 'bytes=-3', 'If-Range': etag}
+    response = auth.get('/my-range-file/;download', headers=headers)
+    assert response.status_code == 206
+    assert response.content == b'789'
+    headers = {'Range': 'bytes=-3', 'If-Range': '"other"'}
+    response = auth.get('/my-range-file/;download', headers=headers)
+    assert response.status_code == 200
+    assert response.content == text
+    # Not satisfiable
+    response = auth.get('/my-range-file/;download', headers={'Range': 'bytes=20-'})
+    assert response.status_code == 416
+    assert response.headers['content-range'] == 'bytes */10'
+
+
+def test_parse_range():
+    assert parse_range(None, 10) is None
+    assert parse_range('bytes=0-4', 10) == (0, 4)
+    assert parse_range('bytes=5-', 10) == (5, 9)
+    assert parse_range('bytes=-3', 10) == (7, 9)
+    assert parse_range('bytes=8-100', 10) == (8, 9)
+    assert parse_range('bytes=10-', 10) is False
+    assert parse_range('bytes=0-1,4-5', 10) is None
+    assert parse_range('items=0-4', 10) is None
+    assert parse_range('bytes=4-2', 10) is None
+
+
 async def test_commit(client, server):
     server.dispatcher.add('/test/json-action', JsonAction_View)
 
@@ -183,6 +653,147 @@ async def test_commit(client, server):
         assert server.root.get_value('title', language='fr') == 'Zidane'
 
 
+async def test_text_queue(server):
+    database = server.database
+    server.text_queue = TextQueue(server, 1)
+    server.text_queue.enable()
+    try:
+        async with database.init_context():
+            server.root.make_resource('test-text-queue', Text,
+                                      data='Zanzibar archipelago')
+            database.save_changes()
+        # Indexed, but not the text
+        assert '/test-text-queue' in server.text_queue.paths
+        query = PhraseQuery('text', 'zanzibar')
+        assert len(database.search(query)) == 0
+        assert len(database.search(abspath='/test-text-queue')) == 1
+
+        # Wait for the queue
+        generation = database.generation
+        await server.text_queue.drain()
+        assert not server.text_queue.paths
+        assert len(database.search(query)) == 1
+        assert database.generation == generation + 1
+    finally:
+        server.text_queue.stop()
+        server.text_queue = None
+
+
+async def test_text_cache(server, tmp_path):
+    database = server.database
+    text_cache = TextCache(str(tmp_path / 'text-cache.db'))
+    server.text_cache = text_cache
+    try:
+        async with database.init_context():
+            resource = server.root.make_resource('test-text-cache', Text,
+                                                 data='Kilimanjaro')
+            database.save_changes()
+            fingerprint = resource.get_fingerprint()
+            assert fingerprint
+            # Extracted once, then from the cache
+            values = resource.get_catalog_values()
+            assert values['fingerprint'] == fingerprint
+            assert text_cache.get(fingerprint) == values['text']
+            text_cache.set(fingerprint, 'From the cache')
+            values = resource.get_catalog_values()
+            assert values['text'] == 'From the cache'
+            # Changed
+            resource.set_value('title', 'Kilimanjaro', language='en')
+            assert resource.get_fingerprint() != fingerprint
+            database.save_changes()
+            assert resource.get_catalog_values()['text'] != 'From the cache'
+
+        # Remove the entries not used
+        assert text_cache.prune(time.time() + 1) == 2
+        assert text_cache.get(fingerprint) is None
+    finally:
+        text_cache.close()
+        server.text_cache = None
+
+
+def test_text_cache_threads(tmp_path):
+    text_cache = TextCache(str(tmp_path / 'text-cache.db'))
+    try:
+        text_cache.set('a', 'Zanzibar')
+        time.sleep(0.01)
+        t0 = time.time()
+        # A connection per thread, the hits are written later
+        results = []
+        thread = threading.Thread(
+            target=lambda: results.append(text_cache.get('a')))
+        thread.start()
+        thread.join()
+        assert results == ['Zanzibar']
+        assert list(text_cache.used) == ['a']
+        # Written before the entries not used are removed
+        assert text_cache.prune(t0) == 0
+        assert text_cache.used == {}
+        assert text_cache.prune(time.time() + 1) == 1
+    finally:
+        text_cache.close()
+
+
+async def test_online_reindex(server, monkeypatch):
+    database = server.database
+    query = PhraseQuery('format', 'user')
+    nb_users = len(database.search(query))
+    assert nb_users > 0
+    # A read-only worker
+    reader = get_database(database.path, *server.database_size,
+                          read_only=True)
+
+    reindex = OnlineReindex(server, batch_size=5)
+    task = asyncio.create_task(reindex.run())
+    # A commit during the rebuild goes to both catalogs
+    while reindex.count == 0:
+        await asyncio.sleep(0)
+    async with database.init_context():
+        server.root.make_resource('test-online-reindex', Text,
+                                  data='Online reindex')
+    await task
+
+    status = reindex.get_status()
+    assert status['state'] == 'done'
+    assert status['count'] > 0
+    assert database.shadow_catalog is None
+    assert len(database.search(query)) == nb_users
+    assert len(database.search(abspath='/test-online-reindex')) == 1
+    # The old catalog is kept for the workers, they open the new one
+    assert os.path.isdir(f'{database.path}/catalog.old')
+    reader.drop_cache()
+    assert len(reader.search(abspath='/test-online-reindex')) == 1
+    reader.close()
+
+    # Not on a read-only server
+    monkeypatch.setattr(server, 'read_only', True)
+    with pytest.raises(ValueError):
+        server.start_catalog_reindex()
+
+
+async def test_online_check(server, monkeypatch):
+    database = server.database
+    async with database.init_context():
+        server.root.make_resource('test-online-check', Text, data='Check')
+    catalog = database.catalog
+    catalog.unindex_document('/test-online-check')
+    catalog.save_changes()
+
+    check = server.start_catalog_check()
+    assert server.start_catalog_check() is check
+    await check.task
+    status = check.get_status()
+    assert status['state'] == 'done'
+    assert status['report']['problems']['missing'] == [
+        ('/test-online-check', None)]
+    assert status['repaired'] == 1
+    assert len(database.search(abspath='/test-online-check')) == 1
+
+    # Not on a read-only server
+    monkeypatch.setattr(server, 'read_only', True)
+    with pytest.raises(ValueError):
+        server.start_catalog_check()
+
+
 async def test_catalog_access(demo):
     query = PhraseQuery('format', 'user')
     with Server(demo) as server:
@@ -191,6 +802,17 @@ async def test_catalog_access(demo):
             search = context.search(query)
             assert len(search) == 0
 
+    # The search follows the login and the logout
+    with Server(demo) as server:
+        async with server.database.init_context() as context:
+            context.session = {}
+            assert len(context.search(query)) == 0
+            admin = context.root.get_user_from_login('test@hforge.org')
+            context.login(admin)
+            assert len(context.search(query)) > 0
+            context.logout()
+            assert len(context.search(query)) == 0
+
 #   with Server(demo) as server:
 #       async with server.database.init_context(username='0') as context:
 #           assert context.user is None
@@ -0,0 +1,95 @@
+# Import from the Standard Library
+import asyncio
+
+# Requirements
+from starlette.requests import Request
+import h11
+
+# Import from ikaaro
+from ikaaro.workers import forward_request
+from ikaaro.workers import get_generation_path, read_generation
+from ikaaro.workers import write_generation
+
+
+def test_generation_file(tmp_path):
+    path = get_generation_path(str(tmp_path))
+    # Missing file
+    assert read_generation(path) == 0
+    # Write / Read
+    write_generation(path, 42)
+    assert read_generation(path) == 42
+    write_generation(path, 43)
+    assert read_generation(path) == 43
+    assert [x.name for x in tmp_path.iterdir()] == ['generation']
+
+
+async def test_generation_bump(database, tmp_path):
+    database.generation_path = get_generation_path(str(tmp_path))
+    generation = database.generation
+    async with database.init_context():
+        root = database.get_resource('/')
+        # Nothing changed
+        database.save_changes()
+        assert database.generation == generation
+        # Commit
+        root.set_value('title', 'Generation', language='en')
+        database.save_changes()
+        assert database.generation == generation + 1
+        assert read_generation(database.generation_path) == generation + 1
+
+
+async def test_forward_request(tmp_path):
+    address = str(tmp_path / 'writer.sock')
+    received = {}
+
+    # The writer
+    async def handle(reader, writer):
+        connection = h11.Connection(h11.SERVER)
+        body = b''
+        while True:
+            event = connection.next_event()
+            if event is h11.NEED_DATA:
+                connection.receive_data(await reader.read(65536))
+            elif isinstance(event, h11.Request):
+                received['headers'] = dict(event.headers)
+            elif isinstance(event, h11.Data):
+                body += event.data
+            elif isinstance(event, h11.EndOfMessage):
+                break
+        received['body'] = body
+        headers = [(b'content-length', b'2'), (b'set-cookie', b'a=1'),
+                   (b'set-cookie', b'b=2'), (b'connection', b'close')]
+        writer.write(connection.send(h11.Response(status_code=201,
+                                                  headers=headers)))
+        writer.write(connection.send(h11.Data(data=b'ok')))
+        writer.write(connection.send(h11.EndOfMessage()))
+        await writer.drain()
+        writer.close()
+
+    server = await asyncio.start_unix_server(handle, path=address)
+
+    # The request, the body arrives in two chunks
+    chunks = [b'hello ', b'world']
+    async def receive():
+        chunk = chunks.pop(0)
+        return {'type': 'http.request', 'body': chunk, 'more_body': bool(chunks)}
+
+    scope = {'type': 'http', 'method': 'POST', 'path': '/;edit',
+             'raw_path': b'/;edit', 'query_string': b'', 'scheme': 'http',
+             'server': ('localhost', 8080), 'client': ('10.0.0.2', 1234),
+             'headers': [(b'host', b'localhost'), (b'content-length', b'11'),
+                         (b'x-forwarded-for', b'10.0.0.1')]}
+    request = Request(scope, receive)
+    async with server:
+        response = await forward_request(request, address)
+        content = b''.join([chunk async for chunk in response.body_iterator])
+
+    assert received['body'] == b'hello world'
+    assert received['headers'][b'content-length'] == b'11'
+    assert received['headers'][b'x-forwarded-for'] == b'10.0.0.1, 10.0.0.2'
+    assert response.status_code == 201
+    assert content == b'ok'
+    cookies = [ value for name, value in response.raw_headers
+                if name == b'set-cookie' ]
+    assert cookies == [b'a=1', b'b=2']
+    assert scope['forwarded_headers'] == response.raw_headers